@@ -94,3 +94,8 @@ BACKUP_NEED_PARAMS = {
 }
 
 MESSAGE_S3_CONNECT_FAILED = "s3 connect failed"
+# the beginning of pgtools -v output kept for error messages
+BACKUP_LIST_HEAD_SIZE = 4096
+# a backup entry of barman-cloud-backup-list is far smaller, a longer
+# undecodable entry is malformed
+BACKUP_LIST_ENTRY_MAX_SIZE = 1024 * 1024
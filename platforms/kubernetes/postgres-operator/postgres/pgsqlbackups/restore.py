@@ -4,12 +4,13 @@ import kopf
 import os
 import time
 
-from pgsqlbackups.utils import get_oldest_backupid, is_backup_id, get_backupid_from_backupinfo, get_latest_backupid, get_need_s3_env
+from pgsqlbackups.utils import get_oldest_backupid, is_backup_id, get_backupid_from_backupinfo, get_latest_backupid, get_need_s3_env, \
+    get_backup_info
 from pgsqlbackups.constants import *
 from pgsqlcommons.constants import *
 from pgsqlcommons.typed import InstanceConnection, InstanceConnections
 from pgsqlclusters.utiles import waiting_postgresql_ready, exec_command, waiting_instance_ready, \
-    connect_machine, waiting_postgresql_recovery_completed
+    connect_machine, waiting_postgresql_recovery_completed, exec_script, ScriptStep
 from pgsqlclusters.timer import correct_user_password
 
 
@@ -90,21 +91,15 @@ def restore_postgresql_fromssh(
     waiting_instance_ready(tmpconns, logger)
 
     # remove old data
-    cmd = ["rm", "-rf", PG_DATABASE_DIR]
-    exec_command(conn, cmd, logger, interrupt=True)
+    steps = [["rm", "-rf", PG_DATABASE_DIR]]
 
     # copy data command
     if address == RESTORE_FROMSSH_LOCAL:
         ssh_conn = conn
-        cmd = ["mv", path, PG_DATABASE_DIR]
-
         # copy data
-        exec_command(conn, cmd, logger, interrupt=True)
-
+        steps.append(["mv", path, PG_DATABASE_DIR])
         # change owner
-        exec_command(conn, ['chown', '-R', 'postgres:postgres', DATA_DIR],
-                     logger,
-                     interrupt=True)
+        steps.append(['chown', '-R', 'postgres:postgres', DATA_DIR])
     else:
         username = address.split(":")[0]
         password = address.split(":")[1]
@@ -118,37 +113,35 @@ def restore_postgresql_fromssh(
         ]
         ssh_conn = connect_machine(address)
         # copy data
-        exec_command(conn, cmd, logger, interrupt=True, user='postgres')
+        steps.append(ScriptStep(cmd, user='postgres'))
 
     # remove recovery file
-    #cmd =["rm", "-rf", os.path.join(PG_DATABASE_DIR, RECOVERY_CONF_FILE)]
-    cmd = [
-        "truncate", "--size", "0",
-        os.path.join(PG_DATABASE_DIR, RECOVERY_CONF_FILE)
-    ]
-    exec_command(conn, cmd, logger, interrupt=True, user='postgres')
-
-    #cmd =["rm", "-rf", os.path.join(PG_DATABASE_DIR, RECOVERY_SET_FILE)]
-    cmd = [
-        "truncate", "--size", "0",
-        os.path.join(PG_DATABASE_DIR, RECOVERY_SET_FILE)
-    ]
-    exec_command(conn, cmd, logger, interrupt=True, user='postgres')
-
-    cmd = ["rm", "-rf", os.path.join(PG_DATABASE_DIR, STANDBY_SIGNAL)]
-    exec_command(conn, cmd, logger, interrupt=True)
+    steps.append(
+        ScriptStep([
+            "truncate", "--size", "0",
+            os.path.join(PG_DATABASE_DIR, RECOVERY_CONF_FILE)
+        ],
+                   user='postgres'))
+    steps.append(
+        ScriptStep([
+            "truncate", "--size", "0",
+            os.path.join(PG_DATABASE_DIR, RECOVERY_SET_FILE)
+        ],
+                   user='postgres'))
+    steps.append(["rm", "-rf", os.path.join(PG_DATABASE_DIR, STANDBY_SIGNAL)])
 
     # remove old status data
-    cmd = [
+    steps.append([
         "rm", "-rf",
         "/var/lib/postgresql/data/auto_failover/pg_autoctl/var/lib/postgresql/data/pg_data/pg_autoctl.init",
         "/var/lib/postgresql/data/auto_failover/pg_autoctl/var/lib/postgresql/data/pg_data/pg_autoctl.state"
-    ]
-    exec_command(conn, cmd, logger, interrupt=True)
+    ])
 
     # resume postgresql
-    cmd = ["pgtools", "-p", POSTGRESQL_RESUME]
-    exec_command(conn, cmd, logger, interrupt=True)
+    steps.append(["pgtools", "-p", POSTGRESQL_RESUME])
+
+    # one exec for the whole restore, stop at the first failed step
+    exec_script(conn, steps, logger, interrupt=True)
 
     # waiting posgresql ready
     waiting_postgresql_ready(tmpconns, logger)
@@ -190,18 +183,18 @@ def restore_postgresql_froms3(
 
     # get backup info
     cmd = ["pgtools", "-v"] + s3_info
-    output = exec_command(conn, cmd, logger, interrupt=True)
-    if output == "":
+    parser = get_backup_info(conn, cmd, logger)
+    if parser.get_head() == "":
         logger.error(f"get backup info failed, exit backup")
         raise kopf.PermanentError("get backup info failed.")
-    logger.warning(f"backup verbose info = {output}")
 
     # process backup info
-    backup_info = {BARMAN_BACKUP_LISTS: ""}
-    try:
-        backup_info = json.loads(output)
-    except json.JSONDecodeError as e:
-        logger.error(f"decode backup_info with error, {e}")
+    if not parser.ok():
+        logger.error(
+            f"decode backup_info with error, {parser.get_head()}")
+    backup_info = parser.get_backup_info()
+    logger.warning(
+        f"backup info has {len(backup_info[BARMAN_BACKUP_LISTS])} backups")
 
     # recovery param processing
     if recovery is None:
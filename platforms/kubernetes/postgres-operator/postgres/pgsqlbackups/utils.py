@@ -4,10 +4,8 @@ import logging
 import copy
 import json
 
-from kubernetes import client
-
 from pgsqlcommons.constants import *
-from pgsqlcommons.typed import TypedDict, List, Any
+from pgsqlcommons.typed import TypedDict, List, Any, InstanceConnection
 from pgsqlbackups.constants import *
 import pgsqlclusters.utiles as pgsql_util
 
@@ -211,6 +209,102 @@ def get_backup_status_from_backup_info(
     return res
 
 
+class BackupListParser:
+    """incremental parser of barman-cloud-backup-list --format json.
+
+    feed the output chunk by chunk, only need_field of every backup is
+    kept, so the memory is bounded by one backup entry whatever the size
+    of the catalog. a malformed entry stops the parser, ok() is False
+    until the whole list is read.
+    """
+
+    def __init__(self, need_field: List = BARMAN_STATUS_DEFAULT_NEED_FIELD):
+        self.need_field = need_field
+        self.decoder = json.JSONDecoder()
+        self.key = '"%s"' % BARMAN_BACKUP_LISTS
+        self.buffer = ""
+        self.head = ""
+        self.in_list = False
+        self.done = False
+        self.error = None
+        self.backups = list()
+
+    def feed(self, chunk: str) -> None:
+        if len(self.head) < BACKUP_LIST_HEAD_SIZE:
+            self.head += chunk[:BACKUP_LIST_HEAD_SIZE - len(self.head)]
+        if self.done or self.error != None:
+            return
+        self.buffer += chunk
+
+        if not self.in_list:
+            i = self.buffer.find(self.key)
+            j = -1 if i == -1 else self.buffer.find("[", i + len(self.key))
+            if j == -1:
+                # keep what may be the beginning of the key
+                if i == -1:
+                    self.buffer = self.buffer[-len(self.key):]
+                return
+            self.buffer = self.buffer[j + 1:]
+            self.in_list = True
+
+        while True:
+            self.buffer = self.buffer.lstrip(" \t\r\n,")
+            if self.buffer.startswith("]"):
+                self.buffer = ""
+                self.done = True
+                return
+            if self.buffer == "":
+                return
+            if not self.buffer.startswith("{"):
+                self.fail(f"backup entry expected at {self.buffer[:32]}")
+                return
+            try:
+                backup, end = self.decoder.raw_decode(self.buffer)
+            except json.JSONDecodeError as e:
+                # the entry is not complete yet
+                if len(self.buffer) > BACKUP_LIST_ENTRY_MAX_SIZE:
+                    self.fail(f"backup entry is malformed, {e}")
+                return
+            self.buffer = self.buffer[end:]
+            self.backups.append({
+                field: backup[field]
+                for field in self.need_field if field in backup
+            })
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        self.buffer = ""
+
+    def get_backup_info(self) -> TypedDict:
+        """like json.loads of the output, with only need_field."""
+        return {BARMAN_BACKUP_LISTS: self.backups}
+
+    def get_head(self) -> str:
+        """the beginning of the output, for error messages."""
+        return self.head
+
+    def get_error(self) -> str:
+        if self.error != None:
+            return self.error
+        if not self.done:
+            return "backup list is truncated"
+        return None
+
+    def ok(self) -> bool:
+        return self.done
+
+
+def get_backup_info(conn: InstanceConnection,
+                    cmd: List,
+                    logger: logging.Logger,
+                    user: str = "root") -> BackupListParser:
+    """run pgtools -v and parse the backup list while it is read."""
+    parser = BackupListParser()
+    for chunk in pgsql_util.exec_command_stream(conn, cmd, logger, user=user):
+        parser.feed(chunk)
+    return parser
+
+
 def get_s3_backup_list(
     meta: kopf.Meta,
     spec: kopf.Spec,
@@ -218,35 +312,38 @@ def get_s3_backup_list(
     status: kopf.Status,
     logger: logging.Logger,
 ) -> (List, str):
-    conns = pgsql_util.connections(
-        spec, meta, patch, pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE),
-        False, None, logger, None, status, False)
     s3_info = get_need_s3_env(meta, spec, patch, status, logger,
                               [SPEC_S3, SPEC_BACKUPTOS3_POLICY, BACKUP_NAME])
 
     cmd = ["pgtools", "-v"] + s3_info
-    output = pgsql_util.exec_command(conns.get_conns()[0],
-                                     cmd,
-                                     logger,
-                                     interrupt=True,
-                                     user="postgres")
+    with pgsql_util.connections(
+            spec, meta, patch,
+            pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE), False, None,
+            logger, None, status, False) as conns:
+        parser = get_backup_info(conns.get_conns()[0],
+                                 cmd,
+                                 logger,
+                                 user="postgres")
+    output = parser.get_head()
     if output == "":
         raise kopf.TemporaryError(
             "get_s3_backup_list get backup info failed, exit ...")
     elif output.find(MESSAGE_S3_CONNECT_FAILED) != -1:
         raise kopf.TemporaryError(
             "get_s3_backup_list connect s3 failed, exit ...")
-    logger.warning(f"get_s3_backup_list get backup verbose info = {output}")
-
-    backup_info = {BARMAN_BACKUP_LISTS: ""}
-    try:
-        backup_info = json.loads(output)
-    except json.JSONDecodeError as e:
-        logger.error(f"decode backup_info with error, {e}")
+    if not parser.ok():
+        # a partial list would drop the missing backups from the status
+        raise kopf.TemporaryError(
+            f"get_s3_backup_list decode backup info failed, {parser.get_error()}, {output}"
+        )
+    backup_info = parser.get_backup_info()
+    logger.warning(
+        f"get_s3_backup_list get {len(backup_info[BARMAN_BACKUP_LISTS])} backups"
+    )
 
     latest_backup_id = get_latest_backupid(backup_info)
 
-    return get_backup_status_from_backup_info(backup_info), latest_backup_id
+    return backup_info[BARMAN_BACKUP_LISTS], latest_backup_id
 
 
 def load_and_check_params(
@@ -296,7 +393,7 @@ def check_condition_pgsql_exists(
 ) -> TypedDict:
 
     body = None
-    customer_obj_api = client.CustomObjectsApi()
+    customer_obj_api = pgsql_util.get_custom_objects_api()
     name = backup_params[SPEC_CLUSTERNAME]
     namespace = backup_params[SPEC_CLUSTERNAMESPACE]
 
@@ -326,7 +423,7 @@ def delete_backup_cr(
     namespace: str,
     logger: logging.Logger,
 ) -> None:
-    customer_obj_api = client.CustomObjectsApi()
+    customer_obj_api = pgsql_util.get_custom_objects_api()
 
     try:
         customer_obj_api.delete_namespaced_custom_object(
@@ -5,6 +5,7 @@ import copy
 import traceback
 import time
 import hashlib
+import functools
 
 from kubernetes import client
 
@@ -31,6 +32,7 @@ from pgsqlclusters.utiles import (
     get_postgresql_config_port,
     get_autoctl_name,
     machine_sftp_put,
+    machine_sftp_same,
     connections,
     get_autofailover_labels,
     get_readwrite_labels,
@@ -54,6 +56,13 @@ from pgsqlclusters.utiles import (
     waiting_instance_ready,
     statefulset_name_get_external_service_name,
     create_ssl_key,
+    get_core_v1_api,
+    get_apps_v1_api,
+    put_file,
+    exec_script,
+    apply_statefulset,
+    waiting_statefulset_rollout,
+    fan_out,
 )
 
 
@@ -143,7 +152,7 @@ def create_statefulset_service(
     logger: logging.Logger,
     meta: kopf.Meta,
 ) -> None:
-    core_v1_api = client.CoreV1Api()
+    core_v1_api = get_core_v1_api()
 
     statefulset_service_body = {}
     statefulset_service_body["apiVersion"] = "v1"
@@ -165,8 +174,14 @@ def create_statefulset_service(
 
     logger.info(f"create statefulset service with {statefulset_service_body}")
     kopf.adopt(statefulset_service_body)
-    core_v1_api.create_namespaced_service(namespace=namespace,
-                                          body=statefulset_service_body)
+    try:
+        core_v1_api.create_namespaced_service(namespace=namespace,
+                                              body=statefulset_service_body)
+    except client.exceptions.ApiException as e:
+        # the statefulset is updated in place, keep its service
+        if e.status != 409:
+            raise
+        logger.info(f"statefulset service {name} already exists")
 
     #service_body = {}
     #service_body["apiVersion"] = "v1"
@@ -204,7 +219,7 @@ def create_statefulset(
     exporter_env: List,
 ) -> None:
 
-    apps_v1_api = client.AppsV1Api()
+    apps_v1_api = get_apps_v1_api()
     statefulset_body = {}
     statefulset_body["apiVersion"] = "apps/v1"
     statefulset_body["kind"] = "StatefulSet"
@@ -250,15 +265,29 @@ def create_statefulset(
     }
     statefulset_body["spec"]["volumeClaimTemplates"] = vct
 
-    logger.info(f"create statefulset with {statefulset_body}")
-    kopf.adopt(statefulset_body)
     try:
-        apps_v1_api.create_namespaced_stateful_set(namespace=namespace,
-                                                   body=statefulset_body)
-    except Exception as e:
-        print(
-            "Exception when calling AppsV1Api->create_namespaced_stateful_set: %s\n"
-            % e)
+        current = apps_v1_api.read_namespaced_stateful_set(name, namespace)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+        current = None
+    if current != None:
+        # volumeClaimTemplates can't be changed, resize_pvc resizes the pvc.
+        current_vct = apps_v1_api.api_client.sanitize_for_serialization(
+            current)["spec"].get("volumeClaimTemplates", [])
+        for current_claim in current_vct:
+            current_claim.pop("status", None)
+        statefulset_body["spec"]["volumeClaimTemplates"] = current_vct
+        logger.info(f"apply statefulset with {statefulset_body}")
+    else:
+        logger.info(f"create statefulset with {statefulset_body}")
+    kopf.adopt(statefulset_body)
+    applied = apply_statefulset(statefulset_body)
+
+    # a changed template restarts the pod in place
+    if current != None and applied.metadata.generation != current.metadata.generation:
+        waiting_statefulset_rollout(name, namespace,
+                                    applied.metadata.generation, logger)
 
 
 def create_postgresql(
@@ -308,11 +337,12 @@ def create_postgresql(
         if container[CONTAINER_NAME] == PODSPEC_CONTAINERS_EXPORTER_CONTAINER:
             exporter_image = container[IMAGE]
 
+    machine_env = ""
+    k8s_env = []
     if mode == MACHINE_MODE:
         replicas = conns.get_number() if create_end is None else create_end
         pgdata = os.path.join(machine_data_path, PGDATA_DIR)
         remotepath = os.path.join(machine_data_path, DOCKER_COMPOSE_DIR)
-        machine_env = ""
         machine_exporter_env = get_machine_exporter_env(
             meta, spec, patch, status, logger, field,
             localspec[PODSPEC][CONTAINERS][EXPORTER_CONTAINER_INDEX])
@@ -321,7 +351,6 @@ def create_postgresql(
             REPLICAS) if create_end is None else create_end
         if replicas == None:
             replicas = 1
-        k8s_env = []
         k8s_exporter_env = get_k8s_exporter_env(
             meta, spec, patch, status, logger, field,
             localspec[PODSPEC][CONTAINERS][EXPORTER_CONTAINER_INDEX])
@@ -450,7 +479,10 @@ def create_postgresql(
             CONTAINER_ENV_NAME: PG_CONFIG_PREFIX + "archive_command",
             CONTAINER_ENV_VALUE: "'/bin/true'"
         })
-    for replica in range(create_begin, replicas):
+
+    def create_replica(replica: int, machine_env: str, k8s_env: List) -> None:
+        # every replica appends its own env to a copy of the common part
+        k8s_env = copy.copy(k8s_env)
         name = get_statefulset_name(meta["name"], field, replica)
         namespace = meta["namespace"]
         autoctl_node_password = patch.status.get(AUTOCTL_NODE)
@@ -613,36 +645,59 @@ def create_postgresql(
 
         if mode == MACHINE_MODE:
             logger.info("put docker-compose file to remote")
-            machine_sftp_put(
-                conns.get_conns()[replica].get_machine().get_sftp(),
+            machine = conns.get_conns()[replica].get_machine()
+            compose_files = {
+                DOCKER_COMPOSE_FILE:
                 DOCKER_COMPOSE_FILE_DATA %
-                (conns.get_conns()[replica].get_machine().get_role(),
-                 conns.get_conns()[replica].get_machine().get_role(),
-                 conns.get_conns()[replica].get_machine().get_role() +
-                 PODSPEC_CONTAINERS_EXPORTER_CONTAINER,
-                 conns.get_conns()[replica].get_machine().get_role() +
+                (machine.get_role(), machine.get_role(), machine.get_role() +
+                 PODSPEC_CONTAINERS_EXPORTER_CONTAINER, machine.get_role() +
                  PODSPEC_CONTAINERS_EXPORTER_CONTAINER),
-                os.path.join(remotepath, DOCKER_COMPOSE_FILE))
-            machine_sftp_put(
-                conns.get_conns()[replica].get_machine().get_sftp(),
-                DOCKER_COMPOSE_ENV_DATA.format(
-                    postgresql_image,
-                    conns.get_conns()[replica].get_machine().get_host(),
-                    pgdata, exporter_image),
-                os.path.join(remotepath, DOCKER_COMPOSE_ENV))
-            machine_sftp_put(
-                conns.get_conns()[replica].get_machine().get_sftp(),
-                machine_env, os.path.join(remotepath, DOCKER_COMPOSE_ENVFILE))
-            machine_sftp_put(
-                conns.get_conns()[replica].get_machine().get_sftp(),
-                machine_exporter_env,
-                os.path.join(remotepath, DOCKER_COMPOSE_EXPORTER_ENVFILE))
-
-            logger.info("start with docker-compose")
-            machine_exec_command(
-                conns.get_conns()[replica].get_machine().get_ssh(),
-                "cd " + os.path.join(machine_data_path, DOCKER_COMPOSE_DIR) +
-                "; docker-compose up -d")
+                DOCKER_COMPOSE_ENV:
+                DOCKER_COMPOSE_ENV_DATA.format(postgresql_image,
+                                               machine.get_host(), pgdata,
+                                               exporter_image),
+                DOCKER_COMPOSE_ENVFILE: machine_env,
+                DOCKER_COMPOSE_EXPORTER_ENVFILE: machine_exporter_env,
+            }
+            changed = False
+            for filename, content in compose_files.items():
+                filepath = os.path.join(remotepath, filename)
+                # files put by older versions are world readable
+                if machine_sftp_same(machine.get_sftp(), content, filepath,
+                                     0o600):
+                    logger.info(
+                        f"{filepath} on {machine.get_host()} is unchanged, skip put"
+                    )
+                    continue
+                changed = True
+                put_file(conns.get_conns()[replica],
+                         filepath,
+                         content,
+                         logger,
+                         host=True)
+
+            running = machine_postgresql_running(conns.get_conns()[replica])
+            if changed == False and running == True:
+                logger.info(
+                    f"docker-compose files on {machine.get_host()} are unchanged and containers are running, skip docker-compose up"
+                )
+            else:
+                if running == True:
+                    # the rolling update doesn't stop a machine instance, stop it here.
+                    output = exec_command(conns.get_conns()[replica],
+                                          ["pgtools", "-R"],
+                                          logger,
+                                          interrupt=False)
+                    if output.find(STOP_FAILED_MESSAGE) != -1:
+                        logger.warning(
+                            f"can't stop postgresql. {output}, force stop it")
+                    machine_postgresql_down(conns.get_conns()[replica],
+                                            logger)
+                logger.info("start with docker-compose")
+                machine_exec_command(
+                    machine.get_ssh(), "cd " +
+                    os.path.join(machine_data_path, DOCKER_COMPOSE_DIR) +
+                    "; docker-compose up -d")
         else:
             create_statefulset_service(
                 statefulset_name_get_service_name(name),
@@ -690,6 +745,22 @@ def create_postgresql(
                                           tmpconn)
                     time.sleep(5)
 
+    parallel_begin = create_begin
+    if field == get_field(
+            POSTGRESQL, READWRITEINSTANCE) and create_begin == 0 and replicas > 0:
+        # the standbys clone from the primary, start it first.
+        create_replica(0, machine_env, k8s_env)
+        parallel_begin = 1
+    parallel_replicas = list(range(parallel_begin, replicas))
+    if len(parallel_replicas) > 0:
+        logger.info(
+            f"create {field} replicas {parallel_replicas} with parallelism {operator_config.CREATE_PARALLELISM}"
+        )
+        fan_out(parallel_replicas,
+                lambda replica: create_replica(replica, machine_env, k8s_env),
+                logger,
+                limit=operator_config.CREATE_PARALLELISM)
+
     if field != get_field(AUTOFAILOVER):
         waiting_pg_basebackup_completed(conns, logger, create_begin, replicas)
 
@@ -704,7 +775,7 @@ def create_services(
     autofailover_machines = spec.get(AUTOFAILOVER).get(MACHINES)
     # k8s mode
     if autofailover_machines == None:
-        core_v1_api = client.CoreV1Api()
+        core_v1_api = get_core_v1_api()
         for service in spec[SERVICES]:
             autofailover = False
             if service[SELECTOR] == SERVICE_AUTOFAILOVER:
@@ -884,157 +955,166 @@ def create_extension(conn: InstanceConnection,
 
 
 # LABEL: MULTI_PG_VERSIONS
+@functools.lru_cache()
+def get_log_table_ddl(postgresql_major_version: int) -> str:
+    """one statement list creating every log_postgresql_NN foreign table."""
+    columns = [
+        "%s %s" % (name, typ) for name, typ, version in PGLOG_COLUMNS
+        if version <= postgresql_major_version
+    ]
+    ddl = [
+        "create extension if not exists file_fdw",
+        "create server if not exists pg_file_server foreign data wrapper file_fdw",
+    ]
+    for day in range(1, PGLOG_DAYS + 1):
+        table_name = PGLOG_TABLE_PREFIX + "%02d" % day
+        log_filepath = PGLOG_DIR + "/" + PGLOG_FILE_PREFIX + "%02d" % day + '.csv'
+        ddl.append(
+            "create foreign table if not exists %s (%s) server pg_file_server options(program 'grep -v pg_auto_failover %s',format 'csv',header 'true')"
+            % (table_name, ", ".join(columns), log_filepath))
+    return "; ".join(ddl)
+
+
+# csvlog ingestion, run on the primary by the timer.
+# the syslogger writes whole records, so a file ending with a newline ends
+# with a complete record and can be loaded up to its current size. when the
+# day of a file changes the file was rotated, the partition then keeps only
+# the rows of the new day.
+PGLOG_STORE_INGEST_BODY = """
+declare
+    v_node text;
+    v_today date;
+    v_log_date date;
+    v_log_day int;
+    v_log_file text;
+    v_log_stat record;
+    v_partition text;
+    v_last_date date;
+    v_last_offset bigint;
+    v_rows bigint;
+    v_current boolean;
+    v_total bigint := 0;
+begin
+    if pg_is_in_recovery() then
+        return 0;
+    end if;
+    perform pg_advisory_xact_lock(hashtext('%(function)s'));
+    v_node := trim(both chr(10) from pg_read_file('/etc/hostname'));
+    v_today := (now() at time zone current_setting('log_timezone'))::date;
+    foreach v_log_date in array array[v_today - 1, v_today] loop
+        v_log_day := extract(day from v_log_date);
+        v_log_file := '%(log_dir)s/%(file_prefix)s' || to_char(v_log_day, 'FM00') || '.csv';
+        v_partition := '%(table)s_' || to_char(v_log_day, 'FM00');
+        v_log_stat := pg_stat_file(v_log_file, true);
+        if v_log_stat.size is null or v_log_stat.modification < v_log_date then
+            continue;
+        end if;
+
+        select log_date, log_offset into v_last_date, v_last_offset
+            from %(offset_table)s where node = v_node and log_day = v_log_day;
+        if v_last_date is distinct from v_log_date then
+            v_last_offset := 0;
+            execute format('select exists (select 1 from %%I where log_time >= %%L)', v_partition, v_log_date) into v_current;
+            if not v_current then
+                execute format('truncate %%I', v_partition);
+            else
+                execute format('delete from %%I where log_time < %%L', v_partition, v_log_date);
+            end if;
+        end if;
+        if v_log_stat.size < v_last_offset then
+            v_last_offset := 0;
+        end if;
+
+        if v_log_stat.size > v_last_offset and get_byte(pg_read_binary_file(v_log_file, v_log_stat.size - 1, 1), 0) = 10 then
+            truncate %(stage_table)s;
+            execute format('copy %(stage_table)s from program %%L with (format csv)',
+                'tail -c +' || (v_last_offset + 1) || ' ' || v_log_file || ' | head -c ' || (v_log_stat.size - v_last_offset));
+            insert into %(table)s select s.*, v_log_day from %(stage_table)s s where s::text not like '%%pg_auto_failover%%';
+            get diagnostics v_rows = row_count;
+            v_total := v_total + v_rows;
+            v_last_offset := v_log_stat.size;
+        end if;
+
+        insert into %(offset_table)s values (v_node, v_log_day, v_log_date, v_last_offset)
+            on conflict (node, log_day) do update set log_date = excluded.log_date, log_offset = excluded.log_offset;
+    end loop;
+    return v_total;
+end
+""" % {
+    "function": PGLOG_STORE_FUNCTION,
+    "log_dir": PGLOG_DIR,
+    "file_prefix": PGLOG_FILE_PREFIX,
+    "table": PGLOG_STORE_TABLE,
+    "stage_table": PGLOG_STORE_STAGE_TABLE,
+    "offset_table": PGLOG_STORE_OFFSET_TABLE,
+}
+
+
+@functools.lru_cache()
+def get_log_store_ddl(postgresql_major_version: int) -> str:
+    """partitioned log table, one partition per postgresql_%d file."""
+    columns = ", ".join([
+        "%s %s" % (name, typ) for name, typ, version in PGLOG_COLUMNS
+        if version <= postgresql_major_version
+    ])
+    ddl = [
+        "create table if not exists %s (%s, log_day int not null) partition by list (log_day)"
+        % (PGLOG_STORE_TABLE, columns)
+    ]
+    for day in range(1, PGLOG_DAYS + 1):
+        ddl.append(
+            "create table if not exists %s_%02d partition of %s for values in (%d)"
+            % (PGLOG_STORE_TABLE, day, PGLOG_STORE_TABLE, day))
+    ddl += [
+        "create index if not exists %s_log_time_idx on %s using brin (log_time)"
+        % (PGLOG_STORE_TABLE, PGLOG_STORE_TABLE),
+        "create index if not exists %s_sql_state_code_idx on %s (sql_state_code)"
+        % (PGLOG_STORE_TABLE, PGLOG_STORE_TABLE),
+        "create index if not exists %s_user_name_idx on %s (user_name)" %
+        (PGLOG_STORE_TABLE, PGLOG_STORE_TABLE),
+        "create unlogged table if not exists %s (%s)" %
+        (PGLOG_STORE_STAGE_TABLE, columns),
+        "create table if not exists %s (node text, log_day int, log_date date, log_offset bigint, primary key (node, log_day))"
+        % PGLOG_STORE_OFFSET_TABLE,
+        # pgtools gets the query in double quotes, so no dollar quoting
+        "create or replace function %s() returns bigint language plpgsql as '%s'"
+        % (PGLOG_STORE_FUNCTION, PGLOG_STORE_INGEST_BODY.replace("'", "''")),
+    ]
+    return "; ".join(ddl)
+
+
 def create_log_table(logger: logging.Logger, conn: InstanceConnection,
                      postgresql_major_version: int) -> None:
     logger.info("create postgresql log table")
-    cmd = ["truncate", "--size", "0", "%s/%s/*" % (PG_DATABASE_DIR, PGLOG_DIR)]
-    output = exec_command(conn, cmd, logger, interrupt=False)
-
-    cmd = ["pgtools", "-q", '"create extension file_fdw"']
-    output = exec_command(conn, cmd, logger, interrupt=False)
-    if output.find("CREATE EXTENSION") == -1:
-        logger.error(f"can't create file_fdw {cmd}, {output}")
-
-    cmd = [
-        "pgtools", "-q",
-        '"create server pg_file_server foreign data wrapper file_fdw"'
+    if postgresql_major_version < PGLOG_MIN_VERSION or postgresql_major_version > PGLOG_MAX_VERSION:
+        logger.warning(
+            f"no compatible postgresql version {postgresql_major_version}, create log with postgresql {PGLOG_MAX_VERSION} query."
+        )
+        postgresql_major_version = PGLOG_MAX_VERSION
+
+    # psql runs a multi statement string in one transaction
+    query = get_log_table_ddl(postgresql_major_version)
+    logger.info(f"create postgresql log table query {query}")
+    steps = [
+        ["truncate", "--size", "0",
+         "%s/%s/*" % (PG_DATABASE_DIR, PGLOG_DIR)],
+        ["pgtools", "-q", '"' + query + '"'],
     ]
-    output = exec_command(conn, cmd, logger, interrupt=False)
-    if output.find("CREATE SERVER") == -1:
-        #logging.getLogger().error(
-        logger.error(f"can't create pg_file_server {cmd}, {output}")
-
-    for day in range(1, 32):
-        table_name = 'log_postgresql_' + "%02d" % day
-        log_filepath = PGLOG_DIR + "/postgresql_" + "%02d" % day + '.csv'
-        if postgresql_major_version == 12:
-            query = """ CREATE foreign TABLE %s
-                (
-                     log_time timestamp(3),
-                     user_name text,
-                     database_name text,
-                     process_id integer,
-                     connection_from text,
-                     session_id text,
-                     session_line_num bigint,
-                     command_tag text,
-                     session_start_time timestamp,
-                     virtual_transaction_id text,
-                     transaction_id bigint,
-                     error_severity text,
-                     sql_state_code text,
-                     message text,
-                     detail text,
-                     hint text,
-                     internal_query text,
-                     internal_query_pos integer,
-                     context text,
-                     query text,
-                     query_pos integer,
-                     location text,
-                     application_name text
-                ) server pg_file_server options(program 'grep -v pg_auto_failover %s',format 'csv',header 'true') """ % (
-                table_name, log_filepath)
-        elif postgresql_major_version == 13:
-            query = """ CREATE foreign TABLE %s
-                (
-                     log_time timestamp(3),
-                     user_name text,
-                     database_name text,
-                     process_id integer,
-                     connection_from text,
-                     session_id text,
-                     session_line_num bigint,
-                     command_tag text,
-                     session_start_time timestamp,
-                     virtual_transaction_id text,
-                     transaction_id bigint,
-                     error_severity text,
-                     sql_state_code text,
-                     message text,
-                     detail text,
-                     hint text,
-                     internal_query text,
-                     internal_query_pos integer,
-                     context text,
-                     query text,
-                     query_pos integer,
-                     location text,
-                     application_name text,
-                     backend_type text
-                ) server pg_file_server options(program 'grep -v pg_auto_failover %s',format 'csv',header 'true') """ % (
-                table_name, log_filepath)
-        elif postgresql_major_version == 14 or postgresql_major_version == 15:
-            query = """ CREATE foreign TABLE %s
-                (
-                     log_time timestamp(3),
-                     user_name text,
-                     database_name text,
-                     process_id integer,
-                     connection_from text,
-                     session_id text,
-                     session_line_num bigint,
-                     command_tag text,
-                     session_start_time timestamp,
-                     virtual_transaction_id text,
-                     transaction_id bigint,
-                     error_severity text,
-                     sql_state_code text,
-                     message text,
-                     detail text,
-                     hint text,
-                     internal_query text,
-                     internal_query_pos integer,
-                     context text,
-                     query text,
-                     query_pos integer,
-                     location text,
-                     application_name text,
-                     backend_type text,
-                     leader_pid integer,
-                     query_id bigint
-                ) server pg_file_server options(program 'grep -v pg_auto_failover %s',format 'csv',header 'true') """ % (
-                table_name, log_filepath)
-        else:
-            logger.warning(
-                f"no compatible postgresql version {postgresql_major_version}, create log with postgresql 14 query."
-            )
-            query = """ CREATE foreign TABLE %s
-                (
-                     log_time timestamp(3),
-                     user_name text,
-                     database_name text,
-                     process_id integer,
-                     connection_from text,
-                     session_id text,
-                     session_line_num bigint,
-                     command_tag text,
-                     session_start_time timestamp,
-                     virtual_transaction_id text,
-                     transaction_id bigint,
-                     error_severity text,
-                     sql_state_code text,
-                     message text,
-                     detail text,
-                     hint text,
-                     internal_query text,
-                     internal_query_pos integer,
-                     context text,
-                     query text,
-                     query_pos integer,
-                     location text,
-                     application_name text,
-                     backend_type text,
-                     leader_pid integer,
-                     query_id bigint
-                ) server pg_file_server options(program 'grep -v pg_auto_failover %s',format 'csv',header 'true') """ % (
-                table_name, log_filepath)
-
-        logger.info(f"create postgresql log table {table_name} query {query}")
-        cmd = ["pgtools", "-q", '"' + query + '"']
-        output = exec_command(conn, cmd, logger, interrupt=False)
-        if output.find("CREATE FOREIGN TABLE") == -1:
-            logger.error(f"can't create table {cmd}, {output}")
+    if operator_config.LOG_INGEST:
+        steps.append([
+            "pgtools", "-q",
+            '"' + get_log_store_ddl(postgresql_major_version) + '"'
+        ])
+    results = exec_script(conn,
+                          steps,
+                          logger,
+                          interrupt=False,
+                          stop_on_error=False)
+    if results[1].get_output().find("CREATE FOREIGN TABLE") == -1:
+        logger.error(f"can't create log table, {results[1].get_output()}")
+    if operator_config.LOG_INGEST and results[2].get_output().find(
+            "CREATE FUNCTION") == -1:
+        logger.error(f"can't create log store, {results[2].get_output()}")
 
 
 def machine_postgresql_down(conn: InstanceConnection,
@@ -1051,6 +1131,14 @@ def machine_postgresql_down(conn: InstanceConnection,
     machine_exec_command(conn.get_machine().get_ssh(), cmd)
 
 
+def machine_postgresql_running(conn: InstanceConnection) -> bool:
+    machine = conn.get_machine()
+    cmd = "docker inspect -f '{{.State.Running}}' " + machine.get_role(
+    ) + " " + machine.get_role() + PODSPEC_CONTAINERS_EXPORTER_CONTAINER
+    output = machine_exec_command(machine.get_ssh(), cmd, interrupt=False)
+    return output.split() == ["true", "true"]
+
+
 def create_postgresql_readwrite(
     meta: kopf.Meta,
     spec: kopf.Spec,
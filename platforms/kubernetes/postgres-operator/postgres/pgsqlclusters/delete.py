@@ -2,8 +2,6 @@ import kopf
 import logging
 import time
 
-from kubernetes import client
-
 from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List
 from pgsqlcommons.constants import *
 from pgsqlcommons.config import operator_config
@@ -56,7 +54,7 @@ def delete_postgresql(
         pgsql_create.machine_postgresql_down(conn, logger)
     elif conn.get_k8s() != None:
         try:
-            apps_v1_api = client.AppsV1Api()
+            apps_v1_api = pgsql_util.get_apps_v1_api()
             logger.info("delete postgresql instance statefulset from k8s " +
                         pgsql_util.pod_name_get_statefulset_name(
                             conn.get_k8s().get_podname()))
@@ -72,7 +70,7 @@ def delete_postgresql(
         # if Node is shutdown, delete statefulset cannot delete pod, the pod will be in the Terminating state for a long time. so need delete pod.
         # More infomation please visit: https://kubernetes.io/zh-cn/docs/tasks/run-application/force-delete-stateful-set-pod/
         try:
-            core_v1_api = client.CoreV1Api()
+            core_v1_api = pgsql_util.get_core_v1_api()
             # delete_pod override grace_period_seconds param
             delete_pod_grace_period_seconds = 10
             logger.info("delete postgresql pod from k8s: " +
@@ -86,7 +84,7 @@ def delete_postgresql(
                 "Exception when calling CoreV1Api->delete_namespaced_pod: %s\n"
                 % e)
         try:
-            core_v1_api = client.CoreV1Api()
+            core_v1_api = pgsql_util.get_core_v1_api()
             logger.info("delete postgresql instance service from k8s " +
                         pgsql_util.statefulset_name_get_service_name(
                             pgsql_util.pod_name_get_statefulset_name(
@@ -105,7 +103,7 @@ def delete_postgresql(
         #                statefulset_name_get_external_service_name(
         #                    pod_name_get_statefulset_name(
         #                        conn.get_k8s().get_podname())))
-        #    core_v1_api = client.CoreV1Api()
+        #    core_v1_api = pgsql_util.get_core_v1_api()
         #    delete_response = core_v1_api.delete_namespaced_service(
         #        statefulset_name_get_external_service_name(
         #            pod_name_get_statefulset_name(
@@ -190,7 +188,7 @@ def delete_cluster(
 
 
 def delete_pvc(logger: logging.Logger, name: str, namespace: str) -> None:
-    core_v1_api = client.CoreV1Api()
+    core_v1_api = pgsql_util.get_core_v1_api()
     grace_period_seconds = 10
 
     try:
@@ -318,7 +316,7 @@ def delete_services(
     autofailover_machines = spec.get(AUTOFAILOVER).get(MACHINES)
     # k8s mode
     if autofailover_machines == None:
-        core_v1_api = client.CoreV1Api()
+        core_v1_api = pgsql_util.get_core_v1_api()
         try:
             api_response = core_v1_api.list_service_for_all_namespaces(
                 label_selector=pgsql_util.dict_to_str(
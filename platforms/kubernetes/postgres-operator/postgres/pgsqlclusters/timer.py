@@ -1,9 +1,11 @@
 import kopf
 import logging
 import copy
+import json
 import time
-
-from kubernetes import client
+import threading
+import types
+import concurrent.futures
 
 import pgsqlclusters.create as pgsql_create
 import pgsqlclusters.update as pgsql_update
@@ -11,16 +13,171 @@ import pgsqlclusters.delete as pgsql_delete
 import pgsqlclusters.utiles as pgsql_util
 import pgsqlbackups.utils as backup_util
 from pgsqlcommons.constants import *
-from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List
+from pgsqlcommons.config import operator_config
+from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List, \
+    Dict, Callable
 from pgsqlclusters.utiles import get_conn_role, get_connhost, exec_command, connections, get_field, get_primary_conn, \
     machine_exec_command, get_readwrite_labels, dict_to_str, pod_exec_command, patch_role_body, \
-    get_postgresql_config_port, set_cluster_status, to_int, create_ssl_key
+    get_postgresql_config_port, set_cluster_status, to_int, create_ssl_key, fan_out, \
+    status_batch, submit_exec
 
 
 def current_time() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
 
+class TimerContext:
+    """what the corrections of one timer tick share.
+
+    the connections of every field are opened once, on first use, and
+    freed when the tick ends. a task still running after that can't open
+    them again.
+    """
+
+    def __init__(self, meta: kopf.Meta, spec: kopf.Spec, patch: kopf.Patch,
+                 status: kopf.Status, logger: logging.Logger):
+        self.meta = meta
+        self.spec = spec
+        self.patch = patch
+        self.status = status
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.conns: Dict[str, InstanceConnections] = {}
+        self.observed: ClusterObservation = None
+        self.ended = False
+
+    def get_conns(self, field: str) -> InstanceConnections:
+        with self.lock:
+            if self.ended:
+                raise kopf.TemporaryError("the timer tick already ended")
+            if field not in self.conns:
+                self.conns[field] = connections(self.spec, self.meta,
+                                                self.patch, field, False,
+                                                None, self.logger, None,
+                                                self.status, False)
+            return self.conns[field]
+
+    def set_broken(self) -> None:
+        """the sessions may still be used by a late task, close them on free."""
+        with self.lock:
+            for conns in self.conns.values():
+                for conn in conns.get_conns():
+                    if conn.get_machine() != None:
+                        conn.get_machine().set_broken()
+
+    def free_conns(self) -> None:
+        with self.lock:
+            self.ended = True
+            for conns in self.conns.values():
+                conns.free_conns()
+            self.conns = {}
+
+
+class ClusterObservation:
+    """what one timer tick observed of the cluster, read only.
+
+    built once per tick, so the corrections don't query the same facts
+    again. read_only/archive_command are indexed like the readwrite conns,
+    nodes is None if the monitor can't be queried.
+    """
+
+    def __init__(self, backup_mode: str, nodes: List[Dict],
+                 readwrite_conns: List[InstanceConnection],
+                 read_only: List[str], archive_command: List[str],
+                 archiver: Dict):
+        self._backup_mode = backup_mode
+        self._nodes = None if nodes == None else tuple(
+            types.MappingProxyType(node) for node in nodes)
+        self._readwrite_conns = tuple(readwrite_conns)
+        self._read_only = tuple(read_only)
+        self._archive_command = tuple(archive_command)
+        self._archiver = None if archiver == None else types.MappingProxyType(
+            archiver)
+
+    def get_backup_mode(self) -> str:
+        return self._backup_mode
+
+    def get_nodes(self) -> Tuple:
+        return self._nodes
+
+    def get_read_only_by_podname(self, podname: str) -> str:
+        for i, conn in enumerate(self._readwrite_conns):
+            if conn.get_k8s() != None and conn.get_k8s().get_podname(
+            ) == podname:
+                return self._read_only[i]
+        return None
+
+    def get_primary_conn(self) -> InstanceConnection:
+        for i, conn in enumerate(self._readwrite_conns):
+            if self._read_only[i] == "off":
+                return conn
+        return None
+
+    def get_archive_commands(self) -> Tuple:
+        return self._archive_command
+
+    def get_archiver(self) -> Dict:
+        return self._archiver
+
+
+def observe_cluster(ctx: TimerContext) -> ClusterObservation:
+    meta, spec, patch, status, logger = ctx.meta, ctx.spec, ctx.patch, ctx.status, ctx.logger
+
+    backup_mode = backup_util.get_backup_mode(meta, spec, patch, status,
+                                              logger)
+
+    autofailover_conns = ctx.get_conns(get_field(AUTOFAILOVER))
+    autofailover_conn = autofailover_conns.get_conns()[0]
+    nodes = pgsql_util.get_autofailover_nodes(
+        autofailover_conn, logger,
+        pgsql_util.sql_endpoint(meta, spec, patch, status, logger,
+                                autofailover_conn))
+
+    readwrite_conns = ctx.get_conns(get_field(POSTGRESQL,
+                                              READWRITEINSTANCE)).get_conns()
+    endpoints = {
+        id(conn): pgsql_util.sql_endpoint(meta, spec, patch, status, logger,
+                                          conn)
+        for conn in readwrite_conns
+    }
+    query = "select current_setting('transaction_read_only') as read_only, current_setting('archive_command') as archive_command"
+    read_only = []
+    archive_command = []
+    for result in fan_out(
+            readwrite_conns, lambda conn: pgsql_util.query_rows(
+                conn, query, logger, endpoint=endpoints[id(conn)]), logger,
+            fail_fast=False):
+        rows = result.get_value() if result.ok() else None
+        if rows == None or len(rows) == 0:
+            read_only.append(FAILED)
+            archive_command.append("")
+        else:
+            read_only.append(rows[0]["read_only"])
+            archive_command.append(rows[0]["archive_command"])
+
+    archiver = None
+    primary_conn = None
+    for i, conn in enumerate(readwrite_conns):
+        if read_only[i] == "off":
+            primary_conn = conn
+            break
+    if primary_conn != None and backup_mode in (
+            BACKUP_MODE_S3_MANUAL,
+            BACKUP_MODE_S3_CRON) and spec[SPEC_BACKUPCLUSTER][
+                SPEC_BACKUPTOS3].get(SPEC_BACKUPTOS3_POLICY, {}).get(
+                    SPEC_BACKUPTOS3_POLICY_ARCHIVE, "") == "on":
+        rows = pgsql_util.query_rows(
+            primary_conn,
+            "select coalesce(last_archived_wal, '') as last_archived_wal, coalesce(last_archived_time::text, '') as last_archived_time from pg_stat_archiver limit 1",
+            logger,
+            endpoint=endpoints[id(primary_conn)])
+        if rows != None and len(rows) > 0:
+            archiver = rows[0]
+
+    return ClusterObservation(backup_mode, nodes, readwrite_conns, read_only,
+                              archive_command, archiver)
+
+
 def timer_cluster(
     meta: kopf.Meta,
     spec: kopf.Spec,
@@ -32,53 +189,137 @@ def timer_cluster(
     patch.status[CLUSTER_STATUS_TIMER] = current_time()
     #set_cluster_status(meta, CLUSTER_STATUS_TIMER, current_time(), logger)
 
-    correct_postgresql_status_lsn(meta, spec, patch, status, logger)
-
+    ctx = TimerContext(meta, spec, patch, status, logger)
+    tasks = [correct_postgresql_status_lsn]
     if pgsql_util.in_disaster_backup(meta, spec, patch, status,
-                                     logger) == True:
-        return
+                                     logger) != True:
+        tasks += [
+            correct_postgresql_role,
+            correct_keepalived,
+            correct_postgresql_password,
+            correct_backup_status,
+            correct_s3_profile,
+            correct_ssl_server_crt,
+        ]
+        if operator_config.LOG_INGEST:
+            tasks.append(ingest_postgresql_log)
 
-    correct_postgresql_role(meta, spec, patch, status, logger)
-    correct_keepalived(meta, spec, patch, status, logger)
-    correct_postgresql_password(meta, spec, patch, status, logger)
-    correct_backup_status(meta, spec, patch, status, logger)
-    correct_s3_profile(meta, spec, patch, status, logger)
+    if len(tasks) > 1:
+        ctx.observed = observe_cluster(ctx)
 
-    # last executed
-    correct_ssl_server_crt(meta, spec, patch, status, logger)
+    # all status fields changed in this tick are written by one patch
+    with status_batch(logger) as batch:
+        durations = run_timer_tasks(ctx, tasks, batch)
+    patch.status[CLUSTER_STATUS_TIMER_DURATION] = durations
 
     from .test import test
     test(meta, spec, patch, status, logger)
 
 
+def run_timer_tasks(ctx: TimerContext, tasks: List[Callable],
+                    batch: Any) -> Dict[str, Any]:
+    """run the corrections concurrently and wait for them until
+    TIMER_TASK_TIMEOUT.
+
+    every status write of a task belongs to the batch of the tick, and the
+    connections of the tick are freed once the tasks ended or the deadline
+    passed. a task still running at the deadline is left behind, the
+    connections it may use are closed instead of pooled. return the
+    duration of every task in seconds, -1 for a failed task and
+    CLUSTER_STATUS_TIMER_DURATION_TIMEOUT for a task left behind.
+    """
+    logger = ctx.logger
+    durations = {}
+
+    def run(task: Callable) -> float:
+        begin = time.time()
+        with status_batch(logger, batch=batch):
+            task(ctx.meta, ctx.spec, ctx.patch, ctx.status, logger, ctx)
+        return time.time() - begin
+
+    try:
+        futures = {submit_exec(run, task): task for task in tasks}
+        _, late = concurrent.futures.wait(
+            futures, timeout=operator_config.TIMER_TASK_TIMEOUT)
+        for future, task in futures.items():
+            if future in late:
+                future.cancel()
+                logger.warning(
+                    f"{task.__name__} not completed in {operator_config.TIMER_TASK_TIMEOUT} seconds, stop waiting for it"
+                )
+                durations[task.__name__] = CLUSTER_STATUS_TIMER_DURATION_TIMEOUT
+                continue
+            try:
+                durations[task.__name__] = round(future.result(), 3)
+            except Exception as e:
+                logger.error(f"{task.__name__} failed, {e}")
+                durations[task.__name__] = -1
+        if len(late) > 0:
+            ctx.set_broken()
+    finally:
+        ctx.free_conns()
+
+    logger.info(f"timer tasks duration {durations}")
+    return durations
+
+
 def correct_ssl_server_crt(
     meta: kopf.Meta,
     spec: kopf.Spec,
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
     if status.get(CLUSTER_STATUS_SERVER_CRT) == None:
         create_ssl_key(meta, spec, patch, status, logger)
 
 
-def correct_postgresql_status_lsn(
+def ingest_postgresql_log(
     meta: kopf.Meta,
     spec: kopf.Spec,
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
-    readwrite_conns = connections(spec, meta, patch,
-                                  get_field(POSTGRESQL, READWRITEINSTANCE),
-                                  False, None, logger, None, status, False)
-    conn = readwrite_conns.get_conns()[0]
+    primary_conn = ctx.observed.get_primary_conn()
+    if primary_conn == None:
+        return
 
-    local_str = ''
-    if pgsql_util.in_disaster_backup(meta, spec, patch, status,
-                                     logger) == True:
-        local_str = '--local'
+    steps = [["pgtools", "-q", '"select %s()"' % PGLOG_STORE_FUNCTION]]
+    output = pgsql_util.exec_script(primary_conn, steps, logger,
+                                    interrupt=False)[0].get_output()
+    if output.find("does not exist") == -1:
+        logger.info(f"ingest postgresql log, {output} rows")
+        return
 
+    # the cluster is created before LOG_INGEST is enabled
+    steps = [["pgtools", "-q", '"show server_version_num"']]
+    version = to_int(
+        pgsql_util.exec_script(primary_conn, steps, logger,
+                               interrupt=False)[0].get_output()) // 10000
+    if version == 0:
+        return
+    steps = [[
+        "pgtools", "-q",
+        '"' + pgsql_create.get_log_store_ddl(
+            min(version, PGLOG_MAX_VERSION)) + '"'
+    ]]
+    output = pgsql_util.exec_script(primary_conn, steps, logger,
+                                    interrupt=False)[0].get_output()
+    if output.find("CREATE FUNCTION") == -1:
+        logger.error(f"can't create log store, {output}")
+
+
+def correct_postgresql_status_lsn(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    ctx: TimerContext,
+) -> None:
     pg_disaster_status_dict = {}
     if status.get(CLUSTER_STATUS_DISASTER_BACKUP_STATUS) == None:
         pg_disaster_status_old = {}
@@ -86,32 +327,35 @@ def correct_postgresql_status_lsn(
         pg_disaster_status_old = copy.deepcopy(
             status[CLUSTER_STATUS_DISASTER_BACKUP_STATUS])
 
-    for i in range(1, 10):
-        pg_disaster_status_cmd = [
-            'pg_autoctl', 'show', 'state', local_str, '--pgdata',
-            PG_DATABASE_DIR, '|', 'grep', AUTOCTL_DISASTER_NAME, '|', 'cut',
-            '-d', "'|'", '-f', '3,4,6', '|', 'tr', '-d', "' '", '|', 'sed',
-            '-n', f'{i}p'
-        ]
-        pg_disaster_status = exec_command(conn,
-                                          pg_disaster_status_cmd,
-                                          logger,
-                                          interrupt=False)
-        if pg_disaster_status.find(
-                'Failed to connect to') == -1 and pg_disaster_status != FAILED:
-            if len(pg_disaster_status) > 10:
-                pg_disaster_status = [
-                    s.strip() for s in pg_disaster_status.split('|')
-                ]
-                pg_disaster_status_dict[pg_disaster_status[0]] = {
-                    "LSN": pg_disaster_status[1],
-                    "state": pg_disaster_status[2]
-                }
-            else:
-                break
-        else:
-            pg_disaster_status_dict = {}
-            break
+    # the monitor node table holds the same state as pg_autoctl show state.
+    # a disaster backup cluster only knows its local node, it isn't observed.
+    observed_nodes = None
+    if ctx.observed != None:
+        observed_nodes = ctx.observed.get_nodes()
+    if observed_nodes != None:
+        nodes = [{
+            AUTOCTL_STATE_JSON_NAME: node[AUTOCTL_NODE_NAME],
+            AUTOCTL_STATE_JSON_HOST: node[AUTOCTL_NODE_HOST],
+            AUTOCTL_STATE_JSON_PORT: node[AUTOCTL_NODE_PORT],
+            AUTOCTL_STATE_JSON_TLI: node[AUTOCTL_NODE_REPORTEDTLI],
+            AUTOCTL_STATE_JSON_LSN: node[AUTOCTL_NODE_REPORTEDLSN],
+            AUTOCTL_STATE_JSON_STATE: node[AUTOCTL_NODE_REPORTEDSTATE],
+        } for node in observed_nodes]
+    else:
+        nodes = get_autoctl_state(meta, spec, patch, status, logger, ctx)
+    for node in nodes:
+        if str(node.get(AUTOCTL_STATE_JSON_NAME,
+                        "")).find(AUTOCTL_DISASTER_NAME) == -1:
+            continue
+        pg_disaster_status_dict["%s:%s" % (
+            node.get(AUTOCTL_STATE_JSON_HOST),
+            node.get(AUTOCTL_STATE_JSON_PORT))] = {
+                "LSN":
+                "%s:%s" % (node.get(AUTOCTL_STATE_JSON_TLI),
+                           node.get(AUTOCTL_STATE_JSON_LSN)),
+                "state":
+                node.get(AUTOCTL_STATE_JSON_STATE)
+            }
 
     # cleanup expired data
     if type(pg_disaster_status_old) == type({}):
@@ -122,7 +366,41 @@ def correct_postgresql_status_lsn(
 
     patch.status[
         CLUSTER_STATUS_DISASTER_BACKUP_STATUS] = pg_disaster_status_dict
-    readwrite_conns.free_conns()
+
+
+def get_autoctl_state(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    ctx: TimerContext,
+) -> List[Dict]:
+    readwrite_conns = ctx.get_conns(get_field(POSTGRESQL, READWRITEINSTANCE))
+    conn = readwrite_conns.get_conns()[0]
+
+    local_str = ''
+    if pgsql_util.in_disaster_backup(meta, spec, patch, status,
+                                     logger) == True:
+        local_str = '--local'
+
+    pg_disaster_status_cmd = [
+        'pg_autoctl', 'show', 'state', local_str, '--json', '--pgdata',
+        PG_DATABASE_DIR, '2>/dev/null'
+    ]
+    pg_disaster_status = exec_command(conn,
+                                      pg_disaster_status_cmd,
+                                      logger,
+                                      interrupt=False)
+    try:
+        nodes = json.loads(pg_disaster_status)
+    except json.JSONDecodeError as e:
+        logger.warning(
+            f"can't decode pg_autoctl show state {pg_disaster_status}, {e}")
+        nodes = []
+    if not isinstance(nodes, list):
+        nodes = []
+    return nodes
 
 
 def correct_user_password(
@@ -169,25 +447,19 @@ def correct_postgresql_password(
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
-    autofailover_conns = connections(spec, meta, patch,
-                                     get_field(AUTOFAILOVER), False, None,
-                                     logger, None, status, False)
+    autofailover_conns = ctx.get_conns(get_field(AUTOFAILOVER))
     for conn in autofailover_conns.get_conns():
         correct_user_password(meta, spec, patch, status, logger, conn)
-    autofailover_conns.free_conns()
 
-    readwrite_conns = connections(spec, meta, patch,
-                                  get_field(POSTGRESQL, READWRITEINSTANCE),
-                                  False, None, logger, None, status, False)
-    conn = get_primary_conn(readwrite_conns, 0, logger, interrupt=False)
+    conn = ctx.observed.get_primary_conn()
     if conn == None:
         logger.error(
             f"can't correct readwrite password. because get primary conn failed"
         )
     else:
         correct_user_password(meta, spec, patch, status, logger, conn)
-    readwrite_conns.free_conns()
 
 
 def correct_keepalived(
@@ -196,34 +468,28 @@ def correct_keepalived(
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
     main_vip = ""
     read_vip = ""
-    autofailover_conns = connections(spec, meta, patch,
-                                     get_field(AUTOFAILOVER), False, None,
-                                     logger, None, status, False)
+    autofailover_conns = ctx.get_conns(get_field(AUTOFAILOVER))
     if autofailover_conns.get_conns()[0].get_machine() == None:
-        autofailover_conns.free_conns()
         return
 
-    conns = connections(spec, meta, patch,
-                        get_field(POSTGRESQL, READWRITEINSTANCE), False, None,
-                        logger, None, status, False)
-    readonly_conns = connections(spec, meta, patch,
-                                 get_field(POSTGRESQL, READONLYINSTANCE),
-                                 False, None, logger, None, status, False)
-    # keepalived is stop
-    for conn in (conns.get_conns() + readonly_conns.get_conns()):
-        for service in spec[SERVICES]:
-            if service[SELECTOR] == SERVICE_PRIMARY:
-                main_vip = service[VIP]
-            elif service[SELECTOR] == SERVICE_READONLY:
-                read_vip = service[VIP]
-            elif service[SELECTOR] == SERVICE_STANDBY_READONLY:
-                read_vip = service[VIP]
-            else:
-                logger.error(f"unsupport service {service}")
+    conns = ctx.get_conns(get_field(POSTGRESQL, READWRITEINSTANCE))
+    readonly_conns = ctx.get_conns(get_field(POSTGRESQL, READONLYINSTANCE))
+    for service in spec[SERVICES]:
+        if service[SELECTOR] == SERVICE_PRIMARY:
+            main_vip = service[VIP]
+        elif service[SELECTOR] == SERVICE_READONLY:
+            read_vip = service[VIP]
+        elif service[SELECTOR] == SERVICE_STANDBY_READONLY:
+            read_vip = service[VIP]
+        else:
+            logger.error(f"unsupport service {service}")
 
+    # keepalived is stop
+    def keepalived_running(conn: InstanceConnection) -> bool:
         output = machine_exec_command(conn.get_machine().get_ssh(),
                                       GET_INET_CMD,
                                       interrupt=False)
@@ -236,11 +502,15 @@ def correct_keepalived(
         output = machine_exec_command(conn.get_machine().get_ssh(),
                                       STATUS_KEEPALIVED,
                                       interrupt=False)
-        if output.find("Active: active (running)") == -1:
-            logger.warning("keepalived is not running. recreate the services")
-            pgsql_delete.delete_services(meta, spec, patch, status, logger)
-            pgsql_create.create_services(meta, spec, patch, status, logger)
-            break
+        return output.find("Active: active (running)") != -1
+
+    results = fan_out(conns.get_conns() + readonly_conns.get_conns(),
+                      keepalived_running, logger)
+    if not all([result.get_value() for result in results]):
+        logger.warning("keepalived is not running. recreate the services")
+        pgsql_delete.delete_services(meta, spec, patch, status, logger)
+        pgsql_create.create_services(meta, spec, patch, status, logger)
+
     # can't access keepalived vip
     accept = False
     port = get_postgresql_config_port(meta, spec, patch, status, logger)
@@ -259,15 +529,15 @@ def correct_keepalived(
             break
     if accept == False:
         logger.warning("can't access keepalived. restart keepalived")
-        for conn in (conns.get_conns() + readonly_conns.get_conns()):
-            if conn.get_machine() == None:
-                break
-            machine_exec_command(conn.get_machine().get_ssh(),
-                                 START_KEEPALIVED,
-                                 interrupt=False)
-    conns.free_conns()
-    readonly_conns.free_conns()
-    autofailover_conns.free_conns()
+        fan_out([
+            conn
+            for conn in conns.get_conns() + readonly_conns.get_conns()
+            if conn.get_machine() != None
+        ], lambda conn: machine_exec_command(conn.get_machine().get_ssh(),
+                                             START_KEEPALIVED,
+                                             interrupt=False),
+                logger,
+                fail_fast=False)
 
 
 def correct_postgresql_role(
@@ -276,8 +546,9 @@ def correct_postgresql_role(
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
-    core_v1_api = client.CoreV1Api()
+    core_v1_api = pgsql_util.get_core_v1_api()
 
     # we don't have pod on machine.
     try:
@@ -290,9 +561,12 @@ def correct_postgresql_role(
             "Exception when calling list_pod_for_all_namespaces: %s\n" % e)
 
     for pod in pods.items:
-        cmd = ["pgtools", "-w", "0", "-q", "'show transaction_read_only'"]
-        output = pod_exec_command(pod.metadata.name, pod.metadata.namespace,
-                                  cmd, logger, False)
+        output = ctx.observed.get_read_only_by_podname(pod.metadata.name)
+        if output == None:
+            cmd = ["pgtools", "-w", "0", "-q", "'show transaction_read_only'"]
+            output = pod_exec_command(pod.metadata.name,
+                                      pod.metadata.namespace, cmd, logger,
+                                      False)
         role = pod.metadata.labels.get(LABEL_ROLE)
 
         patch_body = None
@@ -323,32 +597,18 @@ def correct_backup_status(
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
-    if backup_util.get_backup_mode(
-            meta, spec, patch, status,
-            logger) == BACKUP_MODE_S3_MANUAL or backup_util.get_backup_mode(
-                meta, spec, patch, status, logger) == BACKUP_MODE_S3_CRON:
+    if ctx.observed.get_backup_mode() in (BACKUP_MODE_S3_MANUAL,
+                                          BACKUP_MODE_S3_CRON):
         if spec[SPEC_BACKUPCLUSTER][SPEC_BACKUPTOS3].get(
                 SPEC_BACKUPTOS3_POLICY, {}).get(SPEC_BACKUPTOS3_POLICY_ARCHIVE,
                                                 "") == "on":
-            readwrite_conns = connections(
-                spec, meta, patch, get_field(POSTGRESQL, READWRITEINSTANCE),
-                False, None, logger, None, status, False)
-            conn = get_primary_conn(readwrite_conns,
-                                    0,
-                                    logger,
-                                    interrupt=False)
-            cmd = [
-                "pgtools", "-w", "0", "-q",
-                ''' "select last_archived_wal, last_archived_time from pg_stat_archiver limit 1;" '''
-            ]
-            logger.info(f"correct_backup_status with cmd {cmd}")
-            output = exec_command(conn, cmd, logger,
-                                  interrupt=False).split("|")
-            keys = ["last_archived_wal", "last_archived_time"]
-            state = dict(zip(keys, output))
-
-            readwrite_conns.free_conns()
+            if ctx.observed.get_archiver() == None:
+                logger.warning(
+                    f"correct_backup_status skip, archiver is not observed")
+                return
+            state = dict(ctx.observed.get_archiver())
         else:
             state = ""
         if status.get(CLUSTER_STATUS_ARCHIVE, None) != state:
@@ -361,6 +621,7 @@ def correct_s3_profile(
     patch: kopf.Patch,
     status: kopf.Status,
     logger: logging.Logger,
+    ctx: TimerContext,
 ) -> None:
     # if backup_util.get_backup_mode(
     #         meta, spec, patch, status,
@@ -370,16 +631,13 @@ def correct_s3_profile(
     # archive may be changed to off after the last backup, but the next backup is not performed. Archiving is still required at this point.
     if spec.get(SPEC_S3, None) is not None:
         is_correct = False
-        readwrite_conns = connections(spec, meta, patch,
-                                      get_field(POSTGRESQL, READWRITEINSTANCE),
-                                      False, None, logger, None, status, False)
+        readwrite_conns = ctx.get_conns(
+            get_field(POSTGRESQL, READWRITEINSTANCE))
         s3_info = backup_util.get_need_s3_env(meta, spec, patch, status,
                                               logger, [SPEC_S3])
 
-        for conn in readwrite_conns.get_conns():
-            cmd = ["pgtools", "-w", "0", "-q", "'show archive_command;'"]
-            output = exec_command(conn, cmd, logger, interrupt=False)
-            if output.find("barman") != -1:
+        for archive_command in ctx.observed.get_archive_commands():
+            if archive_command.find("barman") != -1:
                 is_correct = True
                 break
 
@@ -398,5 +656,3 @@ def correct_s3_profile(
             if to_int(output) == 4:
                 cmd = ["pgtools", "-v"] + s3_info
                 exec_command(conn, cmd, logger, interrupt=False)
-
-        readwrite_conns.free_conns()
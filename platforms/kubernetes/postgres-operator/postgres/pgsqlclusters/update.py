@@ -5,8 +5,10 @@ import copy
 import traceback
 import os
 
+from kubernetes import client
+
 from pgsqlcommons.constants import *
-from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List
+from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List, Dict
 import pgsqlbackups.backup as pgsql_backup
 import pgsqlbackups.utils as backup_util
 import pgsqlbackups.restore as backup_restore
@@ -257,24 +259,44 @@ def rolling_update(
     if target_roles is None:
         return
 
+    # pull the new images on every node first, the pods don't wait for them.
+    prepull_images(meta, spec, patch, status, logger, target_roles)
+
     # rolling update autofailover, not allow autofailover delete disk when update cluster
     field = pgsql_util.get_field(AUTOFAILOVER)
     if field in target_roles:
         autofailover_machines = spec.get(AUTOFAILOVER).get(MACHINES)
-        if autofailover_machines != None:
-            pgsql_delete.delete_autofailover(meta, spec, patch, status, logger,
-                                             field, autofailover_machines,
-                                             None, False)
-        else:
-            pgsql_delete.delete_autofailover(meta, spec, patch, status, logger,
-                                             field, None, [0, 1], False)
-            for vct in spec.get(AUTOFAILOVER).get(VOLUMECLAIMTEMPLATES):
-                if vct["metadata"]["name"] == POSTGRESQL_PVC_NAME:
-                    size = get_vct_size(vct)
-            pgsql_util.resize_pvc(
-                meta, spec, patch, status, logger,
-                pgsql_util.get_pvc_name(
-                    pgsql_util.get_pod_name(meta["name"], field, 0)), size)
+        # machines are not deleted, create_autofailover restarts the
+        # machine only when its docker-compose files changed.
+        if autofailover_machines == None:
+            # a template change restarts the pod in place, only a storage
+            # change or a volume which only expands offline needs a new
+            # statefulset.
+            size = get_data_vct_size(spec.get(AUTOFAILOVER))
+            pvc_name = pgsql_util.get_pvc_name(
+                pgsql_util.get_pod_name(meta["name"], field, 0))
+            recreate = not pgsql_util.statefulset_updatable(
+                pgsql_util.get_statefulset_name(meta["name"], field, 0),
+                meta["namespace"],
+                spec.get(AUTOFAILOVER).get(VOLUMECLAIMTEMPLATES), logger)
+            if recreate == False:
+                offline_pvcs = pgsql_util.resize_pvcs(
+                    meta,
+                    spec,
+                    patch,
+                    status,
+                    logger, [pvc_name],
+                    size,
+                    timeout=PVC_RESIZE_ONLINE_TIMEOUT,
+                    label_selector=pgsql_util.dict_to_str(
+                        pgsql_util.get_autofailover_labels(meta)))
+                recreate = len(offline_pvcs) > 0
+            if recreate:
+                pgsql_delete.delete_autofailover(meta, spec, patch, status,
+                                                 logger, field, None, [0, 1],
+                                                 False)
+                pgsql_util.resize_pvc(meta, spec, patch, status, logger,
+                                      pvc_name, size)
         pgsql_create.create_autofailover(
             meta, spec, patch, status, logger,
             pgsql_util.get_autofailover_labels(meta))
@@ -282,97 +304,455 @@ def rolling_update(
         pgsql_util.waiting_cluster_final_status(meta, spec, patch, status,
                                                 logger)
 
-    # rolling update readwrite
-    field = pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE)
-    if field in target_roles:
-        readwrite_machines = spec.get(POSTGRESQL).get(READWRITEINSTANCE).get(
-            MACHINES)
-        if readwrite_machines != None:
-            for replica in range(0, len(readwrite_machines)):
-                pgsql_delete.delete_postgresql_readwrite(
-                    meta, spec, patch, status, logger, field,
-                    readwrite_machines[replica:replica + 1], None, delete_disk)
-                pgsql_create.create_postgresql_readwrite(
-                    meta, spec, patch, status, logger,
-                    pgsql_util.get_readwrite_labels(meta), replica, False,
-                    replica + 1)
-                # wait postgresql ready, then wait the right status.
-                pgsql_util.waiting_target_postgresql_ready(
-                    meta, spec, patch, field, status, logger, replica,
-                    replica + 1, exit, timeout)
-                pgsql_util.waiting_cluster_final_status(
-                    meta, spec, patch, status, logger)
+    # rolling update readwrite, then readonly
+    for field in [
+            pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE),
+            pgsql_util.get_field(POSTGRESQL, READONLYINSTANCE)
+    ]:
+        if field not in target_roles:
+            continue
+        # expand all volumes of the field at once, the replicas recreated
+        # in the waves only pick up the resized volume. the volumes which
+        # only expand offline are resized after their instance is deleted.
+        offline_pvcs = []
+        if delete_disk == False:
+            offline_pvcs = resize_field_pvcs(meta, spec, patch, status,
+                                             logger, field)
+        for wave in get_rolling_waves(meta, spec, patch, status, logger,
+                                      field):
+            logger.info(f"rolling update {field} replicas {wave}")
+            pgsql_util.fan_out(
+                wave, lambda replica: rolling_update_replica(
+                    meta, spec, patch, status, logger, field, replica,
+                    delete_disk, offline_pvcs), logger)
+            # wait postgresql ready, then wait the right status once per wave.
+            pgsql_util.waiting_target_postgresql_ready(meta, spec, patch,
+                                                       field, status, logger,
+                                                       min(wave),
+                                                       max(wave) + 1, exit,
+                                                       timeout)
+            pgsql_util.waiting_cluster_final_status(meta, spec, patch, status,
+                                                    logger)
+
+
+def prepull_images(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    target_roles: List,
+    timeout: int = PREPULL_TIMEOUT,
+) -> None:
+    """pull the changed images of target_roles on all nodes in parallel.
+
+    k8s runs a daemonset with a container per image which is not used by
+    the running pods yet, machines run docker pull over ssh for the images
+    they don't have. the progress of every role is in status image_prepull.
+    a node which can't pull is only logged, the rolling update pulls there
+    again.
+    """
+    apps_v1_api = pgsql_util.get_apps_v1_api()
+    core_v1_api = pgsql_util.get_core_v1_api()
+    namespace = meta["namespace"]
+    progress = {}
+    daemonsets = {}
+    machine_fields = []
+    for field in target_roles:
+        if len(field.split(FIELD_DELIMITER)) == 1:
+            localspec = spec.get(field)
         else:
-            for replica in range(
-                    0, spec[POSTGRESQL][READWRITEINSTANCE][REPLICAS]):
-                pgsql_delete.delete_postgresql_readwrite(
-                    meta, spec, patch, status, logger, field, None,
-                    [replica, replica + 1], delete_disk)
-                if delete_disk == False:
-                    for vct in spec.get(POSTGRESQL).get(READWRITEINSTANCE).get(
-                            VOLUMECLAIMTEMPLATES):
-                        if vct["metadata"]["name"] == POSTGRESQL_PVC_NAME:
-                            size = get_vct_size(vct)
-                    pgsql_util.resize_pvc(
-                        meta, spec, patch, status, logger,
-                        pgsql_util.get_pvc_name(
-                            pgsql_util.get_pod_name(meta["name"], field,
-                                                    replica)), size)
-                pgsql_create.create_postgresql_readwrite(
-                    meta, spec, patch, status, logger,
-                    pgsql_util.get_readwrite_labels(meta), replica, False,
-                    replica + 1)
-                # wait postgresql ready, then wait the right status.
-                pgsql_util.waiting_target_postgresql_ready(
-                    meta, spec, patch, field, status, logger, replica,
-                    replica + 1, exit, timeout)
-                pgsql_util.waiting_cluster_final_status(
-                    meta, spec, patch, status, logger)
+            localspec = spec.get(field.split(FIELD_DELIMITER)[0]).get(
+                field.split(FIELD_DELIMITER)[1])
+        if localspec.get(MACHINES) != None:
+            machine_fields.append(field)
+            continue
 
-    # rolling update readonly
-    field = pgsql_util.get_field(POSTGRESQL, READONLYINSTANCE)
-    if field in target_roles:
-        readonly_machines = spec.get(POSTGRESQL).get(READONLYINSTANCE).get(
-            MACHINES)
-        if readonly_machines != None:
-            for replica in range(0, len(readonly_machines)):
-                pgsql_delete.delete_postgresql_readonly(
-                    meta, spec, patch, status, logger, field,
-                    readonly_machines[replica:replica + 1], None, delete_disk)
-                pgsql_create.create_postgresql_readonly(
-                    meta, spec, patch, status, logger,
-                    pgsql_util.get_readonly_labels(meta), replica, replica + 1)
-                # wait postgresql ready, then wait the right status.
-                pgsql_util.waiting_target_postgresql_ready(
-                    meta, spec, patch, field, status, logger, replica,
-                    replica + 1, exit, timeout)
-                pgsql_util.waiting_cluster_final_status(
-                    meta, spec, patch, status, logger)
+        podspec = localspec[PODSPEC]
+        running_images = get_running_images(meta, field, logger)
+        name = meta["name"] + "-" + field.split(
+            FIELD_DELIMITER)[-1] + "-" + PREPULL_SUFFIX
+        labels = {PREPULL_SUFFIX: name}
+        # the image may have no shell, a container which can't run the
+        # command has pulled its image all the same.
+        containers = [{
+            "name": PREPULL_SUFFIX + "-" + container[CONTAINER_NAME],
+            "image": pgsql_util.get_realimage_from_env(container[IMAGE]),
+            "imagePullPolicy": container.get("imagePullPolicy",
+                                             "IfNotPresent"),
+            "command": ["/bin/sh", "-c", "sleep infinity"],
+            "resources": {
+                "requests": {
+                    "cpu": "1m",
+                    "memory": "8Mi"
+                }
+            }
+        } for container in podspec[CONTAINERS]]
+        containers = [
+            container for container in containers
+            if running_images == None
+            or container["image"] not in running_images
+        ]
+        if len(containers) == 0:
+            logger.info(f"{field} images are not changed, skip prepull")
+            continue
+        template_spec = {
+            "containers": containers,
+            "terminationGracePeriodSeconds": 0
+        }
+        # only the nodes which can run the instances. the pod affinity of
+        # the instances would keep the prepull pods away from them.
+        for key in ["nodeSelector", "tolerations", "imagePullSecrets"]:
+            if podspec.get(key) != None:
+                template_spec[key] = copy.deepcopy(podspec[key])
+        node_affinity = podspec.get("affinity", {}).get("nodeAffinity")
+        if node_affinity != None:
+            template_spec["affinity"] = {
+                "nodeAffinity": copy.deepcopy(node_affinity)
+            }
+        body = {
+            "apiVersion": "apps/v1",
+            "kind": "DaemonSet",
+            "metadata": {
+                "name": name,
+                "namespace": namespace
+            },
+            "spec": {
+                "selector": {
+                    "matchLabels": labels
+                },
+                "template": {
+                    "metadata": {
+                        "labels": labels
+                    },
+                    "spec": template_spec
+                }
+            }
+        }
+        kopf.adopt(body)
+        logger.info(f"prepull {field} images with daemonset {name}")
+        try:
+            try:
+                apps_v1_api.create_namespaced_daemon_set(namespace, body)
+            except client.exceptions.ApiException as e:
+                # left by an interrupted rolling update
+                if e.status != 409:
+                    raise
+                apps_v1_api.replace_namespaced_daemon_set(
+                    name, namespace, body)
+            daemonsets[field] = name
+        except Exception as e:
+            logger.warning(f"create prepull daemonset {name} failed, {e}")
+
+    try:
+        if len(machine_fields) > 0:
+            prepull_machine_images(meta, spec, patch, status, logger,
+                                   machine_fields, progress, timeout)
+
+        def check() -> bool:
+            completed = True
+            for field, name in daemonsets.items():
+                daemonset = apps_v1_api.read_namespaced_daemon_set_status(
+                    name, namespace)
+                desired = daemonset.status.desired_number_scheduled or 0
+                # the pods of an older template pulled other images
+                pods = core_v1_api.list_namespaced_pod(
+                    namespace,
+                    label_selector=pgsql_util.dict_to_str(
+                        {PREPULL_SUFFIX: name}))
+                pulled = len([
+                    pod for pod in pods.items
+                    if (pod.metadata.labels or {}).get(
+                        "pod-template-generation") == str(
+                            daemonset.metadata.generation)
+                    and prepull_pod_pulled(pod)
+                ])
+                progress[field] = f"{pulled}/{desired}"
+                if (daemonset.status.observed_generation or 0) < \
+                        daemonset.metadata.generation or desired == 0 or \
+                        pulled < desired:
+                    completed = False
+            pgsql_util.set_cluster_status(meta, CLUSTER_STATUS_IMAGE_PREPULL,
+                                          progress, logger)
+            return completed
+
+        if len(daemonsets) > 0 and not pgsql_util.wait_until(
+                check, timeout, max_delay=10):
+            logger.warning(f"prepull images not completed {progress}")
+    finally:
+        for name in daemonsets.values():
+            try:
+                apps_v1_api.delete_namespaced_daemon_set(
+                    name, namespace, propagation_policy="Background")
+            except Exception as e:
+                logger.warning(f"delete prepull daemonset {name} failed, {e}")
+
+
+def get_running_images(meta: kopf.Meta, field: str,
+                       logger: logging.Logger) -> List[str]:
+    """the images of the running pods of field, None if unknown."""
+    if field == pgsql_util.get_field(AUTOFAILOVER):
+        labels = pgsql_util.get_autofailover_labels(meta)
+    elif field == pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE):
+        labels = pgsql_util.get_readwrite_labels(meta)
+    else:
+        labels = pgsql_util.get_readonly_labels(meta)
+    try:
+        pods = pgsql_util.get_core_v1_api().list_namespaced_pod(
+            meta["namespace"], label_selector=pgsql_util.dict_to_str(labels))
+    except Exception as e:
+        logger.warning(f"list {field} pods failed, {e}")
+        return None
+    return [
+        container.image for pod in pods.items
+        for container in pod.spec.containers
+    ]
+
+
+def prepull_pod_pulled(pod: client.V1Pod) -> bool:
+    """every container of the prepull pod has its image."""
+    statuses = (pod.status.container_statuses
+                or []) if pod.status != None else []
+    if len(statuses) == 0:
+        return False
+    for container_status in statuses:
+        state = container_status.state
+        if state != None and state.waiting != None and \
+                state.waiting.reason in PREPULL_PULLING_REASONS:
+            return False
+    return True
+
+
+def prepull_machine_images(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    fields: List,
+    progress: Dict,
+    timeout: int,
+) -> None:
+    for field in fields:
+        if len(field.split(FIELD_DELIMITER)) == 1:
+            localspec = spec.get(field)
         else:
-            for replica in range(0,
-                                 spec[POSTGRESQL][READONLYINSTANCE][REPLICAS]):
-                pgsql_delete.delete_postgresql_readonly(
-                    meta, spec, patch, status, logger, field, None,
-                    [replica, replica + 1], delete_disk)
-                if delete_disk == False:
-                    for vct in spec.get(POSTGRESQL).get(READONLYINSTANCE).get(
-                            VOLUMECLAIMTEMPLATES):
-                        if vct["metadata"]["name"] == POSTGRESQL_PVC_NAME:
-                            size = get_vct_size(vct)
-                    pgsql_util.resize_pvc(
-                        meta, spec, patch, status, logger,
-                        pgsql_util.get_pvc_name(
-                            pgsql_util.get_pod_name(meta["name"], field,
-                                                    replica)), size)
-                pgsql_create.create_postgresql_readonly(
-                    meta, spec, patch, status, logger,
-                    pgsql_util.get_readonly_labels(meta), replica, replica + 1)
-                # wait postgresql ready, then wait the right status.
-                pgsql_util.waiting_target_postgresql_ready(
-                    meta, spec, patch, field, status, logger, replica,
-                    replica + 1, exit, timeout)
-                pgsql_util.waiting_cluster_final_status(
-                    meta, spec, patch, status, logger)
+            localspec = spec.get(field.split(FIELD_DELIMITER)[0]).get(
+                field.split(FIELD_DELIMITER)[1])
+        images = [
+            container[IMAGE] for container in localspec[PODSPEC][CONTAINERS]
+        ]
+        with pgsql_util.connections(spec, meta, patch, field, False, None,
+                                    logger, None, status, False) as conns:
+            progress[field] = f"0/{conns.get_number()}"
+            pgsql_util.set_cluster_status(meta, CLUSTER_STATUS_IMAGE_PREPULL,
+                                          progress, logger)
+
+            def pull(conn: InstanceConnection) -> None:
+                for image in images:
+                    logger.info(
+                        f"prepull image {image} on {conn.get_machine().get_host()}"
+                    )
+                    pgsql_util.machine_exec_command(
+                        conn.get_machine().get_ssh(),
+                        f"docker image inspect {image} >/dev/null 2>&1 || docker pull {image}"
+                    )
+
+            results = pgsql_util.fan_out(conns.get_conns(),
+                                         pull,
+                                         logger,
+                                         fail_fast=False,
+                                         timeout=timeout)
+            for result in results:
+                if not result.ok():
+                    logger.warning(
+                        f"prepull images on {pgsql_util.get_connhost(result.get_conn())} failed, {result.get_error()}"
+                    )
+            progress[field] = f"{len([r for r in results if r.ok()])}/{len(results)}"
+            pgsql_util.set_cluster_status(meta, CLUSTER_STATUS_IMAGE_PREPULL,
+                                          progress, logger)
+
+
+def rolling_update_replica(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    field: str,
+    replica: int,
+    delete_disk: bool,
+    offline_pvcs: List[str] = [],
+) -> None:
+    localspec = spec.get(POSTGRESQL).get(field.split(FIELD_DELIMITER)[1])
+    machines = localspec.get(MACHINES)
+    if field == pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE):
+        delete_postgresql = pgsql_delete.delete_postgresql_readwrite
+    else:
+        delete_postgresql = pgsql_delete.delete_postgresql_readonly
+
+    if machines != None:
+        # keep the disk: create_postgresql restarts the machine only when
+        # its docker-compose files changed.
+        if delete_disk == True:
+            delete_postgresql(meta, spec, patch, status, logger, field,
+                              machines[replica:replica + 1], None,
+                              delete_disk)
+    else:
+        pvc_name = pgsql_util.get_pvc_name(
+            pgsql_util.get_pod_name(meta["name"], field, replica))
+        offline = delete_disk == False and pvc_name in offline_pvcs
+        if delete_disk == True or offline or not pgsql_util.statefulset_updatable(
+                pgsql_util.get_statefulset_name(meta["name"], field, replica),
+                meta["namespace"], localspec.get(VOLUMECLAIMTEMPLATES),
+                logger):
+            delete_postgresql(meta, spec, patch, status, logger, field, None,
+                              [replica, replica + 1], delete_disk)
+        if offline:
+            # the volume is detached now
+            pgsql_util.resize_pvc(meta, spec, patch, status, logger, pvc_name,
+                                  get_data_vct_size(localspec))
+
+    if field == pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE):
+        pgsql_create.create_postgresql_readwrite(
+            meta, spec, patch, status, logger,
+            pgsql_util.get_readwrite_labels(meta), replica, False,
+            replica + 1)
+    else:
+        pgsql_create.create_postgresql_readonly(
+            meta, spec, patch, status, logger,
+            pgsql_util.get_readonly_labels(meta), replica, replica + 1)
+
+
+def get_data_vct_size(localspec: TypedDict) -> str:
+    for vct in localspec.get(VOLUMECLAIMTEMPLATES):
+        if vct["metadata"]["name"] == POSTGRESQL_PVC_NAME:
+            return get_vct_size(vct)
+    return None
+
+
+def resize_field_pvcs(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    field: str,
+) -> List[str]:
+    """resize the mounted pvcs of field, return the ones still not resized."""
+    localspec = spec.get(POSTGRESQL).get(field.split(FIELD_DELIMITER)[1])
+    if localspec.get(MACHINES) != None:
+        return []
+
+    if field == pgsql_util.get_field(POSTGRESQL, READWRITEINSTANCE):
+        labels = pgsql_util.get_readwrite_labels(meta)
+    else:
+        labels = pgsql_util.get_readonly_labels(meta)
+    pvc_names = [
+        pgsql_util.get_pvc_name(
+            pgsql_util.get_pod_name(meta["name"], field, replica))
+        for replica in range(0, localspec[REPLICAS])
+    ]
+    return pgsql_util.resize_pvcs(
+        meta,
+        spec,
+        patch,
+        status,
+        logger,
+        pvc_names,
+        get_data_vct_size(localspec),
+        timeout=PVC_RESIZE_ONLINE_TIMEOUT,
+        label_selector=pgsql_util.dict_to_str(labels))
+
+
+def get_rolling_waves(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    field: str,
+) -> List[List[int]]:
+    """split the replicas of field into waves of maxUnavailable replicas.
+
+    async standbys hold no quorum and roll maxUnavailable at a time. the
+    standbys with replication-quorum roll at most as many at a time as the
+    formation can lose while number_sync_standbys is still met, the
+    primary is always the last wave alone.
+    """
+    localspec = spec.get(POSTGRESQL).get(field.split(FIELD_DELIMITER)[1])
+    machines = localspec.get(MACHINES)
+    if machines != None:
+        replicas = len(machines)
+    else:
+        replicas = localspec[REPLICAS]
+    max_unavailable = localspec.get(MAX_UNAVAILABLE,
+                                    MAX_UNAVAILABLE_DEFAULT_VALUE)
+    if max_unavailable <= 1:
+        return [[replica] for replica in range(0, replicas)]
+
+    nodes = pgsql_util.get_autofailover_quorum(meta, spec, patch, status,
+                                               logger)
+    if nodes == None:
+        logger.warning(
+            f"can't read the replication quorum, rolling {field} one by one")
+        return [[replica] for replica in range(0, replicas)]
+    nodes = {node[AUTOCTL_NODE_HOST]: node for node in nodes}
+
+    with pgsql_util.connections(spec, meta, patch, field, False, None,
+                                logger, None, status, False) as conns:
+        hosts = [pgsql_util.get_connhost(conn) for conn in conns.get_conns()]
+
+    return split_rolling_waves(hosts, nodes, max_unavailable)
+
+
+def split_rolling_waves(hosts: List[str], nodes: Dict[str, Dict],
+                        max_unavailable: int) -> List[List[int]]:
+    """waves of the replicas at hosts, nodes are the monitor nodes by host.
+
+    serial waves when a host has no monitor node, the primary and the
+    quorum can't be told apart then.
+    """
+    if any(nodes.get(host) == None for host in hosts):
+        return [[replica] for replica in range(len(hosts))]
+
+    primary_states = [
+        AUTOCTL_STATE_PRIMARY, AUTOCTL_STATE_WAIT_PRIMARY, AUTOCTL_STATE_SINGLE
+    ]
+    primary = []
+    quorum = []
+    others = []
+    for replica, host in enumerate(hosts):
+        node = nodes[host]
+        if node[AUTOCTL_NODE_REPORTEDSTATE] in primary_states:
+            primary.append([replica])
+        elif node[AUTOCTL_NODE_REPLICATIONQUORUM] == True:
+            quorum.append(replica)
+        else:
+            others.append(replica)
+
+    quorum_standbys = [
+        node for node in nodes.values()
+        if node[AUTOCTL_NODE_REPLICATIONQUORUM] == True
+        and node[AUTOCTL_NODE_REPORTEDSTATE] not in primary_states
+    ]
+    # every node carries the same number_sync_standbys of the formation
+    number_sync_standbys = 0
+    if len(nodes) > 0:
+        number_sync_standbys = list(
+            nodes.values())[0][AUTOCTL_FORMATION_NUMBER_SYNC_STANDBYS]
+    quorum_budget = max(
+        1,
+        min(max_unavailable,
+            len(quorum_standbys) - number_sync_standbys))
+
+    return [
+        others[i:i + max_unavailable]
+        for i in range(0, len(others), max_unavailable)
+    ] + [
+        quorum[i:i + quorum_budget]
+        for i in range(0, len(quorum), quorum_budget)
+    ] + primary
 
 
 def update_podspec_volume(
@@ -725,6 +1105,114 @@ def update_configs_port(
                                                 logger)
 
 
+def get_pg_settings_context(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    conns: [InstanceConnection],
+) -> Dict[str, str]:
+    """the pg_settings context of every parameter, from the first node which
+    answers. return None if no node can be queried.
+    """
+    for conn in conns:
+        rows = pgsql_util.query_rows(conn,
+                                     PG_SETTINGS_CONTEXT_QUERY,
+                                     logger,
+                                     endpoint=pgsql_util.sql_endpoint(
+                                         meta, spec, patch, status, logger,
+                                         conn))
+        if rows != None:
+            return {row["name"]: row["context"] for row in rows}
+    return None
+
+
+def get_pending_restart(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    conn: InstanceConnection,
+) -> Tuple[str, List[str]]:
+    rows = pgsql_util.query_rows(conn,
+                                 PG_SETTINGS_PENDING_RESTART_QUERY,
+                                 logger,
+                                 endpoint=pgsql_util.sql_endpoint(
+                                     meta, spec, patch, status, logger, conn))
+    if rows == None or len(rows) == 0:
+        return None, None
+    return rows[0]["load_time"], [
+        name for name in rows[0]["pending_restart"].split(",") if name != ""
+    ]
+
+
+def reload_configs(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    conns: [InstanceConnection],
+    cmd: TypedDict,
+    fallback_restart: List[str] = None,
+) -> List[InstanceConnection]:
+    """write the configs and reload postgresql on every node in parallel.
+
+    return the nodes which still need a restart: postgresql reports
+    pending_restart after the reload, or the reload failed. a node whose
+    pg_settings can't be queried needs a restart if fallback_restart, the
+    changed parameters of the static PG_CONFIG_RESTART list, is not empty.
+    """
+    if fallback_restart == None:
+        fallback_restart = []
+
+    def reload(conn: InstanceConnection) -> List[str]:
+        load_time, pending = get_pending_restart(meta, spec, patch, status,
+                                                 logger, conn)
+        unknown = load_time == None
+        logger.info(f"update configs {cmd} on %s" %
+                    pgsql_util.get_connhost(conn))
+        output = pgsql_util.exec_command(conn, cmd, logger, interrupt=False)
+        if output.find(SUCCESS) == -1:
+            raise Exception(f"update configs {cmd} failed. {output}")
+
+        # pending_restart is valid once the backend has read the new file.
+        def check() -> bool:
+            nonlocal pending, unknown
+            current, pending = get_pending_restart(meta, spec, patch, status,
+                                                   logger, conn)
+            if current == None:
+                unknown = True
+                return True
+            return current != load_time
+
+        if not unknown and not pgsql_util.wait_until(
+                check, MINUTES, max_delay=5):
+            raise Exception("configs are not reloaded")
+        if unknown:
+            logger.warning(
+                f"can't query pg_settings on {pgsql_util.get_connhost(conn)}, use the static restart parameters {fallback_restart}"
+            )
+            return fallback_restart
+        return pending
+
+    restart_conns = []
+    for result in pgsql_util.fan_out(conns, reload, logger, fail_fast=False):
+        host = pgsql_util.get_connhost(result.get_conn())
+        if not result.ok():
+            logger.error(
+                f"reload configs on {host} failed, restart it. {result.get_error()}"
+            )
+            restart_conns.append(result.get_conn())
+        elif len(result.get_value()) > 0:
+            logger.info(
+                f"{host} needs restart for parameters {result.get_value()}")
+            restart_conns.append(result.get_conn())
+    return restart_conns
+
+
 def update_configs(
     meta: kopf.Meta,
     spec: kopf.Spec,
@@ -738,18 +1226,18 @@ def update_configs(
 ) -> None:
     conns = []
     cmd = ["pgtools", "-c"]
-    restart_postgresql = False
     port_change = False
     old_port = None
     new_port = None
     autofailover = False
-    special_change = False
 
     if FIELD == DIFF_FIELD_AUTOFAILOVER_CONFIGS:
         autofailover_conns = pgsql_util.connections(
             spec, meta, patch, pgsql_util.get_field(AUTOFAILOVER), False, None,
             logger, None, status, False)
         conns += autofailover_conns.get_conns()
+        readwrite_conns = autofailover_conns
+        readonly_conns = autofailover_conns
         autofailover = True
     elif FIELD == DIFF_FIELD_POSTGRESQL_CONFIGS:
         readwrite_conns = pgsql_util.connections(
@@ -765,87 +1253,75 @@ def update_configs(
         conns += readonly_conns.get_conns()
 
     if len(conns) != 0:
+        contexts = get_pg_settings_context(meta, spec, patch, status, logger,
+                                           conns)
+        if contexts == None:
+            logger.warning(
+                "can't query pg_settings, use the static parameter lists.")
+        old_configs = {}
+        for oldconfig in OLD or []:
+            oldname = oldconfig.split("=")[0].strip()
+            old_configs[oldname] = oldconfig[oldconfig.find("=") + 1:].strip()
+
+        restart_configs = []
+        fallback_restart = []
         for i, config in enumerate(NEW):
             name = config.split("=")[0].strip()
             value = config[config.find("=") + 1:].strip()
             if autofailover == True and name == 'port':
                 continue
-            if name in PG_CONFIG_IGNORE:
+            if contexts != None and name in contexts:
+                context = contexts[name]
+            elif name in PG_CONFIG_IGNORE:
+                context = PG_SETTINGS_CONTEXT_INTERNAL
+            elif name in PG_CONFIG_RESTART:
+                context = PG_SETTINGS_CONTEXT_POSTMASTER
+            else:
+                context = None
+            if context == PG_SETTINGS_CONTEXT_INTERNAL:
                 continue
-            if name in PG_CONFIG_RESTART:
-                for oldi, oldconfig in enumerate(OLD):
-                    oldname = oldconfig.split("=")[0].strip()
-                    oldvalue = oldconfig[oldconfig.find("=") + 1:].strip()
-                    if name == oldname and value != oldvalue:
-                        logger.info(f"{name} is restart parameter ")
-                        restart_postgresql = True
-                        if name == 'port':
-                            port_change = True
-                            new_port = value
-                            old_port = oldvalue
-                            logger.info(
-                                f"change port from {old_port} to {new_port}")
-            if name in PG_CONFIG_MASTER_LARGE_THAN_SLAVE:
-                for oldi, oldconfig in enumerate(OLD):
-                    oldname = oldconfig.split("=")[0].strip()
-                    oldvalue = oldconfig[oldconfig.find("=") + 1:].strip()
-                    if name == oldname and int(value) != int(oldvalue):
-                        logger.info(f"{name} must large then slave")
-                        special_change = True
+            if name in old_configs and value != old_configs[name]:
+                if context == PG_SETTINGS_CONTEXT_POSTMASTER:
+                    restart_configs.append(name)
+                if name == 'port':
+                    port_change = True
+                    new_port = value
+                    old_port = old_configs[name]
+                    logger.info(f"change port from {old_port} to {new_port}")
+                    # the port is changed node by node by update_configs_port
+                    continue
+                if name in PG_CONFIG_RESTART:
+                    fallback_restart.append(name)
 
             config = name + '="' + value + '"'
             cmd.append('-e')
             cmd.append(PG_CONFIG_PREFIX + config)
+        logger.info(
+            f"update configs reload {len(conns)} nodes, restart parameters {restart_configs}, port change {port_change}"
+        )
 
         if autofailover == False:
             pgsql_util.waiting_postgresql_ready(readwrite_conns, logger)
             pgsql_util.waiting_postgresql_ready(readonly_conns, logger)
             pgsql_util.waiting_cluster_final_status(meta, spec, patch, status,
                                                     logger)
-        #fisrst: port_change
-        #second: restart_postgresql
-        #third: special_change
-        #bitmap: 000 001 010 011 100 101 110 111
-        # if port_change is 1, restart_postgresql must be 1 can't be 0.
-        # if special_change is 1, restart_postgresql must be 1 can't be 0.
-        if port_change == False and restart_postgresql == False and special_change == False:
-            update_configs_utile(meta, spec, patch, status, logger, conns,
-                                 readwrite_conns, readonly_conns,
-                                 copy.deepcopy(cmd), autofailover, False)
-        if port_change == False and restart_postgresql == False and special_change == True:
-            pass
-        if port_change == False and restart_postgresql == True and special_change == False:
-            update_configs_utile(meta, spec, patch, status, logger, conns,
-                                 readwrite_conns, readonly_conns,
-                                 copy.deepcopy(cmd), autofailover, True)
-        if port_change == False and restart_postgresql == True and special_change == True:
-            update_configs_utile(meta, spec, patch, status, logger, conns,
-                                 readwrite_conns, readonly_conns,
-                                 copy.deepcopy(cmd), autofailover, True)
-        if port_change == True and restart_postgresql == False and special_change == False:
-            pass
-        if port_change == True and restart_postgresql == False and special_change == True:
-            pass
-        if port_change == True and restart_postgresql == True and special_change == False:
-            update_configs_port(meta, spec, patch, status, logger, conns,
-                                readwrite_conns, readonly_conns,
-                                copy.deepcopy(cmd), autofailover)
-        if port_change == True and restart_postgresql == True and special_change == True:
-            # don't update port
-            config = "port" + '="' + old_port + '"'
-            tmpcmd = copy.deepcopy(cmd)
-            tmpcmd.append('-e')
-            tmpcmd.append(PG_CONFIG_PREFIX + config)
-            update_configs_utile(meta, spec, patch, status, logger, conns,
-                                 readwrite_conns, readonly_conns,
-                                 copy.deepcopy(cmd), autofailover, True)
-            # update port
-            tmpcmd = copy.deepcopy(cmd)
-            update_configs_port(meta, spec, patch, status, logger, conns,
-                                readwrite_conns, readonly_conns,
-                                copy.deepcopy(tmpcmd), autofailover)
-
+        reload_cmd = copy.deepcopy(cmd)
+        if port_change == True:
+            reload_cmd += ['-e', PG_CONFIG_PREFIX + 'port="' + old_port + '"']
+        # only the nodes where postgresql reports pending_restart restart.
+        restart_conns = reload_configs(meta, spec, patch, status, logger,
+                                       conns, reload_cmd, fallback_restart)
+        if len(restart_conns) > 0:
+            update_configs_utile(meta, spec, patch, status, logger,
+                                 restart_conns, readwrite_conns,
+                                 readonly_conns, copy.deepcopy(reload_cmd),
+                                 autofailover, True)
         if port_change == True:
+            port_cmd = copy.deepcopy(cmd)
+            port_cmd += ['-e', PG_CONFIG_PREFIX + 'port="' + new_port + '"']
+            update_configs_port(meta, spec, patch, status, logger, conns,
+                                readwrite_conns, readonly_conns, port_cmd,
+                                autofailover)
             pgsql_delete.delete_services(meta, spec, patch, status, logger)
             pgsql_create.create_services(meta, spec, patch, status, logger)
             # rolling update exporter env DATA_SOURCE_NAME.port
@@ -1320,10 +1796,14 @@ def rebuild_autofailover(
     cmd_restart = ["pgtools", "-R"]
     cmds = [cmd_pause, cmd_restart]
 
-    pgsql_util.waiting_instance_ready(standby_conns, logger, 1 * MINUTES)
+    pgsql_util.waiting_instance_ready(standby_conns,
+                                      logger,
+                                      timeout=1 * MINUTES)
     pgsql_util.multi_exec_command(standby_conns, cmds, logger, interrupt=False)
 
-    pgsql_util.waiting_instance_ready(primary_conns, logger, 1 * MINUTES)
+    pgsql_util.waiting_instance_ready(primary_conns,
+                                      logger,
+                                      timeout=1 * MINUTES)
     pgsql_util.multi_exec_command(primary_conns, cmds, logger, interrupt=False)
 
     # step2. update autofailover
@@ -1360,11 +1840,15 @@ def rebuild_autofailover(
     cmd_resume = ["pgtools", "-p", "resume"]
     cmds = [cmd_delete, cmd_resume]
 
-    pgsql_util.waiting_instance_ready(primary_conns, logger, 1 * MINUTES)
+    pgsql_util.waiting_instance_ready(primary_conns,
+                                      logger,
+                                      timeout=1 * MINUTES)
     pgsql_util.multi_exec_command(primary_conns, cmds, logger, interrupt=False)
     pgsql_util.waiting_postgresql_ready(primary_conns, logger, 1 * MINUTES)
 
-    pgsql_util.waiting_instance_ready(standby_conns, logger, 1 * MINUTES)
+    pgsql_util.waiting_instance_ready(standby_conns,
+                                      logger,
+                                      timeout=1 * MINUTES)
     pgsql_util.multi_exec_command(standby_conns, cmds, logger, interrupt=False)
     pgsql_util.waiting_postgresql_ready(standby_conns, logger, 1 * MINUTES)
 
@@ -6,16 +6,30 @@ import copy
 import string
 import time
 import random
-import tempfile
+import io
 import base64
 import hashlib
 import re
-
+import json
+import threading
+import weakref
+import concurrent.futures
+import contextlib
+import socket
+import urllib3
+import shlex
+import codecs
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
 from kubernetes import client
 from kubernetes.stream import stream
+from kubernetes import watch
 
 from pgsqlcommons.constants import *
-from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List
+from pgsqlcommons.typed import LabelType, InstanceConnection, InstanceConnections, TypedDict, InstanceConnectionMachine, InstanceConnectionK8S, Tuple, Any, List, Dict, Callable, Iterator
 from pgsqlcommons.config import operator_config
 import pgsqlclusters.create as pgsql_create
 import pgsqlclusters.update as pgsql_update
@@ -23,47 +37,69 @@ import pgsqlclusters.update as pgsql_update
 EXEC_COMMAND_DEFAULT_TIMEOUT = operator_config.BOOTSTRAP_TIMEOUT
 
 
-def set_cluster_status(meta: kopf.Meta,
-                       statefield: Any,
-                       state: Any,
-                       logger: logging.Logger,
-                       timeout: int = MINUTES,
-                       plural: str = RESOURCE_POSTGRESQL) -> None:
-    customer_obj_api = client.CustomObjectsApi()
-    name = meta['name']
-    namespace = meta['namespace']
+class StatusBatch:
+    """.status fields waiting to be written, grouped per object."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fields: Dict[Tuple, Dict] = {}
+
+    def add(self, key: Tuple, fields: Dict) -> None:
+        with self.lock:
+            self.fields.setdefault(key, {}).update(fields)
+
+    def take(self) -> Dict[Tuple, Dict]:
+        with self.lock:
+            fields = self.fields
+            self.fields = {}
+            return fields
+
+
+status_batches = threading.local()
+
+
+@contextlib.contextmanager
+def status_batch(logger: logging.Logger,
+                 timeout: int = MINUTES,
+                 batch: StatusBatch = None):
+    """buffer the set_cluster_status calls of this thread.
 
-    # If only try to update once, you may get the object has been modified; please apply your changes to the latest version and try again error
-    # see https://stackoverflow.com/questions/51297136/kubectl-error-the-object-has-been-modified-please-apply-your-changes-to-the-la get more infomations
+    every object touched in the block gets one merge patch when the
+    outermost block exits. pass batch to share the batch of another thread
+    (the caller's batch is written by the caller).
+    """
+    parent = getattr(status_batches, "batch", None)
+    own = batch == None and parent == None
+    if batch == None:
+        batch = parent if parent != None else StatusBatch()
+    status_batches.batch = batch
+    try:
+        yield batch
+    finally:
+        status_batches.batch = parent
+        if own:
+            for (plural, namespace, name), fields in batch.take().items():
+                patch_cluster_status(namespace, name, fields, logger, timeout,
+                                     plural)
+
+
+def patch_cluster_status(namespace: str,
+                         name: str,
+                         fields: Dict,
+                         logger: logging.Logger,
+                         timeout: int = MINUTES,
+                         plural: str = RESOURCE_POSTGRESQL) -> bool:
+    # merge patch only carries the changed fields, so concurrent writers
+    # don't overwrite each other, and without a resourceVersion in the body
+    # it never conflicts. no GET is needed before the patch.
+    body = {CLUSTER_STATUS: fields}
     i = 0
-    maxtry = timeout
-    while True:
+
+    def patch() -> bool:
+        nonlocal i
         i += 1
-        time.sleep(SECONDS)
-        if i >= maxtry:
-            logger.error(f"set_cluster_status failed, skip.")
-            break
         try:
-            # get customer definition
-            body = customer_obj_api.get_namespaced_custom_object(
-                group=API_GROUP,
-                version=API_VERSION_V1,
-                namespace=namespace,
-                plural=plural,
-                name=name)
-            state_dict = dict()
-            if isinstance(statefield, list) and isinstance(state, list):
-                if len(statefield) != len(state):
-                    logger.error(f"Unknown Error.")
-                    return
-                for i in range(len(statefield)):
-                    state_dict[statefield[i]] = state[i]
-            else:
-                state_dict[statefield] = state
-
-            body.setdefault(CLUSTER_STATUS, {}).update(state_dict)
-
-            customer_obj_api.patch_namespaced_custom_object(
+            get_custom_objects_api().patch_namespaced_custom_object(
                 group=API_GROUP,
                 version=API_VERSION_V1,
                 namespace=namespace,
@@ -71,12 +107,55 @@ def set_cluster_status(meta: kopf.Meta,
                 name=name,
                 body=body)
             logger.info(
-                f"update {'%s.%s/%s' % (plural, API_GROUP, API_VERSION_V1)} crd {name} field .status.{statefield} = {state}, set_cluster_status body = {body}"
+                f"update {'%s.%s/%s' % (plural, API_GROUP, API_VERSION_V1)} crd {name} status {fields}"
             )
-            break
+            return True
+        except client.exceptions.ApiException as err:
+            if err.status == 404:
+                raise
+            logger.warning(
+                f"set_cluster_status failed, try {i} times. error: {err}")
+            return False
         except Exception as err:
             logger.warning(
                 f"set_cluster_status failed, try {i} times. error: {err}")
+            return False
+
+    try:
+        if wait_until(patch, timeout, initial_delay=0.1, max_delay=5):
+            return True
+    except client.exceptions.ApiException as err:
+        logger.warning(f"{plural} {namespace}/{name} not found, {err}")
+        return False
+    logger.error(f"set_cluster_status failed, skip.")
+    return False
+
+
+def set_cluster_status(meta: kopf.Meta,
+                       statefield: Any,
+                       state: Any,
+                       logger: logging.Logger,
+                       timeout: int = MINUTES,
+                       plural: str = RESOURCE_POSTGRESQL) -> None:
+    name = meta['name']
+    namespace = meta['namespace']
+
+    state_dict = dict()
+    if isinstance(statefield, list) and isinstance(state, list):
+        if len(statefield) != len(state):
+            logger.error(f"Unknown Error.")
+            return
+        for i in range(len(statefield)):
+            state_dict[statefield[i]] = state[i]
+    else:
+        state_dict[statefield] = state
+
+    batch = getattr(status_batches, "batch", None)
+    if batch != None:
+        batch.add((plural, namespace, name), state_dict)
+        return
+
+    patch_cluster_status(namespace, name, state_dict, logger, timeout, plural)
 
 
 def set_password(patch: kopf.Patch, status: kopf.Status) -> None:
@@ -163,33 +242,21 @@ def create_ssl_key(
     set_status_ssl_server_crt(meta, spec, patch, status, logger, conn)
 
     if conns != None and len(conns) > 1:
-        cmd = ["base64", PG_DATABASE_DIR + "/server.crt"]
-        server_crt_base64 = exec_command(conn, cmd, logger,
-                                         interrupt=False).replace('\n', '')
-        cmd = ["base64", PG_DATABASE_DIR + "/server.key"]
-        server_key_base64 = exec_command(conn, cmd, logger,
-                                         interrupt=False).replace('\n', '')
-        for i in range(1, len(conns)):
-            cmd = [
-                "echo", server_crt_base64, "|", "base64", "-d", ">",
-                PG_DATABASE_DIR + "/server.crt", "&&", "chown",
-                "postgres:postgres", PG_DATABASE_DIR + "/server.crt"
-            ]
-            output = exec_command(conns[i],
-                                  cmd,
-                                  logger,
-                                  interrupt=False,
-                                  user="postgres")
-            cmd = [
-                "echo", server_key_base64, "|", "base64", "-d", ">",
-                PG_DATABASE_DIR + "/server.key", "&&", "chown",
-                "postgres:postgres", PG_DATABASE_DIR + "/server.key"
-            ]
-            output = exec_command(conns[i],
-                                  cmd,
-                                  logger,
-                                  interrupt=False,
-                                  user="postgres")
+        steps = [["cat", PG_DATABASE_DIR + "/server.crt"],
+                 ["cat", PG_DATABASE_DIR + "/server.key"]]
+        crt, key = exec_script(conn, steps, logger, interrupt=False)
+        if crt.ok() and key.ok():
+            put_files(conns[1:],
+                      PG_DATABASE_DIR + "/server.crt",
+                      crt.get_stdout(),
+                      logger,
+                      mode="0644",
+                      interrupt=False)
+            put_files(conns[1:],
+                      PG_DATABASE_DIR + "/server.key",
+                      key.get_stdout(),
+                      logger,
+                      interrupt=False)
 
     if readwrite_conns != None:
         readwrite_conns.free_conns()
@@ -246,17 +313,240 @@ def get_primary_host(
     auto_failover_conns = connections(spec, meta, patch,
                                       get_field(AUTOFAILOVER), False, None,
                                       logger, None, status, False)
+    output = ""
     for conn in auto_failover_conns.get_conns():
-        cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            '''" select nodehost from pgautofailover.node where reportedstate = 'primary' or reportedstate = 'wait_primary' or reportedstate = 'single'  "'''
-        ]
-        output = exec_command(conn, cmd, logger, interrupt=False)
+        rows = query_rows(
+            conn,
+            "select nodehost from pgautofailover.node where reportedstate = 'primary' or reportedstate = 'wait_primary' or reportedstate = 'single'",
+            logger,
+            endpoint=sql_endpoint(meta, spec, patch, status, logger, conn),
+            dbname=AUTOCTL_DATABASE)
+        if rows != None:
+            output = "".join([row["nodehost"] for row in rows])
         break
     auto_failover_conns.free_conns()
     return output.strip()
 
 
+def get_autofailover_quorum(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+) -> List[Dict]:
+    """nodehost, reportedstate and replicationquorum of every node of the
+    primary formation, with the number_sync_standbys of the formation. None
+    if the monitor can't be queried.
+    """
+    with connections(spec, meta, patch, get_field(AUTOFAILOVER), False, None,
+                     logger, None, status, False) as auto_failover_conns:
+        conn = auto_failover_conns.get_conns()[0]
+        return query_rows(conn,
+                          AUTOCTL_QUORUM_QUERY,
+                          logger,
+                          endpoint=sql_endpoint(meta, spec, patch, status,
+                                                logger, conn),
+                          dbname=AUTOCTL_DATABASE)
+
+
+def wait_until(check: Callable[[], bool],
+               timeout: float,
+               signal: Callable[[float], bool] = None,
+               initial_delay: float = 0.5,
+               max_delay: float = MINUTES / 2) -> bool:
+    """call check until it returns True or the deadline is reached.
+
+    the delay between two checks grows exponentially from initial_delay to
+    max_delay with jitter. signal(seconds) can block until something changed
+    (a pod watch event, a blocking exec ...), when it returns True the
+    delay is reset and check runs again at once.
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        wait = min(delay * random.uniform(0.5, 1.0), remaining)
+        delay = min(delay * 2, max_delay)
+        begin = time.time()
+        if signal != None:
+            try:
+                if signal(wait):
+                    delay = initial_delay
+                    continue
+            except Exception:
+                pass
+        elapsed = time.time() - begin
+        if elapsed < wait:
+            time.sleep(wait - elapsed)
+
+
+def pod_event_signal(conn: InstanceConnection,
+                     logger: logging.Logger) -> Callable[[float], bool]:
+    """return a signal which blocks until the pod of conn is changed."""
+    if conn.get_k8s() == None:
+        return None
+
+    name = conn.get_k8s().get_podname()
+    namespace = conn.get_k8s().get_namespace()
+    field_selector = f"metadata.name={name}"
+
+    def signal(timeout: float) -> bool:
+        if timeout < 1:
+            return False
+        core_v1_api = get_core_v1_api()
+        pods = core_v1_api.list_namespaced_pod(namespace,
+                                               field_selector=field_selector)
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                    core_v1_api.list_namespaced_pod,
+                    namespace,
+                    field_selector=field_selector,
+                    resource_version=pods.metadata.resource_version,
+                    timeout_seconds=int(timeout)):
+                logger.debug(f"pod {name} {event['type']} event")
+                return True
+        finally:
+            w.stop()
+        return False
+
+    return signal
+
+
+def exec_until_signal(conn: InstanceConnection, cmd: str,
+                      logger: logging.Logger) -> Callable[[float], bool]:
+    """return a signal which blocks in the instance until cmd succeeds."""
+
+    def signal(timeout: float) -> bool:
+        if timeout < 1:
+            return False
+        until_cmd = [
+            "timeout",
+            str(int(timeout)), "bash", "-c",
+            f"'until {cmd} >/dev/null 2>&1; do sleep 0.2; done'", "&&",
+            "echo", SUCCESS
+        ]
+        output = exec_command(conn,
+                              until_cmd,
+                              logger,
+                              interrupt=False,
+                              timeout=int(timeout) + MINUTES)
+        return output.find(SUCCESS) != -1
+
+    return signal
+
+
+def find_process(conn: InstanceConnection, pattern: str,
+                 logger: logging.Logger) -> str:
+    """pid of the oldest process whose name matches pattern in the instance.
+
+    return "" when no process matches, None when pgrep can't be run.
+    """
+    result = exec_command_result(conn, ["pgrep", "-o", shlex.quote(pattern)],
+                                 logger)
+    if result.get_returncode() == 1:
+        return ""
+    pid = result.get_stdout().strip()
+    if result.get_returncode() != 0 or not pid.isdigit():
+        return None
+    return pid
+
+
+def exec_wait_signal(conn: InstanceConnection, pattern: str,
+                     logger: logging.Logger) -> Callable[[float], bool]:
+    """return a signal which blocks while the process matching pattern is
+    running in the instance. without such a process it returns False at
+    once, so wait_until backs off instead of checking again.
+    """
+
+    def signal(timeout: float) -> bool:
+        if timeout < 1:
+            return False
+        pid = find_process(conn, pattern, logger)
+        if pid == None or pid == "":
+            return False
+        exec_command(conn, [
+            "timeout",
+            str(int(timeout)), "tail", "--pid=" + pid, "-f", "/dev/null"
+        ],
+                     logger,
+                     interrupt=False,
+                     timeout=int(timeout) + MINUTES)
+        return True
+
+    return signal
+
+
+def get_autofailover_nodes(conn: InstanceConnection,
+                           logger: logging.Logger,
+                           endpoint: "SqlEndpoint" = None) -> List[Dict]:
+    """all nodes of the monitor in one round trip.
+
+    every node is a dict of nodename, nodehost, nodeport, reportedstate,
+    goalstate, health, reportedtli and reportedlsn. return None if the monitor can't be queried.
+    """
+    return query_rows(conn,
+                      AUTOCTL_NODES_QUERY,
+                      logger,
+                      endpoint=endpoint,
+                      dbname=AUTOCTL_DATABASE)
+
+
+def autofailover_nodes_str(nodes: List[Dict]) -> str:
+    return ", ".join([
+        f"{node[AUTOCTL_NODE_NAME]}({node[AUTOCTL_NODE_REPORTEDSTATE]}/{node[AUTOCTL_NODE_GOALSTATE]})"
+        for node in nodes
+    ])
+
+
+def get_cluster_total_nodes(spec: kopf.Spec, conn: InstanceConnection) -> int:
+    if conn.get_machine() == None:
+        return int(spec[POSTGRESQL][READWRITEINSTANCE][REPLICAS]) + int(
+            spec[POSTGRESQL][READONLYINSTANCE][REPLICAS])
+    else:
+        return len(spec.get(POSTGRESQL).get(READWRITEINSTANCE).get(
+            MACHINES)) + len(
+                spec.get(POSTGRESQL).get(READONLYINSTANCE).get(MACHINES))
+
+
+def check_autofailover_nodes(nodes: List[Dict], primary_states: List[str],
+                             correct_states: List[str], total_nodes: int,
+                             logger: logging.Logger) -> bool:
+    primary_nodes = [
+        node for node in nodes
+        if node[AUTOCTL_NODE_REPORTEDSTATE] in primary_states
+    ]
+    if len(primary_nodes) != 1:
+        logger.warning(
+            f"not find primary node in autofailover, nodes are {autofailover_nodes_str(nodes)}"
+        )
+        return False
+
+    not_correct_nodes = [
+        node for node in nodes
+        if node[AUTOCTL_NODE_REPORTEDSTATE] not in correct_states
+    ]
+    if len(not_correct_nodes) != 0:
+        logger.warning(
+            f"there are {len(not_correct_nodes)} nodes is not {'/'.join(correct_states)}, nodes are {autofailover_nodes_str(not_correct_nodes)}"
+        )
+        return False
+
+    if len(nodes) != total_nodes:
+        logger.warning(
+            f"there are {len(nodes)} nodes in autofailover, expect {total_nodes} nodes"
+        )
+        return False
+
+    return True
+
+
 def waiting_cluster_final_status(
     meta: kopf.Meta,
     spec: kopf.Spec,
@@ -277,66 +567,36 @@ def waiting_cluster_final_status(
                                       get_field(AUTOFAILOVER), False, None,
                                       logger, None, status, False)
     for conn in auto_failover_conns.get_conns():
-        not_correct_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            f'''" select count(*) from pgautofailover.node where reportedstate <> 'primary' and reportedstate <> 'secondary' and reportedstate <> 'single' and nodename not like '{AUTOCTL_DISASTER_NAME}%' "'''
-        ]
-        primary_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            f'''" select count(*) from pgautofailover.node where reportedstate = 'primary' or reportedstate = 'single' and nodename not like '{AUTOCTL_DISASTER_NAME}%' "'''
-        ]
-        nodes_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            f'''" select count(*) from pgautofailover.node where nodename not like '{AUTOCTL_DISASTER_NAME}%' "'''
-        ]
+        total_nodes = get_cluster_total_nodes(spec, conn)
+        endpoint = sql_endpoint(meta, spec, patch, status, logger, conn)
+        if except_nodes is not None:
+            total_nodes = except_nodes
 
         i = 0
-        maxtry = timeout
-        while True:
+
+        def check() -> bool:
+            nonlocal i
             logger.info(
                 f"waiting auto_failover cluster final status, {i} times. ")
             i += 1
-            time.sleep(1)
-            if i >= maxtry:
-                logger.warning(
-                    f"cluster maybe maybe not right. skip waitting.")
-                is_health = False
-                break
-            output = exec_command(conn, primary_cmd, logger, interrupt=False)
-            if output != '1':
-                logger.warning(
-                    f"not find primary node in autofailover, output is {output}"
-                )
-                continue
-            output = exec_command(conn,
-                                  not_correct_cmd,
-                                  logger,
-                                  interrupt=False)
-            if output != '0':
-                logger.warning(
-                    f"there are {output} nodes is not primary/secondary/single"
-                )
-                continue
-
-            if conn.get_machine() == None:
-                total_nodes = int(
-                    spec[POSTGRESQL][READWRITEINSTANCE][REPLICAS]) + int(
-                        spec[POSTGRESQL][READONLYINSTANCE][REPLICAS])
-            else:
-                total_nodes = len(
-                    spec.get(POSTGRESQL).get(READWRITEINSTANCE).get(MACHINES)
-                ) + len(
-                    spec.get(POSTGRESQL).get(READONLYINSTANCE).get(MACHINES))
-            if except_nodes is not None:
-                total_nodes = except_nodes
-            output = exec_command(conn, nodes_cmd, logger, interrupt=False)
-            if output != str(total_nodes):
-                logger.warning(
-                    f"there are {output} nodes in autofailover, expect {total_nodes} nodes"
-                )
-                continue
+            nodes = get_autofailover_nodes(conn, logger, endpoint)
+            if nodes == None:
+                return False
+            nodes = [
+                node for node in nodes if not node[AUTOCTL_NODE_NAME].
+                startswith(AUTOCTL_DISASTER_NAME)
+            ]
+            return check_autofailover_nodes(
+                nodes, [AUTOCTL_STATE_PRIMARY, AUTOCTL_STATE_SINGLE], [
+                    AUTOCTL_STATE_PRIMARY, AUTOCTL_STATE_SECONDARY,
+                    AUTOCTL_STATE_SINGLE
+                ], total_nodes, logger)
 
-            break
+        # give the monitor a moment to notice the change
+        time.sleep(1)
+        if not wait_until(check, timeout, max_delay=5):
+            logger.warning(f"cluster maybe maybe not right. skip waitting.")
+            is_health = False
     auto_failover_conns.free_conns()
     return is_health
 
@@ -355,63 +615,32 @@ def waiting_cluster_correct_status(
                                       get_field(AUTOFAILOVER), False, None,
                                       logger, None, status, False)
     for conn in auto_failover_conns.get_conns():
-        not_correct_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            '''" select count(*) from pgautofailover.node where reportedstate <> 'primary' and reportedstate <> 'secondary' and reportedstate <> 'single' and reportedstate <> 'wait_primary' and reportedstate <> 'catchingup' and reportedstate <> 'wait_standby' "'''
-        ]
-        primary_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            '''" select count(*) from pgautofailover.node where reportedstate = 'primary' or reportedstate ='wait_primary' or reportedstate = 'single'  "'''
-        ]
-        nodes_cmd = [
-            "pgtools", "-w", "0", "-Q", "pg_auto_failover", "-q",
-            '''" select count(*) from pgautofailover.node  "'''
-        ]
+        total_nodes = get_cluster_total_nodes(spec, conn)
+        endpoint = sql_endpoint(meta, spec, patch, status, logger, conn)
 
         i = 0
-        maxtry = 60
-        while True:
+
+        def check() -> bool:
+            nonlocal i
             logger.info(
                 f"waiting auto_failover correct cluster Status, {i} times. ")
             i += 1
-            time.sleep(1)
-            if i >= maxtry:
-                logger.warning(
-                    f"cluster maybe maybe not right. skip waitting.")
-                break
-            output = exec_command(conn, primary_cmd, logger, interrupt=False)
-            if output != '1':
-                logger.warning(
-                    f"not find primary node in autofailover, output is {output}"
-                )
-                continue
-            output = exec_command(conn,
-                                  not_correct_cmd,
-                                  logger,
-                                  interrupt=False)
-            if output != '0':
-                logger.warning(
-                    f"there are {output} nodes is not primary/secondary/single/wait_primary/catchingup"
-                )
-                continue
-
-            if conn.get_machine() == None:
-                total_nodes = int(
-                    spec[POSTGRESQL][READWRITEINSTANCE][REPLICAS]) + int(
-                        spec[POSTGRESQL][READONLYINSTANCE][REPLICAS])
-            else:
-                total_nodes = len(
-                    spec.get(POSTGRESQL).get(READWRITEINSTANCE).get(MACHINES)
-                ) + len(
-                    spec.get(POSTGRESQL).get(READONLYINSTANCE).get(MACHINES))
-            output = exec_command(conn, nodes_cmd, logger, interrupt=False)
-            if output != str(total_nodes):
-                logger.warning(
-                    f"there are {output} nodes in autofailover, expect {total_nodes} nodes"
-                )
-                continue
-
-            break
+            nodes = get_autofailover_nodes(conn, logger, endpoint)
+            if nodes == None:
+                return False
+            return check_autofailover_nodes(nodes, [
+                AUTOCTL_STATE_PRIMARY, AUTOCTL_STATE_WAIT_PRIMARY,
+                AUTOCTL_STATE_SINGLE
+            ], [
+                AUTOCTL_STATE_PRIMARY, AUTOCTL_STATE_SECONDARY,
+                AUTOCTL_STATE_SINGLE, AUTOCTL_STATE_WAIT_PRIMARY,
+                AUTOCTL_STATE_CATCHINGUP, AUTOCTL_STATE_WAIT_STANDBY
+            ], total_nodes, logger)
+
+        # give the monitor a moment to notice the change
+        time.sleep(1)
+        if not wait_until(check, MINUTES, max_delay=5):
+            logger.warning(f"cluster maybe maybe not right. skip waitting.")
     auto_failover_conns.free_conns()
 
 
@@ -440,26 +669,39 @@ def waiting_postgresql_ready(
         connect_end = conns.get_number()
     conns = conns.get_conns()[connect_start:connect_end]
 
-    for conn in conns:
+    def waiting(conn: InstanceConnection) -> bool:
         i = 0
-        maxtry = timeout
-        while True:
-            output = exec_command(conn,
-                                  WAITING_POSTGRESQL_READY_COMMAND,
-                                  logger,
-                                  interrupt=False)
+
+        def check() -> bool:
+            nonlocal i
+            result = exec_command_result(conn,
+                                         WAITING_POSTGRESQL_READY_COMMAND,
+                                         logger)
+            output = result.get_output()
             if output != INIT_FINISH_MESSAGE:
                 i += 1
-                time.sleep(1)
                 logger.error(
                     f"postgresql {get_connhost(conn)} is not ready. try {i} times. {output}"
                 )
-                if i >= maxtry:
-                    logger.warning(f"postgresql is not ready. skip waitting.")
-                    return False
-            else:
-                break
-    return True
+                if not result.retryable():
+                    raise kopf.PermanentError(
+                        f"postgresql {get_connhost(conn)} can't be ready. {output}"
+                    )
+                return False
+            return True
+
+        if not wait_until(
+                check, timeout,
+                exec_until_signal(conn,
+                                  " ".join(WAITING_POSTGRESQL_READY_COMMAND),
+                                  logger)):
+            logger.warning(f"postgresql is not ready. skip waitting.")
+            return False
+        return True
+
+    results = fan_out(conns, waiting, logger, fail_fast=False)
+    raise_permanent_error(results)
+    return all([result.ok() and result.get_value() for result in results])
 
 
 def waiting_target_postgresql_ready(meta: kopf.Meta,
@@ -497,20 +739,27 @@ def waiting_instance_ready(conns: InstanceConnections,
 
     success_message = 'running success'
     cmd = ['echo', "'%s'" % success_message]
-    for conn in conns:
+
+    def waiting(conn: InstanceConnection) -> None:
         i = 0
-        maxtry = timeout
-        while True:
-            output = exec_command(conn, cmd, logger, interrupt=False)
+
+        def check() -> bool:
+            nonlocal i
+            result = exec_command_result(conn, cmd, logger)
+            output = result.get_output()
             if output != success_message:
                 i += 1
-                time.sleep(1)
                 logger.warning(f"instance not start. try {i} times. {output}")
-                if i >= maxtry:
-                    logger.warning(f"instance not start. skip waitting.")
-                    break
-            else:
-                break
+                if not result.retryable():
+                    raise kopf.PermanentError(
+                        f"instance {get_connhost(conn)} can't start. {output}")
+                return False
+            return True
+
+        if not wait_until(check, timeout, pod_event_signal(conn, logger)):
+            logger.warning(f"instance not start. skip waitting.")
+
+    raise_permanent_error(fan_out(conns, waiting, logger, fail_fast=False))
 
 
 def waiting_postgresql_recovery_completed(conns: InstanceConnections,
@@ -531,10 +780,10 @@ def waiting_postgresql_recovery_completed(conns: InstanceConnections,
 
     for conn in conns.get_conns():
         i = 0
-        maxtry = timeout
-        while True:
+
+        def check() -> bool:
+            nonlocal i, recovery_is_success
             i += 1
-            time.sleep(1)
             output = exec_command(conn,
                                   recover_completed_cmd,
                                   logger,
@@ -545,7 +794,7 @@ def waiting_postgresql_recovery_completed(conns: InstanceConnections,
             else:
                 logger.info(f"recovery completed.")
                 recovery_is_success = True
-                break
+                return True
 
             output = exec_command(conn,
                                   pg_running_cmd,
@@ -555,11 +804,15 @@ def waiting_postgresql_recovery_completed(conns: InstanceConnections,
                 logger.warning(
                     f"waiting recovery but PostgreSQL is not running. maybe recovery not completed, please check PostgreSQL log. {output}"
                 )
-                break
+                return True
+            return False
 
-            if i >= maxtry:
-                logger.warning(f"recovery not completed. skip waitting.")
-                break
+        if not wait_until(
+                check, timeout,
+                exec_until_signal(
+                    conn, "test -f " +
+                    os.path.join(ASSIST_DIR, RECOVERY_FINISH), logger)):
+            logger.warning(f"recovery not completed. skip waitting.")
 
     return recovery_is_success
 
@@ -591,65 +844,74 @@ def waiting_pg_basebackup_completed(conns: InstanceConnections,
         connect_end = conns.get_number()
     conns = conns.get_conns()[connect_start:connect_end]
 
-    pg_basebackup_is_success = False
     pg_basebackup_precheck_cmd = [
         "test", "-d", PG_DATABASE_DIR, "&&", "ls", PG_DATABASE_DIR, "|", "wc",
         "-l", "||", "echo", "0"
     ]
-    pg_basebackup_completed_cmd = [
-        "ps -ef | grep -v grep | grep pg_basebackup"
-    ]
-    for conn in conns:
-        i = 0
-        maxtry = timeout
-        pg_basebackup_precheck_timeout = 60
-        success_counter = 0
-        success_threshold = 10
-        while True:
-            i += 1
-            time.sleep(1)
+    pg_basebackup_process = "pg_basebackup"
 
+    def waiting(conn: InstanceConnection) -> bool:
+        pg_basebackup_precheck_timeout = MINUTES
+        success_stable_seconds = 10
+        completed_since = None
+
+        def precheck() -> bool:
             output = exec_command(conn,
                                   pg_basebackup_precheck_cmd,
                                   logger,
                                   interrupt=False)
             if to_int(output) == 0:
-                if i < pg_basebackup_precheck_timeout:
-                    logger.warning(
-                        f"pg_basebackup execute pg_basebackup_precheck_cmd for {get_connhost(conn)} not completed. try {i} times."
-                    )
-                    continue
-                else:
-                    logger.warning(
-                        f"pg_basebackup execute pg_basebackup_precheck_cmd for {get_connhost(conn)} not completed. skip waitting."
-                    )
-                    break
-
-            output = exec_command(conn,
-                                  pg_basebackup_completed_cmd,
-                                  logger,
-                                  interrupt=False)
-            if output.strip() == "":
-                success_counter += 1
-                logger.info(
-                    f"pg_basebackup for {get_connhost(conn)} complete {success_counter} times, success_threshold is {success_threshold}."
-                )
-                if success_counter >= success_threshold:
-                    pg_basebackup_is_success = True
-                    break
-            else:
                 logger.warning(
-                    f"pg_basebackup for {get_connhost(conn)} not completed. try {i} times."
+                    f"pg_basebackup execute pg_basebackup_precheck_cmd for {get_connhost(conn)} not completed."
                 )
-                success_counter = 0
-
-            if i >= maxtry:
-                logger.warning(
-                    f"pg_basebackup for {get_connhost(conn)} not completed. skip waitting."
+                return False
+            return True
+
+        # pg_basebackup must not be seen again for success_stable_seconds
+        def check() -> bool:
+            nonlocal completed_since
+            if find_process(conn, pg_basebackup_process, logger) == "":
+                if completed_since == None:
+                    completed_since = time.time()
+                logger.info(
+                    f"pg_basebackup for {get_connhost(conn)} complete {int(time.time() - completed_since)} seconds, success_stable_seconds is {success_stable_seconds}."
                 )
-                break
+                return time.time() - completed_since >= success_stable_seconds
+            logger.warning(
+                f"pg_basebackup for {get_connhost(conn)} not completed.")
+            completed_since = None
+            return False
+
+        def signal(wait: float) -> bool:
+            # pg_basebackup exited
+            if completed_since == None:
+                return exec_wait_signal(conn, pg_basebackup_process,
+                                        logger)(wait)
+            time.sleep(
+                max(
+                    0,
+                    min(wait, success_stable_seconds -
+                        (time.time() - completed_since))))
+            return True
+
+        if not wait_until(precheck,
+                          pg_basebackup_precheck_timeout,
+                          max_delay=5):
+            logger.warning(
+                f"pg_basebackup execute pg_basebackup_precheck_cmd for {get_connhost(conn)} not completed. skip waitting."
+            )
+            return False
+
+        if not wait_until(check, timeout, signal):
+            logger.warning(
+                f"pg_basebackup for {get_connhost(conn)} not completed. skip waitting."
+            )
+            return False
+        return True
 
-    return pg_basebackup_is_success
+    results = fan_out(conns, waiting, logger, fail_fast=False)
+    raise_permanent_error(results)
+    return all([result.ok() and result.get_value() for result in results])
 
 
 def get_replica_by_machine(
@@ -1017,27 +1279,13 @@ def update_pgpassfile(
     readonly_conns = connections(spec, meta, patch,
                                  get_field(POSTGRESQL, READONLYINSTANCE),
                                  False, None, logger, None, status, False)
-    for conn in (conns.get_conns() + readonly_conns.get_conns()):
-        # clean old data
-        cmd = ["truncate", "--size", "0", PGPASSFILE_PATH]
-        output = exec_command(conn, cmd, logger, interrupt=False)
-
-        # sed can't work when file size is 0.
-        cmd = ["truncate", "--size", "1", PGPASSFILE_PATH]
-        output = exec_command(conn, cmd, logger, interrupt=False)
-
-        # ">" can't run in docker exec
-        for onepass in pgpassfile.split("\n"):
-            if len(onepass) < 5:
-                continue
-            cmd = ["sed", "-i", "-e", "'1i" + onepass + "'", PGPASSFILE_PATH]
-            output = exec_command(conn, cmd, logger, interrupt=False)
-
-        cmd = ["chmod", "0600", PGPASSFILE_PATH]
-        output = exec_command(conn, cmd, logger, interrupt=False)
-
-        cmd = ["chown", "postgres:postgres", PGPASSFILE_PATH]
-        output = exec_command(conn, cmd, logger, interrupt=False)
+    pgpassfile = "\n".join(
+        [onepass for onepass in pgpassfile.split("\n") if len(onepass) >= 5]) + "\n"
+    put_files(conns.get_conns() + readonly_conns.get_conns(),
+              PGPASSFILE_PATH,
+              pgpassfile,
+              logger,
+              interrupt=False)
     conns.free_conns()
     readonly_conns.free_conns()
 
@@ -1200,6 +1448,275 @@ def connect_pods(
     return conns
 
 
+class MachineSession:
+
+    def __init__(self, ssh: paramiko.SSHClient, sftp: paramiko.SFTPClient,
+                 trans: paramiko.Transport, password: str):
+        self.ssh = ssh
+        self.sftp = sftp
+        self.trans = trans
+        self.password = password
+        self.last_used = time.time()
+
+    def is_active(self) -> bool:
+        try:
+            transport = self.ssh.get_transport()
+            if transport == None or not transport.is_active():
+                return False
+            if self.trans == None or not self.trans.is_active():
+                return False
+            transport.send_ignore()
+            self.trans.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close(self) -> None:
+        try:
+            self.ssh.close()
+        except Exception:
+            pass
+        try:
+            self.trans.close()
+        except Exception:
+            pass
+
+
+class MachineConnectionPool:
+    """ssh/sftp sessions shared by the whole operator process.
+
+    sessions are keyed by (username, host, port, role). a borrowed session is
+    owned by one InstanceConnectionMachine until free_conn gives it back.
+    the number of opened sessions per host is limited by
+    SSH_POOL_MAX_PER_HOST, idle sessions are closed after
+    SSH_POOL_IDLE_TIMEOUT seconds by a background thread. a session
+    borrowed longer than SSH_POOL_LEASE_TIMEOUT seconds no longer counts
+    when the host is full, it is closed once it comes back. a session whose
+    holder was garbage collected without free_conn is closed by the
+    background thread.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.idle: Dict[Tuple, List[MachineSession]] = {}
+        self.opened: Dict[str, int] = {}
+        # ssh client of every borrowed session -> (host, borrowed at)
+        self.leased: Dict[paramiko.SSHClient, Tuple[str, float]] = {}
+        # ssh client of every borrowed session -> (session, its holder)
+        self.holders: Dict[paramiko.SSHClient,
+                           Tuple[MachineSession, weakref.ref]] = {}
+        self.evictor: threading.Thread = None
+
+    def acquire(self,
+                username: str,
+                password: str,
+                host: str,
+                port: int,
+                role: str,
+                timeout: int = MINUTES * 10) -> MachineSession:
+        key = (username, host, port, role)
+        deadline = time.time() + timeout
+        with self.cond:
+            self._start_evictor()
+            while True:
+                self._evict_idle()
+                sessions = self.idle.get(key, [])
+                while len(sessions) > 0:
+                    session = sessions.pop()
+                    if session.password == password and session.is_active():
+                        self.leased[session.ssh] = (host, time.time())
+                        return session
+                    self._close(host, session)
+                if self.opened.get(host, 0) < operator_config.SSH_POOL_MAX_PER_HOST:
+                    self.opened[host] = self.opened.get(host, 0) + 1
+                    break
+                # make room with idle sessions of other users/ports
+                if self._evict_host(host) or self._expire_leases(host):
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise kopf.TemporaryError(
+                        f"ssh sessions to machine {host} exceed {operator_config.SSH_POOL_MAX_PER_HOST}"
+                    )
+                self.cond.wait(min(remaining, 1))
+
+        try:
+            session = self._open(username, password, host, port)
+        except:
+            with self.cond:
+                self.opened[host] -= 1
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.leased[session.ssh] = (host, time.time())
+        return session
+
+    def hold(self, session: MachineSession,
+             machine: InstanceConnectionMachine) -> None:
+        """remember the holder of a borrowed session, see evict."""
+        with self.cond:
+            self.holders[session.ssh] = (session, weakref.ref(machine))
+
+    def release(self, machine: InstanceConnectionMachine) -> None:
+        key = (machine.get_username(), machine.get_host(),
+               machine.get_port(), machine.get_role())
+        session = MachineSession(machine.get_ssh(), machine.get_sftp(),
+                                 machine.get_trans(), machine.get_password())
+        with self.cond:
+            self.holders.pop(session.ssh, None)
+            if self.leased.pop(session.ssh, None) == None:
+                # the lease expired, the session is not counted any more
+                session.close()
+                return
+            if machine.is_broken():
+                # a timed out command may still run on it
+                self._close(key[1], session)
+                self.cond.notify_all()
+                return
+            self.idle.setdefault(key, []).append(session)
+            self._evict_idle()
+            self.cond.notify_all()
+
+    def evict(self) -> None:
+        """close the idle sessions and the sessions whose holder is gone."""
+        with self.cond:
+            self._evict_idle()
+            for ssh, (session, holder) in list(self.holders.items()):
+                if holder() != None:
+                    continue
+                self.holders.pop(ssh)
+                lease = self.leased.pop(ssh, None)
+                if lease == None:
+                    session.close()
+                    continue
+                logging.warning(
+                    f"ssh session to machine {lease[0]} is not freed by its holder, close it"
+                )
+                self._close(lease[0], session)
+            self.cond.notify_all()
+
+    def close_all(self) -> None:
+        with self.cond:
+            for key, sessions in self.idle.items():
+                for session in sessions:
+                    self._close(key[1], session)
+            self.idle = {}
+            self.cond.notify_all()
+
+    def _open(self, username: str, password: str, host: str,
+              port: int) -> MachineSession:
+        machine = "%s@%s:%d" % (username, host, port)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        i = 0
+        max_times = 600
+
+        while True:
+            try:
+                ssh.connect(host,
+                            username=username,
+                            port=port,
+                            password=password)
+                time.sleep(0.1)
+                break
+            except Exception as e:
+                time.sleep(1)
+                i += 1
+                if i >= max_times:
+                    raise kopf.PermanentError(
+                        f"ssh can't connect to machine {machine} : {e}")
+
+        trans = paramiko.Transport((host, port))
+        try:
+            trans.connect(username=username, password=password)
+            sftp = paramiko.SFTPClient.from_transport(trans)
+        except Exception as e:
+            ssh.close()
+            trans.close()
+            raise kopf.PermanentError(
+                f"sftp can't connect to machine {machine} : {e}")
+
+        # only new sessions need the compose directories
+        cmd = "mkdir -p " + os.path.join(operator_config.DATA_PATH_AUTOFAILOVER,
+                                         DOCKER_COMPOSE_DIR)
+        machine_exec_command(ssh, cmd)
+        cmd = "mkdir -p " + os.path.join(operator_config.DATA_PATH_POSTGRESQL,
+                                         DOCKER_COMPOSE_DIR)
+        machine_exec_command(ssh, cmd)
+        return MachineSession(ssh, sftp, trans, password)
+
+    def _start_evictor(self) -> None:
+        if self.evictor != None:
+            return
+        self.evictor = threading.Thread(target=run_pool_evictor,
+                                        args=(weakref.ref(self), ),
+                                        name="ssh-pool-evictor",
+                                        daemon=True)
+        self.evictor.start()
+
+    def _close(self, host: str, session: MachineSession) -> None:
+        session.close()
+        self.opened[host] = self.opened.get(host, 1) - 1
+        if self.opened[host] <= 0:
+            self.opened.pop(host)
+
+    def _evict_idle(self) -> None:
+        now = time.time()
+        for key in list(self.idle.keys()):
+            keep = []
+            for session in self.idle[key]:
+                if now - session.last_used > operator_config.SSH_POOL_IDLE_TIMEOUT:
+                    self._close(key[1], session)
+                else:
+                    keep.append(session)
+            if len(keep) == 0:
+                self.idle.pop(key)
+            else:
+                self.idle[key] = keep
+
+    def _expire_leases(self, host: str) -> bool:
+        now = time.time()
+        expired = False
+        for ssh, (leased_host, since) in list(self.leased.items()):
+            if leased_host == host and now - since > operator_config.SSH_POOL_LEASE_TIMEOUT:
+                logging.warning(
+                    f"ssh session to machine {host} is not released in {operator_config.SSH_POOL_LEASE_TIMEOUT} seconds, stop counting it"
+                )
+                self.leased.pop(ssh)
+                self.opened[host] = self.opened.get(host, 1) - 1
+                if self.opened[host] <= 0:
+                    self.opened.pop(host)
+                expired = True
+        return expired
+
+    def _evict_host(self, host: str) -> bool:
+        for key in list(self.idle.keys()):
+            if key[1] == host and len(self.idle[key]) > 0:
+                self._close(host, self.idle[key].pop(0))
+                if len(self.idle[key]) == 0:
+                    self.idle.pop(key)
+                return True
+        return False
+
+
+def run_pool_evictor(pool_ref: weakref.ref) -> None:
+    """evict the pool every SSH_POOL_EVICT_INTERVAL until the pool is gone."""
+    while True:
+        time.sleep(SSH_POOL_EVICT_INTERVAL)
+        pool = pool_ref()
+        if pool == None:
+            return
+        try:
+            pool.evict()
+        except Exception as e:
+            logging.warning(f"evict ssh sessions failed, {e}")
+        pool = None
+
+
+# The global ssh/sftp pool of machine mode
+machine_connection_pool = MachineConnectionPool()
+
+
 def connect_machine(machine: str,
                     role: str = POSTGRESQL) -> InstanceConnection:
     username = machine.split(":")[0]
@@ -1207,55 +1724,58 @@ def connect_machine(machine: str,
     host = machine.split(":")[2]
     port = int(machine.split(":")[3])
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    i = 0
-    max_times = 600
+    session = machine_connection_pool.acquire(username, password, host, port,
+                                              role)
+    machine = InstanceConnectionMachine(host, port, username, password,
+                                        session.ssh, session.sftp,
+                                        session.trans, role,
+                                        machine_connection_pool)
+    machine_connection_pool.hold(session, machine)
+    return InstanceConnection(machine, None)
 
-    while True:
-        try:
-            ssh.connect(host, username=username, port=port, password=password)
-            time.sleep(0.1)
-            break
-        except Exception as e:
-            time.sleep(1)
-            i += 1
-            if i >= max_times:
-                raise kopf.PermanentError(
-                    f"ssh can't connect to machine {machine} : {e}")
-                break
 
-    trans = paramiko.Transport((host, port))
+def machine_sftp_put(sftp: paramiko.SFTPClient,
+                     buffer: str,
+                     remotepath: str,
+                     mode: int = None) -> None:
     try:
-        trans.connect(username=username, password=password)
-        sftp = paramiko.SFTPClient.from_transport(trans)
+        # readers never see a half written file, mode is set before the
+        # content is written.
+        with sftp.open(remotepath + PUT_FILE_SUFFIX, 'wb') as f:
+            if mode != None:
+                f.chmod(mode)
+            f.write(buffer.encode('utf-8'))
+        sftp.posix_rename(remotepath + PUT_FILE_SUFFIX, remotepath)
     except Exception as e:
         raise kopf.PermanentError(
-            f"sftp can't connect to machine {machine} : {e}")
+            f"can't put file to remote {remotepath} : {e}")
 
-    conn = InstanceConnection(
-        InstanceConnectionMachine(host, port, username, password, ssh, sftp,
-                                  trans, role), None)
-    cmd = "mkdir -p " + os.path.join(operator_config.DATA_PATH_AUTOFAILOVER,
-                                     DOCKER_COMPOSE_DIR)
-    machine_exec_command(conn.get_machine().get_ssh(), cmd)
-    cmd = "mkdir -p " + os.path.join(operator_config.DATA_PATH_POSTGRESQL,
-                                     DOCKER_COMPOSE_DIR)
-    machine_exec_command(conn.get_machine().get_ssh(), cmd)
-    return conn
 
+def machine_sftp_same(sftp: paramiko.SFTPClient,
+                      buffer: str,
+                      remotepath: str,
+                      mode: int = None) -> bool:
+    """True when remotepath already holds buffer, compared by size then sha256.
 
-def machine_sftp_put(sftp: paramiko.SFTPClient, buffer: str,
-                     remotepath: str) -> None:
+    an unchanged file with more permission bits than mode is chmodded to mode.
+    """
+    data = buffer.encode('utf-8')
     try:
-        tf = tempfile.NamedTemporaryFile()
-        tf.write(buffer.encode('utf-8'))
-        tf.flush()
-        sftp.put(localpath=tf.name, remotepath=remotepath)
-        tf.close()
-    except Exception as e:
-        raise kopf.PermanentError(
-            f"can't put file to remote {remotepath} : {e}")
+        attr = sftp.stat(remotepath)
+        if attr.st_size != len(data):
+            return False
+        remote_hash = hashlib.sha256()
+        with sftp.open(remotepath, 'rb') as f:
+            f.prefetch()
+            for chunk in iter(lambda: f.read(EXEC_STREAM_CHUNK_SIZE), b''):
+                remote_hash.update(chunk)
+        if remote_hash.digest() != hashlib.sha256(data).digest():
+            return False
+        if mode != None and attr.st_mode & 0o777 & ~mode:
+            sftp.chmod(remotepath, mode)
+    except Exception:
+        return False
+    return True
 
 
 def machine_sftp_get(sftp: paramiko.SFTPClient, localpath: str,
@@ -1267,6 +1787,189 @@ def machine_sftp_get(sftp: paramiko.SFTPClient, localpath: str,
             f"can't get file from remote {remotepath} : {e}")
 
 
+class NodeResult:
+
+    def __init__(self, conn: InstanceConnection):
+        self.conn = conn
+        self.value = None
+        self.error = None
+
+    def get_conn(self):
+        return self.conn
+
+    def get_value(self):
+        return self.value
+
+    def get_error(self):
+        return self.error
+
+    def ok(self) -> bool:
+        return self.error == None
+
+
+exec_executor = None
+exec_worker = threading.local()
+
+
+def mark_exec_worker() -> None:
+    exec_worker.active = True
+
+
+def get_exec_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """the executor shared by every parallel exec of the operator."""
+    global exec_executor
+    with api_lock:
+        if exec_executor == None:
+            exec_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=operator_config.EXEC_PARALLELISM,
+                thread_name_prefix="exec",
+                initializer=mark_exec_worker)
+        return exec_executor
+
+
+def in_exec_worker() -> bool:
+    return getattr(exec_worker, "active", False)
+
+
+def submit_exec(func: Callable, *args) -> concurrent.futures.Future:
+    """run func(*args) on the shared exec executor.
+
+    a worker of the executor runs func itself, waiting for other workers
+    there could take every worker and never return.
+    """
+    if not in_exec_worker():
+        return get_exec_executor().submit(func, *args)
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def exec_command_async(
+        conn: InstanceConnection,
+        cmd: [str],
+        logger: logging.Logger,
+        interrupt: bool = True,
+        user: str = "root",
+        timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT
+) -> concurrent.futures.Future:
+    """exec_command on the shared exec executor, the future holds the output."""
+    return submit_exec(exec_command, conn, cmd, logger, interrupt, user,
+                       timeout)
+
+
+def fan_out(conns: List[InstanceConnection],
+            func: Callable[[InstanceConnection], Any],
+            logger: logging.Logger,
+            fail_fast: bool = True,
+            timeout: int = None,
+            limit: int = None) -> List[NodeResult]:
+    """run func(conn) for every conn on the shared exec executor.
+
+    returns one NodeResult per conn, in the order of conns. at most limit
+    conns run at once. timeout is per node and counted from the moment the
+    node starts running.
+    fail_fast=True skips the nodes which have not started on the first node
+    error (or timeout) and raises it once the running nodes ended, otherwise
+    every node runs to the end and errors are kept in the results.
+    a fan_out called from an exec worker runs the conns one by one there.
+    conns may be any items, e.g. replica numbers, when timeout is None.
+    """
+    results = [NodeResult(conn) for conn in conns]
+    if len(conns) == 0:
+        return results
+    if in_exec_worker():
+        limit = 1
+
+    started = {}
+
+    def run(i: int, conn: InstanceConnection) -> Any:
+        started[i] = time.time()
+        return func(conn)
+
+    futures = {}
+    queued = list(range(len(conns)))
+    pending = set()
+
+    def submit() -> None:
+        while len(queued) > 0 and (limit == None or len(pending) < limit):
+            i = queued.pop(0)
+            future = submit_exec(run, i, conns[i])
+            futures[future] = i
+            pending.add(future)
+
+    first_error = None
+    try:
+        submit()
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=None if timeout == None else 1,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                try:
+                    results[i].value = future.result()
+                except Exception as e:
+                    results[i].error = e
+                    if fail_fast and first_error == None:
+                        first_error = e
+            if timeout != None:
+                now = time.time()
+                for future in list(pending):
+                    i = futures[future]
+                    if i in started and now - started[i] > timeout:
+                        # the thread can't be killed, only stop waiting for
+                        # it. its ssh session is closed instead of pooled.
+                        pending.remove(future)
+                        if isinstance(conns[i], InstanceConnection
+                                      ) and conns[i].get_machine() != None:
+                            conns[i].get_machine().set_broken()
+                        results[i].error = kopf.TemporaryError(
+                            f"{get_connhost(conns[i])} not completed in {timeout} seconds"
+                        )
+                        logger.warning(str(results[i].error))
+                        if fail_fast and first_error == None:
+                            first_error = results[i].error
+            if first_error != None:
+                # the nodes which have not started are skipped, the running
+                # ones still use their sessions, wait for them.
+                queued.clear()
+                pending = set(
+                    future for future in pending if not future.cancel())
+                continue
+            submit()
+    finally:
+        for future in pending:
+            future.cancel()
+
+    if first_error != None:
+        raise first_error
+    return results
+
+
+def raise_permanent_error(results: List[NodeResult]) -> None:
+    """raise the first kopf.PermanentError of a fail_fast=False fan_out."""
+    for result in results:
+        if isinstance(result.get_error(), kopf.PermanentError):
+            raise result.get_error()
+
+
+def parallel_exec_command(conns: List[InstanceConnection],
+                          cmd: [str],
+                          logger: logging.Logger,
+                          interrupt: bool = True,
+                          user: str = "root",
+                          fail_fast: bool = True,
+                          timeout: int = None) -> List[NodeResult]:
+    return fan_out(
+        conns, lambda conn: exec_command(
+            conn, cmd, logger, interrupt=interrupt, user=user), logger,
+        fail_fast, timeout)
+
+
 def multi_exec_command(
     conns: InstanceConnections,
     cmds: List,
@@ -1274,10 +1977,118 @@ def multi_exec_command(
     interrupt: bool = True,
     user: str = "root",
 ) -> None:
-    for conn in conns.get_conns():
+
+    def run(conn: InstanceConnection) -> None:
         for cmd in cmds:
             exec_command(conn, cmd, logger, interrupt=interrupt, user=user)
 
+    fan_out(conns.get_conns(), run, logger, fail_fast=interrupt)
+
+
+def machine_host_path(machine: InstanceConnectionMachine, path: str) -> str:
+    """host path of a container path under DATA_DIR (the pgdata volume)."""
+    if machine.get_role() == AUTOFAILOVER:
+        machine_data_path = operator_config.DATA_PATH_AUTOFAILOVER
+    else:
+        machine_data_path = operator_config.DATA_PATH_POSTGRESQL
+    relpath = os.path.relpath(path, DATA_DIR)
+    if relpath.startswith(".."):
+        raise kopf.PermanentError(f"{path} is not under {DATA_DIR}")
+    return os.path.join(machine_data_path, PGDATA_DIR, relpath)
+
+
+def put_file(conn: InstanceConnection,
+             path: str,
+             content: str,
+             logger: logging.Logger,
+             mode: str = "0600",
+             owner: str = "postgres:postgres",
+             interrupt: bool = True,
+             host: bool = False) -> bool:
+    """write the whole file in one call and rename it in place.
+
+    pods get the content on the exec stdin, machines get it by sftp on the
+    pgdata volume. the file is written to path + PUT_FILE_SUFFIX first, so
+    readers see the old or the new file, never a part of it.
+    host=True writes path on the machine itself (docker-compose files),
+    owner is ignored then.
+    """
+    if host == True:
+        if conn.get_machine() == None:
+            raise kopf.PermanentError(f"can't put host file {path} to a pod")
+        logger.info(f"put file {path} to {get_connhost(conn)}")
+        try:
+            machine_sftp_put(conn.get_machine().get_sftp(), content, path,
+                             int(mode, 8))
+        except Exception as e:
+            if interrupt:
+                raise kopf.PermanentError(
+                    f"put file {path} to {get_connhost(conn)} failed, {e}")
+            logger.error(
+                f"put file {path} to {get_connhost(conn)} failed, {e}")
+            return False
+        return True
+
+    tmppath = path + PUT_FILE_SUFFIX
+    finish_cmd = [
+        "chmod", mode, tmppath, "&&", "chown", owner, tmppath, "&&", "mv",
+        "-f", tmppath, path, "&&", "echo", SUCCESS
+    ]
+    logger.info(f"put file {path} to {get_connhost(conn)}")
+    if conn.get_k8s() != None:
+        data = string_to_base64(content)
+        # the websocket can't close stdin, so read exactly len(data) bytes
+        cmd = ["head", "-c", str(len(data)), "|", "base64", "-d", ">", tmppath
+               ] + ["&&"] + finish_cmd
+        output = pod_exec_command(conn.get_k8s().get_podname(),
+                                  conn.get_k8s().get_namespace(),
+                                  cmd,
+                                  logger,
+                                  interrupt,
+                                  stdin=data)
+    else:
+        # the uploaded file belongs to the ssh user and pgtools runs as
+        # postgres, so root copies it to a file owned by postgres inside the
+        # container. the upload is only readable by its owner and removed
+        # whatever the copy returns.
+        uploadpath = tmppath + PUT_FILE_SUFFIX
+        try:
+            host_uploadpath = machine_host_path(conn.get_machine(),
+                                                uploadpath)
+            machine_sftp_put(conn.get_machine().get_sftp(), content,
+                             host_uploadpath, 0o600)
+        except Exception as e:
+            if interrupt:
+                raise
+            logger.error(str(e))
+            return False
+        cmd = ["cp", "-f", uploadpath, tmppath, "&&"] + finish_cmd + [
+            ";", "rm", "-f", uploadpath, tmppath
+        ]
+        output = exec_command(conn, cmd, logger, interrupt)
+
+    if output.find(SUCCESS) == -1:
+        if interrupt:
+            raise kopf.PermanentError(
+                f"put file {path} to {get_connhost(conn)} failed, {output}")
+        logger.error(f"put file {path} to {get_connhost(conn)} failed, {output}")
+        return False
+    return True
+
+
+def put_files(conns: List[InstanceConnection],
+              path: str,
+              content: str,
+              logger: logging.Logger,
+              mode: str = "0600",
+              owner: str = "postgres:postgres",
+              interrupt: bool = True,
+              host: bool = False) -> List[NodeResult]:
+    return fan_out(
+        conns, lambda conn: put_file(conn, path, content, logger, mode,
+                                     owner, interrupt, host), logger,
+        interrupt)
+
 
 def exec_command(conn: InstanceConnection,
                  cmd: [str],
@@ -1301,39 +2112,479 @@ def exec_command(conn: InstanceConnection,
     return ret
 
 
+class ScriptStep:
+
+    def __init__(self, cmd: [str], user: str = "root"):
+        self.cmd = cmd
+        self.user = user
+
+    def get_cmd(self) -> [str]:
+        return self.cmd
+
+    def get_user(self) -> str:
+        return self.user
+
+
+class ExecResult:
+    """what one exec returned.
+
+    returncode is None when the command didn't run or didn't finish, error
+    is then the exception of the exec itself.
+    """
+
+    def __init__(self,
+                 returncode: int = None,
+                 stdout: str = '',
+                 stderr: str = '',
+                 error: Exception = None):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.error = error
+
+    def get_returncode(self) -> int:
+        return self.returncode
+
+    def get_stdout(self) -> str:
+        return self.stdout
+
+    def get_stderr(self) -> str:
+        return self.stderr
+
+    def get_error(self) -> Exception:
+        return self.error
+
+    def get_output(self) -> str:
+        """stdout and stderr without newline, like exec_command."""
+        return self.stdout.replace('\n', '') + self.stderr.replace('\n', '')
+
+    def get_lines(self) -> List[str]:
+        """not empty stdout lines."""
+        return [
+            line.strip() for line in self.stdout.replace('\r\n', '\n').split('\n')
+            if line.strip() != ''
+        ]
+
+    def get_rows(self, separator: str = "|") -> List[List[str]]:
+        """rows of a psql -t -A (pgtools -q) output."""
+        return [line.split(separator) for line in self.get_lines()]
+
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    def retryable(self) -> bool:
+        if self.returncode in EXEC_NONRETRYABLE_CODES:
+            return False
+        if isinstance(self.error, client.exceptions.ApiException
+                      ) and self.error.status in EXEC_NONRETRYABLE_API_STATUS:
+            return False
+        if isinstance(self.error, paramiko.AuthenticationException):
+            return False
+        return True
+
+
+class StepResult(ExecResult):
+
+    def __init__(self, step: ScriptStep):
+        super().__init__()
+        self.step = step
+
+    def get_step(self) -> ScriptStep:
+        return self.step
+
+
+# every step prints one line "mark:index:returncode:stdout:stderr;" with
+# stdout and stderr base64 encoded, which survives the newline stripping of
+# pod exec and the pty of docker exec.
+SCRIPT_STEP_FUNCTION = """
+step() {
+	out=$(mktemp); err=$(mktemp)
+	if [ "$(id -u)" = 0 ]; then
+		gosu "$2" bash -c "$3" >"$out" 2>"$err"
+	else
+		bash -c "$3" >"$out" 2>"$err"
+	fi
+	rc=$?
+	echo "%s:$1:$rc:$(base64 -w0 "$out"):$(base64 -w0 "$err");"
+	rm -f "$out" "$err"
+	return $rc
+}
+""" % SCRIPT_STEP_MARK
+SCRIPT_STEP_PATTERN = re.compile(SCRIPT_STEP_MARK +
+                                 r":(\d+):(\d+):([A-Za-z0-9+/=]*):([A-Za-z0-9+/=]*);")
+
+
+def exec_script(conn: InstanceConnection,
+                steps: List[Any],
+                logger: logging.Logger,
+                interrupt: bool = True,
+                stop_on_error: bool = True,
+                timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT
+                ) -> List[StepResult]:
+    """run an ordered list of steps in one pod exec or docker exec.
+
+    a step is a ScriptStep or a cmd list (run as root). returns one
+    StepResult per step, steps after a failed one are not run when
+    stop_on_error is True. interrupt=True raises on the first failed step.
+    """
+    steps = [
+        step if isinstance(step, ScriptStep) else ScriptStep(step)
+        for step in steps
+    ]
+    results = [StepResult(step) for step in steps]
+    if len(steps) == 0:
+        return results
+
+    script = SCRIPT_STEP_FUNCTION
+    for i, step in enumerate(steps):
+        script += "step %d %s %s" % (i, step.get_user(),
+                                     shlex.quote(" ".join(step.get_cmd())))
+        script += " || exit 0\n" if stop_on_error else "\n"
+    cmd = ["echo", string_to_base64(script), "|", "base64", "-d", "|", "bash"]
+    logger.info(f"exec script {[step.get_cmd() for step in steps]}")
+    output = exec_command(conn, cmd, logger, interrupt=interrupt, timeout=timeout)
+
+    for match in SCRIPT_STEP_PATTERN.finditer(output):
+        i = int(match.group(1))
+        if i >= len(results):
+            continue
+        results[i].returncode = int(match.group(2))
+        results[i].stdout = base64.b64decode(match.group(3)).decode(
+            errors="replace")
+        results[i].stderr = base64.b64decode(match.group(4)).decode(
+            errors="replace")
+
+    for result in results:
+        if result.ok():
+            continue
+        if result.get_returncode() == None:
+            msg = f"exec script on {get_connhost(conn)} stopped before {result.get_step().get_cmd()}, {output}"
+        else:
+            msg = f"exec script step {result.get_step().get_cmd()} on {get_connhost(conn)} failed with {result.get_returncode()}, {result.get_output()}"
+        if interrupt:
+            raise kopf.PermanentError(msg)
+        logger.error(msg)
+        break
+
+    return results
+
+
+class RateLimiter:
+    """token bucket, qps tokens per second and at most burst tokens."""
+
+    def __init__(self, qps: int, burst: int):
+        self.qps = qps
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.qps)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.qps
+            time.sleep(wait)
+
+
+class LimitedApiClient(client.ApiClient):
+
+    def __init__(self, limiter: RateLimiter, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def call_api(self, *args, **kwargs):
+        self.limiter.acquire()
+        return super().call_api(*args, **kwargs)
+
+
+api_lock = threading.Lock()
+api_limiter = None
+api_client = None
+exec_apis = []
+
+
+def new_api_client() -> client.ApiClient:
+    global api_limiter
+    if api_limiter == None:
+        api_limiter = RateLimiter(operator_config.K8S_API_QPS,
+                                  operator_config.K8S_API_BURST)
+    # default configuration is set by kopf login (incluster or kubeconfig)
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = operator_config.K8S_API_POOL_SIZE
+    api = LimitedApiClient(api_limiter, configuration)
+    # keep the connections to the apiserver alive between two calls
+    api.rest_client.pool_manager.connection_pool_kw["socket_options"] = \
+        urllib3.connection.HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    return api
+
+
+def get_api_client() -> client.ApiClient:
+    """the ApiClient shared by every rest call of the operator."""
+    global api_client
+    with api_lock:
+        if api_client == None:
+            api_client = new_api_client()
+        return api_client
+
+
+def get_core_v1_api() -> client.CoreV1Api:
+    return client.CoreV1Api(get_api_client())
+
+
+def get_apps_v1_api() -> client.AppsV1Api:
+    return client.AppsV1Api(get_api_client())
+
+
+def get_custom_objects_api() -> client.CustomObjectsApi:
+    return client.CustomObjectsApi(get_api_client())
+
+
+@contextlib.contextmanager
+def exec_api() -> Iterator[client.CoreV1Api]:
+    """check out a CoreV1Api for one pod exec.
+
+    stream() swaps api_client.request with the websocket request while it
+    runs, an api client is never shared by two concurrent stream() calls
+    nor by rest calls. released clients are kept for the next exec.
+    """
+    with api_lock:
+        api = exec_apis.pop() if len(exec_apis) > 0 else None
+    if api == None:
+        api = client.CoreV1Api(new_api_client())
+    try:
+        yield api
+    finally:
+        with api_lock:
+            if len(exec_apis) < operator_config.EXEC_PARALLELISM:
+                exec_apis.append(api)
+
+
+class SqlEndpoint:
+
+    def __init__(self, host: str, port: int, user: str, password: str,
+                 dbname: str):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.dbname = dbname
+
+    def get_key(self) -> Tuple:
+        return (self.host, self.port, self.user, self.dbname)
+
+    def get_host(self) -> str:
+        return self.host
+
+
+class SqlConnectionPool:
+    """a few idle psycopg connections per endpoint.
+
+    an endpoint which can't be reached is not tried again for
+    SQL_ENDPOINT_RETRY seconds, the callers use exec meanwhile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.broken = {}
+
+    def usable(self, endpoint: SqlEndpoint) -> bool:
+        if psycopg == None or operator_config.SQL_POOL_SIZE == 0:
+            return False
+        with self.lock:
+            return time.time() >= self.broken.get(endpoint.get_key(), 0)
+
+    def acquire(self, endpoint: SqlEndpoint) -> Any:
+        with self.lock:
+            idle = self.idle.get(endpoint.get_key(), [])
+            while len(idle) > 0:
+                connection = idle.pop()
+                if not connection.closed:
+                    return connection
+        return psycopg.connect(host=endpoint.host,
+                               port=endpoint.port,
+                               user=endpoint.user,
+                               password=endpoint.password,
+                               dbname=endpoint.dbname,
+                               connect_timeout=SQL_CONNECT_TIMEOUT,
+                               application_name=SQL_APPLICATION_NAME,
+                               autocommit=True)
+
+    def release(self, endpoint: SqlEndpoint, connection: Any,
+                broken: bool) -> None:
+        if broken:
+            connection.close()
+            with self.lock:
+                self.broken[endpoint.get_key()] = time.time(
+                ) + SQL_ENDPOINT_RETRY
+                for idle in self.idle.pop(endpoint.get_key(), []):
+                    idle.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(endpoint.get_key(), [])
+            if len(idle) < operator_config.SQL_POOL_SIZE:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def mark_broken(self, endpoint: SqlEndpoint) -> None:
+        with self.lock:
+            self.broken[endpoint.get_key()] = time.time() + SQL_ENDPOINT_RETRY
+
+    def close_all(self) -> None:
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
+
+
+sql_connection_pool = SqlConnectionPool()
+
+
+def sql_endpoint(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    conn: InstanceConnection,
+) -> SqlEndpoint:
+    """where and how the operator connects to conn over the network.
+
+    the monitor is reached as autoctl_node, the postgresql nodes as the
+    first admin user. return None when there is no such user.
+    """
+    if get_conn_role(conn) == AUTOFAILOVER:
+        password = patch.status.get(AUTOCTL_NODE)
+        if password == None:
+            password = status.get(AUTOCTL_NODE)
+        if password == None:
+            return None
+        return SqlEndpoint(get_connhost(conn), AUTO_FAILOVER_PORT,
+                           AUTOCTL_NODE, password, AUTOCTL_DATABASE)
+
+    admins = spec[POSTGRESQL].get(SPEC_POSTGRESQL_USERS,
+                                  {}).get(SPEC_POSTGRESQL_USERS_ADMIN, [])
+    if len(admins) == 0:
+        return None
+    return SqlEndpoint(
+        get_connhost(conn),
+        get_postgresql_config_port(meta, spec, patch, status, logger),
+        admins[0][SPEC_POSTGRESQL_USERS_USER_NAME],
+        admins[0][SPEC_POSTGRESQL_USERS_USER_PASSWORD], "postgres")
+
+
+def query_rows(conn: InstanceConnection,
+               query: str,
+               logger: logging.Logger,
+               endpoint: SqlEndpoint = None,
+               dbname: str = None) -> List[Dict]:
+    """rows of query as dicts, None if the query failed.
+
+    the rows are aggregated to json by the server, so the pooled connection
+    to endpoint and the pgtools exec fallback return the same values.
+    """
+    query = f"select coalesce(json_agg(t), '[]') from ({query}) t"
+    if endpoint != None and sql_connection_pool.usable(endpoint):
+        broken = False
+        try:
+            connection = sql_connection_pool.acquire(endpoint)
+        except Exception as e:
+            logger.warning(
+                f"can't connect {endpoint.get_host()}, use exec. {e}")
+            sql_connection_pool.mark_broken(endpoint)
+        else:
+            try:
+                return connection.execute(query).fetchone()[0]
+            except psycopg.Error as e:
+                broken = True
+                logger.warning(
+                    f"query on {endpoint.get_host()} failed, use exec. {e}")
+            finally:
+                sql_connection_pool.release(endpoint, connection, broken)
+
+    cmd = ["pgtools", "-w", "0"]
+    if dbname != None:
+        cmd += ["-Q", dbname]
+    cmd += ["-q", f'" {query} "']
+    output = exec_command(conn, cmd, logger, interrupt=False)
+    try:
+        rows = json.loads(output)
+    except json.JSONDecodeError as e:
+        logger.warning(f"can't decode query result {output}, {e}")
+        return None
+    if not isinstance(rows, list):
+        logger.warning(f"can't decode query result {output}")
+        return None
+    return rows
+
+
+def pod_exec_result(name: str,
+                    namespace: str,
+                    cmd: [str],
+                    logger: logging.Logger,
+                    user: str = "root",
+                    timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT,
+                    stdin: str = None) -> ExecResult:
+    resp = None
+    try:
+        with exec_api() as api:
+            resp = stream(
+                api.connect_get_namespaced_pod_exec,
+                name,
+                namespace,
+                command=["/bin/bash", "-c", " ".join(['gosu', user] + cmd)],
+                stderr=True,
+                container=PODSPEC_CONTAINERS_POSTGRESQL_CONTAINER,
+                stdin=stdin != None,
+                stdout=True,
+                tty=False,
+                _preload_content=False)
+        if stdin != None:
+            resp.write_stdin(stdin)
+        # in order to keep json format.
+        # more information please visit https://github.com/kubernetes-client/python/issues/811#issuecomment-663458763
+        resp.run_forever(timeout=timeout)
+        stdout = resp.read_stdout()
+        stderr = resp.read_stderr()
+        # None if the command is still running after timeout
+        return ExecResult(resp.returncode, stdout, stderr)
+    except Exception as e:
+        return ExecResult(None, '', str(e), e)
+    finally:
+        if resp != None:
+            resp.close()
+
+
 def pod_exec_command(name: str,
                      namespace: str,
                      cmd: [str],
                      logger: logging.Logger,
                      interrupt: bool = True,
                      user: str = "root",
-                     timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT) -> str:
-    try:
-        core_v1_api = client.CoreV1Api()
-        # stderr stdout all in resp. don't have return code.
-        resp = stream(
-            core_v1_api.connect_get_namespaced_pod_exec,
-            name,
-            namespace,
-            command=["/bin/bash", "-c", " ".join(['gosu', user] + cmd)],
-            stderr=True,
-            container=PODSPEC_CONTAINERS_POSTGRESQL_CONTAINER,
-            stdin=False,
-            stdout=True,
-            tty=False,
-            _preload_content=False)
-        # in order to keep json format.
-        # more information please visit https://github.com/kubernetes-client/python/issues/811#issuecomment-663458763
-        resp.run_forever(timeout=timeout)
-        return resp.read_stdout().replace(
-            '\n', '') + resp.read_stderr().replace('\n', '')
-    except Exception as e:
+                     timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT,
+                     stdin: str = None) -> str:
+    # stderr stdout all in output. don't have return code.
+    result = pod_exec_result(name, namespace, cmd, logger, user, timeout,
+                             stdin)
+    if result.get_error() != None:
         if interrupt:
             raise kopf.PermanentError(
-                f"pod {name} exec command({cmd}) failed {e}")
+                f"pod {name} exec command({cmd}) failed {result.get_error()}")
         else:
-            logger.error(f"pod {name} exec command({cmd}) failed {e}")
+            logger.error(
+                f"pod {name} exec command({cmd}) failed {result.get_error()}")
             return FAILED
+    return result.get_output()
 
 
 def string_to_base64(cmd: str) -> str:
@@ -1394,6 +2645,130 @@ def docker_exec_command(role: str,
     return ret.replace('\r\n', '\n')
 
 
+def docker_exec_result(role: str,
+                       ssh: paramiko.SSHClient,
+                       cmd: [str],
+                       logger: logging.Logger,
+                       user: str = "root",
+                       host: str = None,
+                       timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT
+                       ) -> ExecResult:
+    # no pty, so stderr and the exit status of pgtools stay apart
+    try:
+        base64_cmd = [string_to_base64(" ".join(cmd))]
+        user_cmd = "docker exec " + role + " " + " ".join(
+            ['gosu', user, 'pgtools', '-f'] + base64_cmd)
+        logger.info(f"docker exec command {cmd} on host {host}")
+        ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(user_cmd,
+                                                             timeout=timeout)
+        stdout = ssh_stdout.read().decode()
+        stderr = ssh_stderr.read().decode()
+        return ExecResult(ssh_stdout.channel.recv_exit_status(), stdout,
+                          stderr)
+    except Exception as e:
+        return ExecResult(None, '', str(e), e)
+
+
+def exec_command_stream(
+        conn: InstanceConnection,
+        cmd: [str],
+        logger: logging.Logger,
+        user: str = "root",
+        timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT) -> Iterator[str]:
+    """yield the stdout of cmd chunk by chunk while it runs.
+
+    the output is never held as a whole, so it can be as large as it wants.
+    stderr is only logged. raise kopf.TemporaryError if the exec fails.
+    """
+    deadline = time.time() + timeout
+    if conn.get_k8s() != None:
+        resp = None
+        try:
+            with exec_api() as api:
+                resp = stream(
+                    api.connect_get_namespaced_pod_exec,
+                    conn.get_k8s().get_podname(),
+                    conn.get_k8s().get_namespace(),
+                    command=["/bin/bash", "-c", " ".join(['gosu', user] + cmd)],
+                    stderr=True,
+                    container=PODSPEC_CONTAINERS_POSTGRESQL_CONTAINER,
+                    stdin=False,
+                    stdout=True,
+                    tty=False,
+                    _preload_content=False)
+            while True:
+                is_open = resp.is_open()
+                if is_open:
+                    resp.update(timeout=1)
+                if resp.peek_stdout():
+                    yield resp.read_stdout()
+                if resp.peek_stderr():
+                    logger.warning(
+                        f"pod {get_connhost(conn)} exec command({cmd}) stderr {resp.read_stderr()}"
+                    )
+                if not is_open:
+                    break
+                if time.time() > deadline:
+                    raise kopf.TemporaryError(
+                        f"not completed in {timeout} seconds")
+        except kopf.TemporaryError:
+            raise
+        except Exception as e:
+            raise kopf.TemporaryError(
+                f"pod {get_connhost(conn)} exec command({cmd}) failed {e}")
+        finally:
+            if resp != None:
+                resp.close()
+        return
+
+    user_cmd = "docker exec " + conn.get_machine().get_role() + " " + " ".join(
+        ['gosu', user, 'pgtools', '-f', string_to_base64(" ".join(cmd))])
+    logger.info(
+        f"docker exec command {cmd} on host {get_connhost(conn)}, stream output"
+    )
+    try:
+        ssh_stdin, ssh_stdout, ssh_stderr = conn.get_machine().get_ssh(
+        ).exec_command(user_cmd, timeout=timeout)
+        channel = ssh_stdout.channel
+        # a chunk may end in the middle of a utf-8 character
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            data = channel.recv(EXEC_STREAM_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            yield decoder.decode(data)
+            if time.time() > deadline:
+                raise kopf.TemporaryError(
+                    f"not completed in {timeout} seconds")
+        err_output = ssh_stderr.read().decode()
+        if err_output != "":
+            logger.warning(
+                f"docker exec command {cmd} on host {get_connhost(conn)} stderr {err_output}"
+            )
+    except kopf.TemporaryError:
+        raise
+    except Exception as e:
+        raise kopf.TemporaryError(
+            f"docker exec command {cmd} on host {get_connhost(conn)} failed {e}"
+        )
+
+
+def exec_command_result(
+        conn: InstanceConnection,
+        cmd: [str],
+        logger: logging.Logger,
+        user: str = "root",
+        timeout: int = EXEC_COMMAND_DEFAULT_TIMEOUT) -> ExecResult:
+    """exec_command with the exit status and stdout/stderr apart, never raises."""
+    if conn.get_k8s() != None:
+        return pod_exec_result(conn.get_k8s().get_podname(),
+                               conn.get_k8s().get_namespace(), cmd, logger,
+                               user, timeout)
+    return docker_exec_result(conn.get_machine().get_role(),
+                              conn.get_machine().get_ssh(), cmd, logger, user,
+                              conn.get_machine().get_host(), timeout)
+
+
 def machine_exec_command(ssh: paramiko.SSHClient,
                          cmd: str,
                          interrupt: bool = True) -> str:
@@ -1593,12 +2968,17 @@ def get_primary_conn(conns: InstanceConnections,
     if timeout <= 1:
         timeout = 1
 
+    cmd = ["pgtools", "-w", "0", "-q", "'show transaction_read_only'"]
     for i in range(0, timeout):
+        retryable = False
         for conn in conns.get_conns():
-            cmd = ["pgtools", "-w", "0", "-q", "'show transaction_read_only'"]
-            output = exec_command(conn, cmd, logger, interrupt=False)
-            if output == "off":
+            result = exec_command_result(conn, cmd, logger)
+            if result.ok() and result.get_lines() == ["off"]:
                 return conn
+            retryable = retryable or result.retryable()
+        if not retryable:
+            logger.error(f"get primary conn failed, can't query any node.")
+            break
         time.sleep(1)
         logger.warning(f"get primary conn failed. try again {i} times.")
 
@@ -1683,6 +3063,119 @@ def patch_statefulset_restartPolicy(policy: str) -> TypedDict:
     return {"spec": {"template": {"spec": {"restartPolicy": policy}}}}
 
 
+def apply_statefulset(body: TypedDict) -> Any:
+    """server-side apply body, create the statefulset if it doesn't exist.
+
+    the client has no apply content type, so call the api directly. the
+    rest client only encodes json content types, the body is sent as a json
+    string which is valid yaml.
+    """
+    apps_v1_api = get_apps_v1_api()
+    return apps_v1_api.api_client.call_api(
+        '/apis/apps/v1/namespaces/{namespace}/statefulsets/{name}',
+        'PATCH',
+        path_params={
+            'namespace': body["metadata"]["namespace"],
+            'name': body["metadata"]["name"]
+        },
+        query_params=[('fieldManager', STATEFULSET_FIELD_MANAGER),
+                      ('force', 'true')],
+        header_params={
+            'Accept': 'application/json',
+            'Content-Type': 'application/apply-patch+yaml'
+        },
+        body=json.dumps(
+            apps_v1_api.api_client.sanitize_for_serialization(body)),
+        response_type='V1StatefulSet',
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True)
+
+
+def get_storage_topology(vct: List) -> List:
+    return sorted((v["metadata"]["name"], v["spec"].get("storageClassName"),
+                   tuple(v["spec"].get("accessModes", [])),
+                   v["spec"].get("volumeMode", "Filesystem")) for v in vct)
+
+
+def statefulset_updatable(name: str, namespace: str, vct: List,
+                          logger: logging.Logger) -> bool:
+    """True if the statefulset can be applied in place.
+
+    it must exist, be applied by the operator (fields of an older create are
+    never removed by an apply) and keep its volumes, the size is resized on
+    the pvc itself.
+    """
+    apps_v1_api = get_apps_v1_api()
+    try:
+        statefulset = apps_v1_api.read_namespaced_stateful_set(name, namespace)
+    except Exception as e:
+        logger.warning(f"read statefulset {name} failed, {e}")
+        return False
+
+    applied = False
+    for managed in statefulset.metadata.managed_fields or []:
+        if managed.manager == STATEFULSET_FIELD_MANAGER and managed.operation == "Apply":
+            applied = True
+    if applied == False:
+        logger.info(f"statefulset {name} is not applied by operator")
+        return False
+
+    current = apps_v1_api.api_client.sanitize_for_serialization(
+        statefulset)["spec"].get("volumeClaimTemplates", [])
+    if get_storage_topology(current) != get_storage_topology(vct):
+        logger.info(f"statefulset {name} storage topology changed")
+        return False
+    return True
+
+
+def waiting_statefulset_rollout(name: str,
+                                namespace: str,
+                                generation: int,
+                                logger: logging.Logger,
+                                timeout: int = WAIT_TIMEOUT) -> bool:
+    """wait until the pods of generation are running and ready."""
+    apps_v1_api = get_apps_v1_api()
+    field_selector = f"metadata.name={name}"
+
+    def check() -> bool:
+        statefulset = apps_v1_api.read_namespaced_stateful_set_status(
+            name, namespace)
+        status = statefulset.status
+        if (status.observed_generation or 0) < generation or \
+                status.update_revision != status.current_revision or \
+                (status.updated_replicas or 0) < statefulset.spec.replicas or \
+                (status.ready_replicas or 0) < statefulset.spec.replicas:
+            logger.info(
+                f"statefulset {name} rolling out, revision {status.current_revision} -> {status.update_revision}"
+            )
+            return False
+        return True
+
+    def signal(timeout: float) -> bool:
+        if timeout < 1:
+            return False
+        statefulsets = apps_v1_api.list_namespaced_stateful_set(
+            namespace, field_selector=field_selector)
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                    apps_v1_api.list_namespaced_stateful_set,
+                    namespace,
+                    field_selector=field_selector,
+                    resource_version=statefulsets.metadata.resource_version,
+                    timeout_seconds=int(timeout)):
+                logger.debug(f"statefulset {name} {event['type']} event")
+                return True
+        finally:
+            w.stop()
+        return False
+
+    if not wait_until(check, timeout, signal):
+        logger.warning(f"statefulset {name} rollout not completed.")
+        return False
+    return True
+
+
 def patch_role_body(role: str) -> TypedDict:
     role_body = {"metadata": {"labels": {"role": role}}}
     return role_body
@@ -1707,37 +3200,96 @@ def resize_pvc(
     pvc_name: str,
     size: str,
 ) -> None:
-    core_v1_api = client.CoreV1Api()
+    resize_pvcs(meta, spec, patch, status, logger, [pvc_name], size)
 
-    try:
-        real_size, real_status = read_pvc_size_and_status(
-            meta, spec, patch, status, logger, pvc_name)
-        core_v1_api.patch_namespaced_persistent_volume_claim(
-            pvc_name, meta["namespace"], patch_pvc_body(size))
 
-        if convert_to_bytes(real_size) >= convert_to_bytes(size):
-            logger.warning(f"pvc {pvc_name} does not need expand.")
-            return
+def pvc_resized(pvc: client.V1PersistentVolumeClaim, size: str) -> bool:
+    """the pvc reached size, or only waits for the pod to grow the filesystem."""
+    if pvc.status == None:
+        return False
+    capacity = (pvc.status.capacity or {}).get("storage")
+    if capacity != None and convert_to_bytes(capacity) >= convert_to_bytes(
+            size):
+        return True
+    for condition in pvc.status.conditions or []:
+        if condition.type == "FileSystemResizePending":
+            return True
+    return False
 
-        i = 0
-        while i < WAIT_TIMEOUT and real_status != "FileSystemResizePending" and convert_to_bytes(
-                real_size) < convert_to_bytes(size):
+
+def resize_pvcs(
+    meta: kopf.Meta,
+    spec: kopf.Spec,
+    patch: kopf.Patch,
+    status: kopf.Status,
+    logger: logging.Logger,
+    pvc_names: List[str],
+    size: str,
+    timeout: int = WAIT_TIMEOUT,
+    label_selector: str = None,
+) -> List[str]:
+    """patch all pvcs to size, then watch them until they are resized.
+
+    the volumes expand concurrently, the pods recreated later only need to
+    grow the filesystem when FileSystemResizePending is set. label_selector
+    limits the watch to the pvcs of one field. return the pvcs which are
+    not resized in timeout, a storage class which only expands detached
+    volumes never resizes a mounted pvc.
+    """
+    core_v1_api = get_core_v1_api()
+    namespace = meta["namespace"]
+
+    pending = set()
+    for pvc_name in pvc_names:
+        try:
             real_size, real_status = read_pvc_size_and_status(
                 meta, spec, patch, status, logger, pvc_name)
-            i += 1
+            if real_size != None and convert_to_bytes(
+                    real_size) >= convert_to_bytes(size):
+                logger.warning(f"pvc {pvc_name} does not need expand.")
+                continue
+            core_v1_api.patch_namespaced_persistent_volume_claim(
+                pvc_name, namespace, patch_pvc_body(size))
+            pending.add(pvc_name)
+        except Exception as e:
+            logger.error(
+                "Exception when calling AppsV1Api->patch_namespaced_persistent_volume_claim or read_namespaced_persistent_volume_claim: %s\n"
+                % e)
+
+    deadline = time.time() + timeout
+    while len(pending) > 0 and time.time() < deadline:
+        w = watch.Watch()
+        try:
+            pvcs = core_v1_api.list_namespaced_persistent_volume_claim(
+                namespace, label_selector=label_selector)
+            for pvc in pvcs.items:
+                if pvc.metadata.name in pending and pvc_resized(pvc, size):
+                    logger.info(f"resize_pvc on {pvc.metadata.name} success.")
+                    pending.discard(pvc.metadata.name)
+            if len(pending) == 0:
+                break
+            for event in w.stream(
+                    core_v1_api.list_namespaced_persistent_volume_claim,
+                    namespace,
+                    label_selector=label_selector,
+                    resource_version=pvcs.metadata.resource_version,
+                    timeout_seconds=max(int(deadline - time.time()), 1)):
+                pvc = event["object"]
+                if pvc.metadata.name in pending and pvc_resized(pvc, size):
+                    logger.info(f"resize_pvc on {pvc.metadata.name} success.")
+                    pending.discard(pvc.metadata.name)
+                    if len(pending) == 0:
+                        break
+        except Exception as e:
+            logger.warning(f"watch pvcs {pending} failed, {e}")
             time.sleep(SECONDS)
-            logger.warning(
-                f"resize_pvc on {pvc_name} not success, try {i} times. current status is {real_status}, current size is {real_size}"
-            )
-            if i == WAIT_TIMEOUT:
-                logger.error(
-                    f"resize_pvc on {pvc_name} timeout, skip waiting. current status is {real_status}, current size is {real_size}"
-                )
-    except Exception as e:
-        logger.error(
-            "Exception when calling AppsV1Api->patch_namespaced_persistent_volume_claim or read_namespaced_persistent_volume_claim: %s\n"
-            % e)
-        time.sleep(SECONDS * 10)
+        finally:
+            w.stop()
+
+    if len(pending) > 0:
+        logger.warning(
+            f"resize_pvc on {sorted(pending)} timeout, skip waiting.")
+    return sorted(pending)
 
 
 def read_pvc_size_and_status(
@@ -1748,7 +3300,7 @@ def read_pvc_size_and_status(
     logger: logging.Logger,
     pvc_name: str,
 ) -> (str, str):
-    core_v1_api = client.CoreV1Api()
+    core_v1_api = get_core_v1_api()
 
     pvc = client.V1PersistentVolumeClaim(
         core_v1_api.read_namespaced_persistent_volume_claim(
@@ -1796,7 +3348,7 @@ def postgresql_action(
             replicas = 0
 
         try:
-            apps_v1_api = client.AppsV1Api()
+            apps_v1_api = get_apps_v1_api()
 
             name = pod_name_get_statefulset_name(conn.get_k8s().get_podname())
             namespace = conn.get_k8s().get_namespace()
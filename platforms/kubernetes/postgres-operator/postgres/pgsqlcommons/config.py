@@ -23,6 +23,17 @@ class Config:
     DATA_PATH_POSTGRESQL: str = os.path.join(DATA_PATH, POSTGRESQL)
     IMAGE_REGISTRY: str = ""
     NAMESPACE_OVERRIDE: str = ""
+    SSH_POOL_MAX_PER_HOST: int = 16
+    SSH_POOL_IDLE_TIMEOUT: int = 300
+    SSH_POOL_LEASE_TIMEOUT: int = 3600
+    EXEC_PARALLELISM: int = 64
+    K8S_API_POOL_SIZE: int = 32
+    K8S_API_QPS: int = 50
+    K8S_API_BURST: int = 100
+    TIMER_TASK_TIMEOUT: int = 50
+    LOG_INGEST: bool = False
+    SQL_POOL_SIZE: int = 2
+    CREATE_PARALLELISM: int = 4
 
     def __init__(self, *, prefix: str):
         self._prefix = prefix
@@ -123,6 +134,158 @@ class Config:
         self.NAMESPACE_OVERRIDE = self.env("NAMESPACE_OVERRIDE",
                                            default=self.NAMESPACE_OVERRIDE)
 
+        # SSH_POOL_MAX_PER_HOST
+        ssh_pool_max_per_host = self.env("SSH_POOL_MAX_PER_HOST",
+                                         default=str(
+                                             self.SSH_POOL_MAX_PER_HOST))
+        try:
+            self.SSH_POOL_MAX_PER_HOST = int(ssh_pool_max_per_host)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_MAX_PER_HOST="
+                f"'{ssh_pool_max_per_host}'. Needs to be a positive integer.")
+        if self.SSH_POOL_MAX_PER_HOST < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_MAX_PER_HOST="
+                f"'{ssh_pool_max_per_host}'. Needs to be large than 0.")
+
+        # SSH_POOL_IDLE_TIMEOUT
+        ssh_pool_idle_timeout = self.env("SSH_POOL_IDLE_TIMEOUT",
+                                         default=str(
+                                             self.SSH_POOL_IDLE_TIMEOUT))
+        try:
+            self.SSH_POOL_IDLE_TIMEOUT = int(ssh_pool_idle_timeout)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_IDLE_TIMEOUT="
+                f"'{ssh_pool_idle_timeout}'. Needs to be a positive integer.")
+        if self.SSH_POOL_IDLE_TIMEOUT < 0:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_IDLE_TIMEOUT="
+                f"'{ssh_pool_idle_timeout}'. Needs to be a positive integer.")
+
+        # SSH_POOL_LEASE_TIMEOUT
+        ssh_pool_lease_timeout = self.env("SSH_POOL_LEASE_TIMEOUT",
+                                          default=str(
+                                              self.SSH_POOL_LEASE_TIMEOUT))
+        try:
+            self.SSH_POOL_LEASE_TIMEOUT = int(ssh_pool_lease_timeout)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_LEASE_TIMEOUT="
+                f"'{ssh_pool_lease_timeout}'. Needs to be a positive integer.")
+        if self.SSH_POOL_LEASE_TIMEOUT < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SSH_POOL_LEASE_TIMEOUT="
+                f"'{ssh_pool_lease_timeout}'. Needs to be large than 0.")
+
+        # EXEC_PARALLELISM
+        exec_parallelism = self.env("EXEC_PARALLELISM",
+                                    default=str(self.EXEC_PARALLELISM))
+        try:
+            self.EXEC_PARALLELISM = int(exec_parallelism)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}EXEC_PARALLELISM="
+                f"'{exec_parallelism}'. Needs to be a positive integer.")
+        if self.EXEC_PARALLELISM < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}EXEC_PARALLELISM="
+                f"'{exec_parallelism}'. Needs to be large than 0.")
+
+        # K8S_API_POOL_SIZE
+        k8s_api_pool_size = self.env("K8S_API_POOL_SIZE",
+                                     default=str(self.K8S_API_POOL_SIZE))
+        try:
+            self.K8S_API_POOL_SIZE = int(k8s_api_pool_size)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_POOL_SIZE="
+                f"'{k8s_api_pool_size}'. Needs to be a positive integer.")
+        if self.K8S_API_POOL_SIZE < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_POOL_SIZE="
+                f"'{k8s_api_pool_size}'. Needs to be large than 0.")
+
+        # K8S_API_QPS
+        k8s_api_qps = self.env("K8S_API_QPS",
+                               default=str(self.K8S_API_QPS))
+        try:
+            self.K8S_API_QPS = int(k8s_api_qps)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_QPS="
+                f"'{k8s_api_qps}'. Needs to be a positive integer.")
+        if self.K8S_API_QPS < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_QPS="
+                f"'{k8s_api_qps}'. Needs to be large than 0.")
+
+        # K8S_API_BURST
+        k8s_api_burst = self.env("K8S_API_BURST",
+                                 default=str(self.K8S_API_BURST))
+        try:
+            self.K8S_API_BURST = int(k8s_api_burst)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_BURST="
+                f"'{k8s_api_burst}'. Needs to be a positive integer.")
+        if self.K8S_API_BURST < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_BURST="
+                f"'{k8s_api_burst}'. Needs to be large than 0.")
+
+        if self.K8S_API_BURST < self.K8S_API_QPS:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}K8S_API_BURST="
+                f"'{k8s_api_burst}'. Needs to be large than K8S_API_QPS.")
+
+        # TIMER_TASK_TIMEOUT
+        timer_task_timeout = self.env("TIMER_TASK_TIMEOUT",
+                                      default=str(self.TIMER_TASK_TIMEOUT))
+        try:
+            self.TIMER_TASK_TIMEOUT = int(timer_task_timeout)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}TIMER_TASK_TIMEOUT="
+                f"'{timer_task_timeout}'. Needs to be a positive integer.")
+        if self.TIMER_TASK_TIMEOUT < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}TIMER_TASK_TIMEOUT="
+                f"'{timer_task_timeout}'. Needs to be large than 0.")
+
+        # LOG_INGEST
+        log_ingest = self.env("LOG_INGEST", default=str(self.LOG_INGEST))
+        self.LOG_INGEST = log_ingest.lower() == "true"
+
+        # SQL_POOL_SIZE
+        sql_pool_size = self.env("SQL_POOL_SIZE",
+                                 default=str(self.SQL_POOL_SIZE))
+        try:
+            self.SQL_POOL_SIZE = int(sql_pool_size)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SQL_POOL_SIZE="
+                f"'{sql_pool_size}'. Needs to be a positive integer.")
+        if self.SQL_POOL_SIZE < 0:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}SQL_POOL_SIZE="
+                f"'{sql_pool_size}'. Needs to be large than -1.")
+
+        # CREATE_PARALLELISM
+        create_parallelism = self.env("CREATE_PARALLELISM",
+                                      default=str(self.CREATE_PARALLELISM))
+        try:
+            self.CREATE_PARALLELISM = int(create_parallelism)
+        except ValueError:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}CREATE_PARALLELISM="
+                f"'{create_parallelism}'. Needs to be a positive integer.")
+        if self.CREATE_PARALLELISM < 1:
+            raise kopf.TemporaryError(
+                f"Invalid {self._prefix}CREATE_PARALLELISM="
+                f"'{create_parallelism}'. Needs to be large than 0.")
+
     def env(self, name: str, *, default=UNDEFINED) -> str:
         full_name = f"{self._prefix}{name}"
         try:
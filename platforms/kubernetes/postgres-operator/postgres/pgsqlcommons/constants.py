@@ -35,12 +35,21 @@ PGAUTOFAILOVER_REPLICATOR = "pgautofailover_replicator"
 STREAMING = "streaming"
 STREAMING_ASYNC = "async"
 STREAMING_SYNC = "sync"
+MAX_UNAVAILABLE = "maxUnavailable"
+MAX_UNAVAILABLE_DEFAULT_VALUE = 1
 DELETE_PVC = "deletepvc"
 SPEC_DELETE_S3 = "deletes3"
 UPDATE_TOLERATION = "updatetoleration"
 POSTGRESQL_PVC_NAME = "data"
 SUCCESS = "exec_success"
 FAILED = "exec_failed"
+PUT_FILE_SUFFIX = ".put"
+SCRIPT_STEP_MARK = "exec_step"
+EXEC_STREAM_CHUNK_SIZE = 64 * 1024
+# exec errors which don't go away by retrying: the command can't be run or
+# is not found, the exec itself is not authorized.
+EXEC_NONRETRYABLE_CODES = (126, 127)
+EXEC_NONRETRYABLE_API_STATUS = (401, 403)
 SERVICES = "services"
 SELECTOR = "selector"
 SERVICE_AUTOFAILOVER = "autofailover"
@@ -127,6 +136,9 @@ CLUSTER_STATUS_SERVER_CRT = "server_crt"
 CLUSTER_STATUS_CRON_NEXT_RUN = "cron_next_run_time"
 CLUSTER_STATUS_DISASTER_BACKUP_STATUS = 'disaster_backup_status'
 CLUSTER_STATUS_TIMER = 'timer'
+CLUSTER_STATUS_TIMER_DURATION = 'timer_duration'
+CLUSTER_STATUS_TIMER_DURATION_TIMEOUT = 'timeout'
+CLUSTER_STATUS_IMAGE_PREPULL = 'image_prepull'
 
 # base label
 BASE_LABEL_PART_OF = "part-of"
@@ -409,10 +421,22 @@ DIFF_FIELD_SPEC_SWITCHOVER_MASTERNODE = (SPEC, SPEC_SWITCHOVER,
                                          SPEC_SWITCHOVER_MASTERNODE)
 
 STATEFULSET_REPLICAS = 1
-PG_CONFIG_MASTER_LARGE_THAN_SLAVE = ("max_connections", "max_worker_processes",
-                                     "max_wal_senders",
-                                     "max_prepared_transactions",
-                                     "max_locks_per_transaction")
+STATEFULSET_FIELD_MANAGER = POSTGRES_OPERATOR
+PREPULL_SUFFIX = "prepull"
+PREPULL_TIMEOUT = MINUTES * 10
+SSH_POOL_EVICT_INTERVAL = SECONDS * 30
+# a prepull container waiting for one of these reasons has no image yet
+PREPULL_PULLING_REASONS = [
+    "ContainerCreating", "ErrImagePull", "ImagePullBackOff",
+    "ErrImageNeverPull", "InvalidImageName"
+]
+# pvcs not resized while mounted are resized once their pod is deleted
+PVC_RESIZE_ONLINE_TIMEOUT = MINUTES * 5
+PG_SETTINGS_CONTEXT_QUERY = "select name, context from pg_settings"
+PG_SETTINGS_PENDING_RESTART_QUERY = "select pg_conf_load_time()::text as load_time, coalesce(string_agg(name, ',') filter (where pending_restart), '') as pending_restart from pg_settings"
+PG_SETTINGS_CONTEXT_INTERNAL = "internal"
+PG_SETTINGS_CONTEXT_POSTMASTER = "postmaster"
+# used when pg_settings can't be queried
 PG_CONFIG_IGNORE = ("block_size", "data_checksums", "data_directory_mode",
                     "debug_assertions", "integer_datetimes", "lc_collate",
                     "lc_ctype", "max_function_args", "max_identifier_length",
@@ -480,6 +504,79 @@ NODE_PRIORITY_NEVER = 0
 WAIT_TIMEOUT = MINUTES * 20
 POSTGRESQL_IMAGE_VERSION_v1_1_0 = 'v1.1.0'
 
+## auto_failover monitor
+AUTOCTL_NODE_NAME = "nodename"
+AUTOCTL_NODE_HOST = "nodehost"
+AUTOCTL_NODE_PORT = "nodeport"
+AUTOCTL_NODE_REPORTEDSTATE = "reportedstate"
+AUTOCTL_NODE_GOALSTATE = "goalstate"
+AUTOCTL_NODE_HEALTH = "health"
+AUTOCTL_NODE_REPORTEDLSN = "reportedlsn"
+AUTOCTL_NODE_REPORTEDTLI = "reportedtli"
+AUTOCTL_NODE_REPLICATIONQUORUM = "replicationquorum"
+AUTOCTL_FORMATION_NUMBER_SYNC_STANDBYS = "number_sync_standbys"
+AUTOCTL_STATE_PRIMARY = "primary"
+AUTOCTL_STATE_SECONDARY = "secondary"
+AUTOCTL_STATE_SINGLE = "single"
+AUTOCTL_STATE_WAIT_PRIMARY = "wait_primary"
+AUTOCTL_STATE_CATCHINGUP = "catchingup"
+AUTOCTL_STATE_WAIT_STANDBY = "wait_standby"
+AUTOCTL_STATE_JSON_NAME = "nodename"
+AUTOCTL_STATE_JSON_HOST = "nodehost"
+AUTOCTL_STATE_JSON_PORT = "nodeport"
+AUTOCTL_STATE_JSON_TLI = "reported_tli"
+AUTOCTL_STATE_JSON_LSN = "reported_lsn"
+AUTOCTL_STATE_JSON_STATE = "current_group_state"
+AUTOCTL_NODES_QUERY = f"select nodename as {AUTOCTL_NODE_NAME}, nodehost as {AUTOCTL_NODE_HOST}, nodeport as {AUTOCTL_NODE_PORT}, reportedstate as {AUTOCTL_NODE_REPORTEDSTATE}, goalstate as {AUTOCTL_NODE_GOALSTATE}, health as {AUTOCTL_NODE_HEALTH}, reportedtli as {AUTOCTL_NODE_REPORTEDTLI}, reportedlsn as {AUTOCTL_NODE_REPORTEDLSN} from pgautofailover.node order by nodeid"
+AUTOCTL_QUORUM_QUERY = f"select n.nodehost as {AUTOCTL_NODE_HOST}, n.reportedstate as {AUTOCTL_NODE_REPORTEDSTATE}, n.replicationquorum as {AUTOCTL_NODE_REPLICATIONQUORUM}, f.number_sync_standbys as {AUTOCTL_FORMATION_NUMBER_SYNC_STANDBYS} from pgautofailover.node n join pgautofailover.formation f on f.formationid = n.formationid where n.formationid = 'primary' order by n.nodeid"
+AUTOCTL_DATABASE = "pg_auto_failover"
+
+## direct sql
+SQL_CONNECT_TIMEOUT = 3
+# seconds an endpoint is not tried again after a failed connection
+SQL_ENDPOINT_RETRY = 60
+SQL_APPLICATION_NAME = "postgres-operator"
+
+## postgresql log table
+PGLOG_TABLE_PREFIX = "log_postgresql_"
+PGLOG_FILE_PREFIX = "postgresql_"
+PGLOG_DAYS = 31
+PGLOG_MIN_VERSION = 12
+PGLOG_MAX_VERSION = 15
+# csvlog columns, (name, type, first postgresql major version)
+PGLOG_COLUMNS = [
+    ("log_time", "timestamp(3)", 12),
+    ("user_name", "text", 12),
+    ("database_name", "text", 12),
+    ("process_id", "integer", 12),
+    ("connection_from", "text", 12),
+    ("session_id", "text", 12),
+    ("session_line_num", "bigint", 12),
+    ("command_tag", "text", 12),
+    ("session_start_time", "timestamp", 12),
+    ("virtual_transaction_id", "text", 12),
+    ("transaction_id", "bigint", 12),
+    ("error_severity", "text", 12),
+    ("sql_state_code", "text", 12),
+    ("message", "text", 12),
+    ("detail", "text", 12),
+    ("hint", "text", 12),
+    ("internal_query", "text", 12),
+    ("internal_query_pos", "integer", 12),
+    ("context", "text", 12),
+    ("query", "text", 12),
+    ("query_pos", "integer", 12),
+    ("location", "text", 12),
+    ("application_name", "text", 12),
+    ("backend_type", "text", 13),
+    ("leader_pid", "integer", 14),
+    ("query_id", "bigint", 14),
+]
+PGLOG_STORE_TABLE = "log_postgresql_store"
+PGLOG_STORE_STAGE_TABLE = "log_postgresql_store_stage"
+PGLOG_STORE_OFFSET_TABLE = "log_postgresql_store_offset"
+PGLOG_STORE_FUNCTION = "log_postgresql_store_ingest"
+
 ## backup
 BACKUP_MODE_NONE = "none"
 BACKUP_MODE_S3_MANUAL = "manual"
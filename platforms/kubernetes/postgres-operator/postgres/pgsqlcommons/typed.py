@@ -1,11 +1,10 @@
+import logging
 import paramiko
-from typing import Dict, TypedDict, TypeVar, Optional, List, Optional, Callable, Tuple, Any
+from typing import Dict, TypedDict, TypeVar, Optional, List, Optional, Callable, Tuple, Any, Iterator
 from pgsqlcommons.constants import (
     AUTOFAILOVER,
     POSTGRESQL,
 )
-# import logging
-# logger = logging.getLogger()
 
 LabelType = Dict[str, str]
 
@@ -14,7 +13,8 @@ class InstanceConnectionMachine:
 
     def __init__(self, host: str, port: int, username: str, password: str,
                  ssh: paramiko.SSHClient, sftp: paramiko.SFTPClient,
-                 trans: paramiko.Transport, role: str):
+                 trans: paramiko.Transport, role: str,
+                 pool: Any = None):
         self.host = host
         self.port = port
         self.username = username
@@ -23,9 +23,17 @@ class InstanceConnectionMachine:
         self.sftp = sftp
         self.trans = trans
         self.role = role
+        self.pool = pool
+        self.broken = False
 
     def __del__(self):
-        # logger.warning("InstanceConnectionMachine free_conn")
+        # a finalizer must not take the pool lock, the pool closes the
+        # session once it sees its holder is gone.
+        if self.pool != None:
+            if self.ssh != None:
+                logging.warning(
+                    f"ssh session to machine {self.host} is not freed")
+            return
         self.free_conn()
 
     def get_host(self):
@@ -49,7 +57,23 @@ class InstanceConnectionMachine:
     def get_trans(self):
         return self.trans
 
+    def set_broken(self):
+        # the session may still be in use, free_conn closes it
+        self.broken = True
+
+    def is_broken(self):
+        return self.broken
+
     def free_conn(self):
+        # pooled session, give it back instead of closing it
+        if self.pool != None:
+            if self.ssh != None:
+                self.pool.release(self)
+            self.ssh = None
+            self.trans = None
+            self.sftp = None
+            return
+
         # ssh
         if self.ssh != None:
             self.ssh.close()
@@ -101,10 +125,6 @@ class InstanceConnection:
             self.machine = None
         return None
 
-    def __del__(self):
-        # logger.warning("InstanceConnection free_conn")
-        self.free_conn()
-
 
 class InstanceConnections:
 
@@ -126,6 +146,8 @@ class InstanceConnections:
         for conn in self.conns:
             conn.free_conn()
 
-    def __del__(self):
-        # logger.warning("InstanceConnections free_conn")
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
         self.free_conns()
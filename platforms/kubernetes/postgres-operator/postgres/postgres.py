@@ -21,7 +21,7 @@ from pgsqlclusters.update import update_cluster
 from pgsqlclusters.delete import delete_cluster
 from pgsqlclusters.timer import timer_cluster
 from pgsqlclusters.daemon import daemon_cluster
-from pgsqlclusters.utiles import set_cluster_status
+from pgsqlclusters.utiles import set_cluster_status, machine_connection_pool, sql_connection_pool
 from pgsqlbackups.main import create_backup, delete_backup, check_backup, daemon_backup
 from pgsqlbackups.constants import *
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -51,6 +51,12 @@ def startup(settings: kopf.OperatorSettings, **_kwargs):
         pass
 
 
+@kopf.on.cleanup()
+def cleanup(**_kwargs):
+    machine_connection_pool.close_all()
+    sql_connection_pool.close_all()
+
+
 # timeout: if create function run timeout large than timeout and no error. this is allow.
 #          if create function run timeout large than timeout and error happend, it not retry,
 #          if create function run timeout less than timeout and error happend, it do retry,
@@ -0,0 +1,86 @@
+import json
+
+import kopf
+import pytest
+
+from unittest import mock
+
+from pgsqlcommons.constants import *
+from pgsqlbackups.constants import *
+from pgsqlcommons.typed import InstanceConnections
+import pgsqlbackups.utils as backup_util
+
+
+def backup_list_output():
+    backups = [{
+        BARMAN_BACKUP_ID: "20240101T000000",
+        BARMAN_BACKUP_END: "Mon Jan  1 00:01:00 2024",
+        "size": "16.0 MiB",
+    }, {
+        BARMAN_BACKUP_ID: "20240102T000000",
+        BARMAN_BACKUP_ERROR: "failure [1, 2]",
+    }]
+    return 'pgtools begin\n{"%s": %s}\n' % (BARMAN_BACKUP_LISTS,
+                                            json.dumps(backups))
+
+
+def test_backup_list_parser_at_every_chunk_boundary():
+    output = backup_list_output()
+    for size in range(1, len(output) + 1):
+        parser = backup_util.BackupListParser()
+        for i in range(0, len(output), size):
+            parser.feed(output[i:i + size])
+
+        assert parser.ok(), size
+        assert parser.get_backup_info() == {
+            BARMAN_BACKUP_LISTS: [{
+                BARMAN_BACKUP_ID: "20240101T000000",
+                BARMAN_BACKUP_END: "Mon Jan  1 00:01:00 2024",
+            }, {
+                BARMAN_BACKUP_ID: "20240102T000000",
+                BARMAN_BACKUP_ERROR: "failure [1, 2]",
+            }]
+        }
+
+
+def test_backup_list_parser_truncated_output():
+    output = backup_list_output()
+    parser = backup_util.BackupListParser()
+    parser.feed(output[:output.find("20240102T000000")])
+
+    assert not parser.ok()
+    assert parser.get_error() == "backup list is truncated"
+    assert len(parser.get_backup_info()[BARMAN_BACKUP_LISTS]) == 1
+
+
+def test_backup_list_parser_malformed_entry():
+    parser = backup_util.BackupListParser()
+    parser.feed('{"%s": [{"backup_id": x}' % BARMAN_BACKUP_LISTS)
+    parser.feed(" " * BACKUP_LIST_ENTRY_MAX_SIZE)
+
+    assert not parser.ok()
+    assert parser.get_error().startswith("backup entry is malformed")
+    assert parser.buffer == ""
+    parser.feed("]}")
+    assert not parser.ok()
+
+    parser = backup_util.BackupListParser()
+    parser.feed('{"%s": [1, 2]}' % BARMAN_BACKUP_LISTS)
+    assert not parser.ok()
+    assert parser.get_error().startswith("backup entry expected")
+
+
+def test_get_s3_backup_list_rejects_partial_list(monkeypatch):
+    conn = mock.Mock()
+    conns = InstanceConnections()
+    conns.add(conn)
+    monkeypatch.setattr(backup_util.pgsql_util, "connections",
+                        lambda *args: conns)
+    monkeypatch.setattr(backup_util, "get_need_s3_env", lambda *args: [])
+    output = backup_list_output()
+    monkeypatch.setattr(backup_util.pgsql_util, "exec_command_stream",
+                        lambda *args, **kwargs: iter([output[:-10]]))
+
+    with pytest.raises(kopf.TemporaryError):
+        backup_util.get_s3_backup_list({}, {}, None, {}, mock.Mock())
+    conn.free_conn.assert_called_once()
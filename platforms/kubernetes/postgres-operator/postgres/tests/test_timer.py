@@ -0,0 +1,99 @@
+import time
+
+import pytest
+from unittest import mock
+
+import pgsqlclusters.timer as pgsql_timer
+import pgsqlclusters.utiles as pgsql_util
+from pgsqlcommons.config import operator_config
+
+
+def timer_ctx():
+    ctx = pgsql_timer.TimerContext({
+        "name": "pg",
+        "namespace": "ns"
+    }, {}, mock.Mock(), {}, mock.Mock())
+    ctx.free_conns = mock.Mock()
+    return ctx
+
+
+def test_run_timer_tasks_stops_waiting_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(operator_config, "TIMER_TASK_TIMEOUT", 0.2)
+    ctx = timer_ctx()
+    ctx.set_broken = mock.Mock()
+
+    def quick_task(meta, spec, patch, status, logger, ctx):
+        pgsql_util.set_cluster_status(meta, "quick", "done", logger)
+
+    def slow_task(meta, spec, patch, status, logger, ctx):
+        time.sleep(1)
+
+    def failed_task(meta, spec, patch, status, logger, ctx):
+        raise Exception("failed")
+
+    batch = pgsql_util.StatusBatch()
+    begin = time.time()
+    durations = pgsql_timer.run_timer_tasks(
+        ctx, [quick_task, slow_task, failed_task], batch)
+
+    assert time.time() - begin < 0.8
+    assert durations["quick_task"] >= 0
+    assert durations["slow_task"] == pgsql_util.CLUSTER_STATUS_TIMER_DURATION_TIMEOUT
+    assert durations["failed_task"] == -1
+    assert batch.take() == {
+        (pgsql_util.RESOURCE_POSTGRESQL, "ns", "pg"): {
+            "quick": "done"
+        }
+    }
+    ctx.set_broken.assert_called_once()
+    ctx.free_conns.assert_called_once()
+
+
+def test_timer_context_closes_sessions_after_a_timeout():
+    ctx = pgsql_timer.TimerContext({}, {}, mock.Mock(), {}, mock.Mock())
+    conn = mock.Mock()
+    conns = pgsql_util.InstanceConnections()
+    conns.add(conn)
+    ctx.conns["field"] = conns
+
+    ctx.set_broken()
+    ctx.free_conns()
+
+    conn.get_machine.return_value.set_broken.assert_called_once()
+    conn.free_conn.assert_called_once()
+    with pytest.raises(pgsql_util.kopf.TemporaryError):
+        ctx.get_conns("field")
+
+
+def test_correct_postgresql_status_lsn_reads_observed_nodes(monkeypatch):
+    monkeypatch.setattr(pgsql_timer, "exec_command", mock.Mock())
+    ctx = timer_ctx()
+    node = {
+        pgsql_util.AUTOCTL_NODE_NAME: "node_1",
+        pgsql_util.AUTOCTL_NODE_HOST: "pg-0",
+        pgsql_util.AUTOCTL_NODE_PORT: 5432,
+        pgsql_util.AUTOCTL_NODE_REPORTEDSTATE: "primary",
+        pgsql_util.AUTOCTL_NODE_GOALSTATE: "primary",
+        pgsql_util.AUTOCTL_NODE_HEALTH: 1,
+        pgsql_util.AUTOCTL_NODE_REPORTEDTLI: 1,
+        pgsql_util.AUTOCTL_NODE_REPORTEDLSN: "0/3000148",
+    }
+    disaster = dict(node)
+    disaster[pgsql_util.AUTOCTL_NODE_NAME] = pgsql_util.AUTOCTL_DISASTER_NAME
+    disaster[pgsql_util.AUTOCTL_NODE_HOST] = "dr-0"
+    disaster[pgsql_util.AUTOCTL_NODE_REPORTEDSTATE] = "secondary"
+    ctx.observed = pgsql_timer.ClusterObservation(None, [node, disaster], [],
+                                                  [], [], None)
+    patch = mock.Mock()
+    patch.status = {}
+
+    pgsql_timer.correct_postgresql_status_lsn(ctx.meta, ctx.spec, patch, {},
+                                              ctx.logger, ctx)
+
+    assert patch.status[pgsql_util.CLUSTER_STATUS_DISASTER_BACKUP_STATUS] == {
+        "dr-0:5432": {
+            "LSN": "1:0/3000148",
+            "state": "secondary"
+        }
+    }
+    pgsql_timer.exec_command.assert_not_called()
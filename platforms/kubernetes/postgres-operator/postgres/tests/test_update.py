@@ -0,0 +1,257 @@
+from unittest import mock
+
+from kubernetes import client
+
+import pgsqlclusters.update as pgsql_update
+from pgsqlcommons.config import operator_config
+from pgsqlcommons.constants import *
+
+
+def node(state, quorum, number_sync_standbys=0):
+    return {
+        AUTOCTL_NODE_REPORTEDSTATE: state,
+        AUTOCTL_NODE_REPLICATIONQUORUM: quorum,
+        AUTOCTL_FORMATION_NUMBER_SYNC_STANDBYS: number_sync_standbys,
+    }
+
+
+def test_split_rolling_waves_async_standbys_use_max_unavailable():
+    hosts = ["ro-%d" % i for i in range(5)]
+    nodes = {host: node(AUTOCTL_STATE_SECONDARY, False) for host in hosts}
+    nodes["rw-0"] = node(AUTOCTL_STATE_PRIMARY, True)
+
+    assert pgsql_update.split_rolling_waves(hosts, nodes,
+                                            2) == [[0, 1], [2, 3], [4]]
+
+
+def test_split_rolling_waves_caps_quorum_standbys():
+    hosts = ["rw-%d" % i for i in range(5)]
+    # 4 quorum standbys, 2 must stay up
+    nodes = {host: node(AUTOCTL_STATE_SECONDARY, True, 2) for host in hosts}
+    nodes["rw-2"] = node(AUTOCTL_STATE_PRIMARY, True, 2)
+
+    assert pgsql_update.split_rolling_waves(hosts, nodes,
+                                            3) == [[0, 1], [3, 4], [2]]
+
+
+def test_split_rolling_waves_mixed_and_unknown_hosts():
+    hosts = ["rw-0", "rw-1", "rw-2", "rw-3", "rw-4"]
+    nodes = {
+        "rw-0": node(AUTOCTL_STATE_WAIT_PRIMARY, True, 1),
+        "rw-1": node(AUTOCTL_STATE_SECONDARY, True, 1),
+        "rw-2": node(AUTOCTL_STATE_SECONDARY, False, 1),
+        "rw-3": node(AUTOCTL_STATE_SECONDARY, False, 1),
+    }
+
+    # one quorum standby for number_sync_standbys 1, none to spare
+    assert pgsql_update.split_rolling_waves(hosts[:4], nodes,
+                                            4) == [[2, 3], [1], [0]]
+    # rw-4 has no monitor node, it may be the primary
+    assert pgsql_update.split_rolling_waves(hosts, nodes,
+                                            4) == [[0], [1], [2], [3], [4]]
+
+
+def test_get_rolling_waves_is_serial_without_monitor(monkeypatch):
+    monkeypatch.setattr(pgsql_update.pgsql_util, "get_autofailover_quorum",
+                        lambda *args: None)
+    spec = {POSTGRESQL: {READONLYINSTANCE: {REPLICAS: 3, MAX_UNAVAILABLE: 2}}}
+
+    assert pgsql_update.get_rolling_waves(
+        {}, spec, None, {}, mock.Mock(),
+        POSTGRESQL + FIELD_DELIMITER + READONLYINSTANCE) == [[0], [1], [2]]
+
+
+def pod(labels=None, images=(), waiting=()):
+    statuses = [
+        client.V1ContainerStatus(
+            name="c%d" % i,
+            image="",
+            image_id="",
+            ready=False,
+            restart_count=0,
+            state=client.V1ContainerState(
+                waiting=client.V1ContainerStateWaiting(reason=reason)))
+        for i, reason in enumerate(waiting)
+    ]
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(labels=labels),
+        spec=client.V1PodSpec(containers=[
+            client.V1Container(name="c%d" % i, image=image)
+            for i, image in enumerate(images)
+        ]),
+        status=client.V1PodStatus(container_statuses=statuses))
+
+
+def test_prepull_pod_pulled():
+    assert pgsql_update.prepull_pod_pulled(
+        pod(waiting=["CrashLoopBackOff", "RunContainerError"]))
+    assert not pgsql_update.prepull_pod_pulled(
+        pod(waiting=["CrashLoopBackOff", "ImagePullBackOff"]))
+    assert not pgsql_update.prepull_pod_pulled(pod())
+
+
+def test_prepull_images_only_pulls_changed_images(monkeypatch):
+    monkeypatch.setattr(operator_config, "IMAGE_REGISTRY", "")
+    monkeypatch.setattr(operator_config, "NAMESPACE_OVERRIDE", "")
+    monkeypatch.setattr(pgsql_update.pgsql_util, "set_cluster_status",
+                        mock.Mock())
+    monkeypatch.setattr(pgsql_update.kopf, "adopt", mock.Mock())
+    prepull = "pg-readonlyinstance-" + PREPULL_SUFFIX
+    apps_api = mock.Mock()
+    apps_api.read_namespaced_daemon_set_status.return_value = client.V1DaemonSet(
+        metadata=client.V1ObjectMeta(generation=2),
+        status=client.V1DaemonSetStatus(current_number_scheduled=1,
+                                        desired_number_scheduled=1,
+                                        number_misscheduled=0,
+                                        number_ready=0,
+                                        observed_generation=2))
+    core_api = mock.Mock()
+
+    def list_pods(namespace, label_selector):
+        if label_selector == PREPULL_SUFFIX + "=" + prepull:
+            return client.V1PodList(items=[
+                pod({"pod-template-generation": "1"}, [],
+                    ["CrashLoopBackOff"]),
+                pod({"pod-template-generation": "2"}, [],
+                    ["ContainerCreating"]),
+            ] if len(core_api.list_namespaced_pod.call_args_list) < 3 else [
+                pod({"pod-template-generation": "2"}, [],
+                    ["CrashLoopBackOff"])
+            ])
+        return client.V1PodList(
+            items=[pod(images=["reg/ns/pg:1", "reg/ns/exporter:1"])])
+
+    core_api.list_namespaced_pod.side_effect = list_pods
+    monkeypatch.setattr(pgsql_update.pgsql_util, "get_apps_v1_api",
+                        lambda: apps_api)
+    monkeypatch.setattr(pgsql_update.pgsql_util, "get_core_v1_api",
+                        lambda: core_api)
+    spec = {
+        POSTGRESQL: {
+            READONLYINSTANCE: {
+                PODSPEC: {
+                    CONTAINERS: [{
+                        CONTAINER_NAME: "postgresql",
+                        IMAGE: "reg/ns/pg:2"
+                    }, {
+                        CONTAINER_NAME: "exporter",
+                        IMAGE: "reg/ns/exporter:1"
+                    }],
+                    "affinity": {
+                        "nodeAffinity": {
+                            "key": "value"
+                        },
+                        "podAntiAffinity": {
+                            "key": "value"
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    pgsql_update.prepull_images({
+        "name": "pg",
+        "namespace": "ns"
+    }, spec, None, {}, mock.Mock(),
+                                [POSTGRESQL + FIELD_DELIMITER + READONLYINSTANCE],
+                                timeout=10)
+
+    body = apps_api.create_namespaced_daemon_set.call_args.args[1]
+    template_spec = body["spec"]["template"]["spec"]
+    assert [c["image"] for c in template_spec["containers"]] == ["reg/ns/pg:2"]
+    assert template_spec["affinity"] == {"nodeAffinity": {"key": "value"}}
+    assert core_api.list_namespaced_pod.call_count == 3
+    apps_api.delete_namespaced_daemon_set.assert_called_once()
+
+
+def conn(host):
+    c = mock.MagicMock()
+    c.get_k8s.return_value = None
+    c.get_machine.return_value.get_host.return_value = host
+    return c
+
+
+def test_reload_configs_returns_nodes_which_need_restart(monkeypatch):
+    reloaded, pending, failed = conn("a"), conn("b"), conn("c")
+    unreachable, lost = conn("d"), conn("e")
+    load_times = {
+        reloaded: ["1", "2"],
+        pending: ["1", "1", "2"],
+        failed: ["1"],
+        unreachable: [None],
+        lost: ["1", None],
+    }
+
+    def get_pending_restart(meta, spec, patch, status, logger, c):
+        load_time = load_times[c].pop(0)
+        if load_time == None:
+            return None, None
+        if c is pending and load_time == "2":
+            return load_time, ["shared_buffers"]
+        return load_time, []
+
+    monkeypatch.setattr(pgsql_update, "get_pending_restart",
+                        get_pending_restart)
+    monkeypatch.setattr(
+        pgsql_update.pgsql_util, "exec_command",
+        lambda c, *args, **kwargs: "failed" if c is failed else SUCCESS)
+    wait_until = mock.Mock(
+        side_effect=lambda check, *args, **kwargs: check() or check())
+    monkeypatch.setattr(pgsql_update.pgsql_util, "wait_until", wait_until)
+
+    assert pgsql_update.reload_configs(
+        {}, {}, None, {}, mock.Mock(),
+        [reloaded, pending, failed, unreachable, lost], ["pgtools", "-c"],
+        ["shared_buffers"]) == [pending, failed, unreachable, lost]
+    # the unreachable node is not waited for
+    assert wait_until.call_count == 3
+
+
+def test_reload_configs_without_static_restart_parameters(monkeypatch):
+    unreachable = conn("a")
+    monkeypatch.setattr(pgsql_update, "get_pending_restart",
+                        lambda *args: (None, None))
+    monkeypatch.setattr(pgsql_update.pgsql_util, "exec_command",
+                        lambda *args, **kwargs: SUCCESS)
+
+    assert pgsql_update.reload_configs({}, {}, None, {}, mock.Mock(),
+                                       [unreachable], ["pgtools", "-c"]) == []
+
+
+def test_update_configs_reloads_and_restarts_only_pending_nodes(monkeypatch):
+    conns = pgsql_update.pgsql_util.InstanceConnections()
+    nodes = [conn("a"), conn("b")]
+    for c in nodes:
+        conns.add(c)
+    monkeypatch.setattr(pgsql_update.pgsql_util, "connections",
+                        lambda *args: conns)
+    monkeypatch.setattr(
+        pgsql_update, "get_pg_settings_context", lambda *args: {
+            "work_mem": "user",
+            "shared_buffers": "postmaster",
+            "block_size": "internal",
+        })
+    reload_configs = mock.Mock(return_value=[])
+    update_configs_utile = mock.Mock()
+    monkeypatch.setattr(pgsql_update, "reload_configs", reload_configs)
+    monkeypatch.setattr(pgsql_update, "update_configs_utile",
+                        update_configs_utile)
+    old = ["work_mem=4MB", "shared_buffers=128MB", "block_size=8192"]
+    new = ["work_mem=8MB", "shared_buffers=256MB", "block_size=16384"]
+
+    pgsql_update.update_configs({}, {}, None, {}, mock.Mock(), DIFF_CHANGE,
+                                DIFF_FIELD_AUTOFAILOVER_CONFIGS, old, new)
+
+    cmd = reload_configs.call_args.args[6]
+    assert cmd == [
+        "pgtools", "-c", "-e", PG_CONFIG_PREFIX + 'work_mem="8MB"', "-e",
+        PG_CONFIG_PREFIX + 'shared_buffers="256MB"'
+    ]
+    assert reload_configs.call_args.args[7] == ["shared_buffers"]
+    update_configs_utile.assert_not_called()
+
+    reload_configs.return_value = [nodes[1]]
+    pgsql_update.update_configs({}, {}, None, {}, mock.Mock(), DIFF_CHANGE,
+                                DIFF_FIELD_AUTOFAILOVER_CONFIGS, old, new)
+    assert update_configs_utile.call_args.args[5] == [nodes[1]]
@@ -0,0 +1,576 @@
+import json
+import time
+
+import pytest
+import urllib3
+from unittest import mock
+from kubernetes import client
+
+import pgsqlclusters.utiles as pgsql_util
+
+
+def test_apply_statefulset_through_rest_client(monkeypatch):
+    configuration = client.Configuration()
+    configuration.host = "https://k8s.example:6443"
+    api_client = client.ApiClient(configuration)
+    response = urllib3.HTTPResponse(
+        body=json.dumps({
+            "kind": "StatefulSet",
+            "metadata": {
+                "name": "sts",
+                "namespace": "ns",
+                "generation": 2
+            }
+        }).encode(),
+        status=200,
+        headers={"Content-Type": "application/json"},
+        preload_content=False)
+    pool_manager = mock.Mock()
+    pool_manager.request.return_value = response
+    api_client.rest_client.pool_manager = pool_manager
+    monkeypatch.setattr(pgsql_util, "get_apps_v1_api",
+                        lambda: client.AppsV1Api(api_client))
+
+    body = {
+        "apiVersion": "apps/v1",
+        "kind": "StatefulSet",
+        "metadata": {
+            "name": "sts",
+            "namespace": "ns"
+        },
+        "spec": {
+            "replicas": 1
+        }
+    }
+    applied = pgsql_util.apply_statefulset(body)
+
+    assert applied.metadata.generation == 2
+    args, kwargs = pool_manager.request.call_args
+    assert args[0] == "PATCH"
+    assert args[1].startswith(
+        "https://k8s.example:6443/apis/apps/v1/namespaces/ns/statefulsets/sts"
+    )
+    assert "fieldManager=" in args[1] and "force=true" in args[1]
+    assert kwargs["headers"][
+        "Content-Type"] == "application/apply-patch+yaml"
+    assert json.loads(kwargs["body"]) == body
+
+
+def test_exec_api_is_checked_out_exclusively(monkeypatch):
+    monkeypatch.setattr(pgsql_util, "exec_apis", [])
+    with pgsql_util.exec_api() as first:
+        with pgsql_util.exec_api() as second:
+            assert first is not second
+            assert first.api_client is not second.api_client
+    with pgsql_util.exec_api() as again:
+        assert again is first or again is second
+    assert len(pgsql_util.exec_apis) == 2
+
+
+def machine_conn(role=pgsql_util.POSTGRESQL):
+    conn = mock.MagicMock()
+    conn.get_k8s.return_value = None
+    conn.get_machine.return_value.get_role.return_value = role
+    conn.get_machine.return_value.get_host.return_value = "192.168.0.1"
+    return conn
+
+
+def test_machine_sftp_put_sets_mode_before_content():
+    sftp = mock.MagicMock()
+    f = sftp.open.return_value.__enter__.return_value
+
+    pgsql_util.machine_sftp_put(sftp, "secret", "/data/pgpass", 0o600)
+
+    assert f.mock_calls[:2] == [
+        mock.call.chmod(0o600),
+        mock.call.write(b"secret")
+    ]
+    sftp.posix_rename.assert_called_once_with(
+        "/data/pgpass" + pgsql_util.PUT_FILE_SUFFIX, "/data/pgpass")
+
+
+def test_machine_sftp_same_chmods_only_open_files():
+    sftp = mock.MagicMock()
+    sftp.open.return_value.__enter__.return_value.read.side_effect = [
+        b"env", b""
+    ]
+    sftp.stat.return_value = mock.Mock(st_size=3, st_mode=0o100644)
+
+    assert pgsql_util.machine_sftp_same(sftp, "env", "/data/env", 0o600)
+    sftp.chmod.assert_called_once_with("/data/env", 0o600)
+
+    sftp.reset_mock()
+    sftp.open.return_value.__enter__.return_value.read.side_effect = [
+        b"env", b""
+    ]
+    sftp.stat.return_value = mock.Mock(st_size=3, st_mode=0o100600)
+
+    assert pgsql_util.machine_sftp_same(sftp, "env", "/data/env", 0o600)
+    sftp.chmod.assert_not_called()
+
+
+def test_put_file_machine_always_removes_upload(monkeypatch):
+    conn = machine_conn()
+    commands = []
+    monkeypatch.setattr(
+        pgsql_util, "exec_command",
+        lambda conn, cmd, logger, interrupt=True: commands.append(cmd) or "")
+    path = pgsql_util.os.path.join(pgsql_util.DATA_DIR, "pgpass")
+    uploadpath = path + pgsql_util.PUT_FILE_SUFFIX * 2
+
+    assert pgsql_util.put_file(conn, path, "secret", mock.Mock(),
+                               interrupt=False) == False
+
+    sftp = conn.get_machine.return_value.get_sftp.return_value
+    sftp.open.return_value.__enter__.return_value.chmod.assert_called_once_with(
+        0o600)
+    cmd = commands[0]
+    assert cmd[:4] == ["cp", "-f", uploadpath, path + pgsql_util.PUT_FILE_SUFFIX]
+    assert cmd[cmd.index(";"):] == [
+        ";", "rm", "-f", uploadpath, path + pgsql_util.PUT_FILE_SUFFIX
+    ]
+
+
+def test_wait_until_returns_when_check_succeeds():
+    checks = []
+
+    def check():
+        checks.append(time.time())
+        return len(checks) == 3
+
+    assert pgsql_util.wait_until(check, 5, initial_delay=0.01) == True
+    assert len(checks) == 3
+
+
+def test_wait_until_times_out():
+    begin = time.time()
+    assert pgsql_util.wait_until(lambda: False, 0.2,
+                                 initial_delay=0.01) == False
+    assert 0.2 <= time.time() - begin < 1
+
+
+def test_wait_until_signal_resets_the_delay():
+    checks = []
+    signals = []
+
+    def check():
+        checks.append(time.time())
+        return len(checks) == 4
+
+    def signal(timeout):
+        signals.append(timeout)
+        return True
+
+    assert pgsql_util.wait_until(check, 5, signal, initial_delay=10) == True
+    assert len(signals) == 3
+
+
+def test_wait_until_backs_off_when_signal_has_nothing_to_wait():
+    checks = []
+    begin = time.time()
+    assert pgsql_util.wait_until(lambda: checks.append(1) or False,
+                                 0.3,
+                                 lambda timeout: False,
+                                 initial_delay=0.05) == False
+    # without a signal the delay still grows, no busy loop
+    assert len(checks) < 10
+    assert time.time() - begin >= 0.3
+
+
+def test_exec_wait_signal_without_process(monkeypatch):
+    monkeypatch.setattr(pgsql_util, "exec_command_result",
+                        lambda conn, cmd, logger: pgsql_util.ExecResult(1))
+    exec_command = mock.Mock()
+    monkeypatch.setattr(pgsql_util, "exec_command", exec_command)
+
+    signal = pgsql_util.exec_wait_signal(machine_conn(), "pg_basebackup",
+                                         mock.Mock())
+
+    assert signal(10) == False
+    exec_command.assert_not_called()
+
+
+def test_exec_wait_signal_waits_for_pid(monkeypatch):
+    commands = []
+    monkeypatch.setattr(
+        pgsql_util, "exec_command_result", lambda conn, cmd, logger:
+        commands.append(cmd) or pgsql_util.ExecResult(0, "42\n"))
+    exec_command = mock.Mock()
+    monkeypatch.setattr(pgsql_util, "exec_command", exec_command)
+
+    signal = pgsql_util.exec_wait_signal(machine_conn(),
+                                         "pg_basebackup|barman-cloud",
+                                         mock.Mock())
+
+    assert signal(10) == True
+    assert commands[0] == ["pgrep", "-o", "'pg_basebackup|barman-cloud'"]
+    assert exec_command.call_args[0][1] == [
+        "timeout", "10", "tail", "--pid=42", "-f", "/dev/null"
+    ]
+
+
+def pvc(name, capacity=None, conditions=None):
+    return client.V1PersistentVolumeClaim(
+        metadata=client.V1ObjectMeta(name=name),
+        status=client.V1PersistentVolumeClaimStatus(
+            capacity={"storage": capacity} if capacity else None,
+            conditions=[
+                client.V1PersistentVolumeClaimCondition(status="True",
+                                                        type=c)
+                for c in conditions or []
+            ]))
+
+
+def test_pvc_resized():
+    assert pgsql_util.pvc_resized(pvc("a", "2Gi"), "2Gi")
+    assert pgsql_util.pvc_resized(pvc("a", "1Gi", ["FileSystemResizePending"]),
+                                  "2Gi")
+    assert not pgsql_util.pvc_resized(pvc("a", "1Gi", ["Resizing"]), "2Gi")
+    assert not pgsql_util.pvc_resized(
+        client.V1PersistentVolumeClaim(metadata=client.V1ObjectMeta(name="a")),
+        "2Gi")
+
+
+def test_resize_pvcs_returns_offline_pvcs(monkeypatch):
+    api = mock.Mock()
+    api.list_namespaced_persistent_volume_claim.return_value = client.V1PersistentVolumeClaimList(
+        metadata=client.V1ListMeta(resource_version="1"),
+        items=[pvc("online", "2Gi"), pvc("offline", "1Gi")])
+    w = mock.Mock()
+    w.stream.return_value = iter([])
+    monkeypatch.setattr(pgsql_util, "get_core_v1_api", lambda: api)
+    monkeypatch.setattr(pgsql_util.watch, "Watch", lambda: w)
+    monkeypatch.setattr(pgsql_util, "read_pvc_size_and_status",
+                        lambda *args: ("1Gi", None))
+
+    pending = pgsql_util.resize_pvcs({"namespace": "ns"}, None, None, None,
+                                     mock.Mock(), ["online", "offline"],
+                                     "2Gi", timeout=1,
+                                     label_selector="a=b")
+
+    assert pending == ["offline"]
+    assert api.patch_namespaced_persistent_volume_claim.call_count == 2
+    for call in api.list_namespaced_persistent_volume_claim.call_args_list:
+        assert call.kwargs["label_selector"] == "a=b"
+
+
+def test_get_storage_topology_ignores_size():
+    vct = {
+        "metadata": {
+            "name": "data"
+        },
+        "spec": {
+            "accessModes": ["ReadWriteOnce"],
+            "storageClassName": "local",
+            "resources": {
+                "requests": {
+                    "storage": "1Gi"
+                }
+            }
+        }
+    }
+    resized = json.loads(json.dumps(vct))
+    resized["spec"]["resources"]["requests"]["storage"] = "2Gi"
+    moved = json.loads(json.dumps(vct))
+    moved["spec"]["storageClassName"] = "remote"
+
+    assert pgsql_util.get_storage_topology([vct]) == pgsql_util.get_storage_topology([resized])
+    assert pgsql_util.get_storage_topology([vct]) != pgsql_util.get_storage_topology([moved])
+
+
+def test_status_batch_merges_nested_writes(monkeypatch):
+    patch = mock.Mock(return_value=True)
+    monkeypatch.setattr(pgsql_util, "patch_cluster_status", patch)
+    meta = {"name": "pg", "namespace": "ns"}
+    logger = mock.Mock()
+
+    with pgsql_util.status_batch(logger) as batch:
+        pgsql_util.set_cluster_status(meta, "a", 1, logger)
+        with pgsql_util.status_batch(logger) as inner:
+            assert inner is batch
+            pgsql_util.set_cluster_status(meta, ["a", "b"], [2, 3], logger)
+        patch.assert_not_called()
+
+    patch.assert_called_once_with("ns", "pg", {
+        "a": 2,
+        "b": 3
+    }, logger, pgsql_util.MINUTES, pgsql_util.RESOURCE_POSTGRESQL)
+
+
+def test_patch_cluster_status_retries_failed_patch(monkeypatch):
+    api = mock.Mock()
+    api.patch_namespaced_custom_object.side_effect = [
+        client.exceptions.ApiException(status=500), None
+    ]
+    monkeypatch.setattr(pgsql_util, "get_custom_objects_api", lambda: api)
+
+    assert pgsql_util.patch_cluster_status("ns", "pg", {"a": 1}, mock.Mock(),
+                                           timeout=5)
+    assert api.patch_namespaced_custom_object.call_count == 2
+    assert api.patch_namespaced_custom_object.call_args.kwargs["body"] == {
+        pgsql_util.CLUSTER_STATUS: {
+            "a": 1
+        }
+    }
+
+
+def test_patch_cluster_status_gives_up_on_missing_object(monkeypatch):
+    api = mock.Mock()
+    api.patch_namespaced_custom_object.side_effect = client.exceptions.ApiException(
+        status=404)
+    monkeypatch.setattr(pgsql_util, "get_custom_objects_api", lambda: api)
+
+    assert not pgsql_util.patch_cluster_status("ns", "pg", {"a": 1},
+                                               mock.Mock(), timeout=5)
+    assert api.patch_namespaced_custom_object.call_count == 1
+
+
+def test_fan_out_keeps_the_order_of_conns():
+    conns = [machine_conn() for _ in range(4)]
+
+    def run(conn):
+        i = conns.index(conn)
+        time.sleep(0.01 * (4 - i))
+        if i == 2:
+            raise ValueError("failed")
+        return i
+
+    results = pgsql_util.fan_out(conns, run, mock.Mock(), fail_fast=False)
+
+    assert [result.get_conn() for result in results] == conns
+    assert [result.get_value() for result in results] == [0, 1, None, 3]
+    assert [result.ok() for result in results] == [True, True, False, True]
+    assert isinstance(results[2].get_error(), ValueError)
+
+
+def test_fan_out_limits_the_running_conns():
+    lock = pgsql_util.threading.Lock()
+    running = []
+    peak = []
+
+    def run(conn):
+        with lock:
+            running.append(conn)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(conn)
+
+    pgsql_util.fan_out([machine_conn() for _ in range(6)],
+                       run,
+                       mock.Mock(),
+                       limit=2)
+
+    assert max(peak) == 2
+
+
+def test_fan_out_nested_in_an_exec_worker_runs_inline():
+    conns = [machine_conn() for _ in range(3)]
+
+    def outer(conn):
+        results = pgsql_util.fan_out(conns, lambda c: conns.index(c),
+                                     mock.Mock())
+        return [result.get_value() for result in results]
+
+    future = pgsql_util.submit_exec(outer, None)
+
+    assert future.result(timeout=5) == [0, 1, 2]
+
+
+def test_exec_command_async_returns_the_output(monkeypatch):
+    monkeypatch.setattr(pgsql_util, "exec_command",
+                        lambda conn, cmd, *args: " ".join(cmd))
+
+    future = pgsql_util.exec_command_async(machine_conn(), ["echo", "ok"],
+                                           mock.Mock())
+
+    assert future.result(timeout=5) == "echo ok"
+
+
+def test_fan_out_fail_fast_raises_first_error():
+    with pytest.raises(ZeroDivisionError):
+        pgsql_util.fan_out([machine_conn()],
+                           lambda conn: 1 / 0,
+                           mock.Mock(),
+                           fail_fast=True)
+
+
+def test_fan_out_timeout_stops_waiting():
+    begin = time.time()
+    results = pgsql_util.fan_out([machine_conn()],
+                                 lambda conn: time.sleep(3),
+                                 mock.Mock(),
+                                 fail_fast=False,
+                                 timeout=0.1)
+
+    assert time.time() - begin < 2.5
+    assert isinstance(results[0].get_error(), pgsql_util.kopf.TemporaryError)
+
+
+def test_fan_out_fail_fast_waits_for_running_conns():
+    ended = []
+
+    def run(conn):
+        if conn == "fail":
+            raise ZeroDivisionError()
+        time.sleep(0.2)
+        ended.append(conn)
+
+    with pytest.raises(ZeroDivisionError):
+        pgsql_util.fan_out(["slow", "fail", "skipped"],
+                           run,
+                           mock.Mock(),
+                           limit=2)
+
+    assert ended == ["slow"]
+
+
+def test_exec_result_retryable_by_status_and_exception():
+    assert pgsql_util.ExecResult(1, "", "permission denied").retryable()
+    assert not pgsql_util.ExecResult(127, "", "").retryable()
+    assert not pgsql_util.ExecResult(
+        None, "", "", client.exceptions.ApiException(status=403)).retryable()
+    assert pgsql_util.ExecResult(
+        None, "", "", client.exceptions.ApiException(status=500)).retryable()
+    assert not pgsql_util.ExecResult(
+        None, "", "",
+        pgsql_util.paramiko.AuthenticationException()).retryable()
+
+
+def test_waiting_instance_ready_raises_permanent_error(monkeypatch):
+    monkeypatch.setattr(pgsql_util, "exec_command_result",
+                        lambda *args, **kwargs: pgsql_util.ExecResult(127))
+    monkeypatch.setattr(pgsql_util, "pod_event_signal",
+                        lambda *args: None)
+    conns = mock.Mock()
+    conns.get_number.return_value = 2
+    conns.get_conns.return_value = [machine_conn(), machine_conn()]
+
+    with pytest.raises(pgsql_util.kopf.PermanentError):
+        pgsql_util.waiting_instance_ready(conns, mock.Mock(), timeout=5)
+
+
+def pooled_machine(pool, session, host="192.168.0.1"):
+    return pgsql_util.InstanceConnectionMachine(host, 22, "root", "password",
+                                                session.ssh, session.sftp,
+                                                session.trans,
+                                                pgsql_util.POSTGRESQL, pool)
+
+
+def test_machine_pool_expires_leases_held_too_long(monkeypatch):
+    monkeypatch.setattr(pgsql_util.operator_config, "SSH_POOL_MAX_PER_HOST", 1)
+    monkeypatch.setattr(pgsql_util.operator_config, "SSH_POOL_LEASE_TIMEOUT",
+                        60)
+    pool = pgsql_util.MachineConnectionPool()
+    monkeypatch.setattr(
+        pool, "_open", lambda *args: pgsql_util.MachineSession(
+            mock.Mock(), mock.Mock(), mock.Mock(), "password"))
+
+    leaked = pool.acquire("root", "password", "192.168.0.1", 22,
+                          pgsql_util.POSTGRESQL)
+    with pytest.raises(pgsql_util.kopf.TemporaryError):
+        pool.acquire("root", "password", "192.168.0.1", 22,
+                     pgsql_util.POSTGRESQL, timeout=0)
+
+    pool.leased[leaked.ssh] = ("192.168.0.1", time.time() - 61)
+    session = pool.acquire("root", "password", "192.168.0.1", 22,
+                           pgsql_util.POSTGRESQL, timeout=0)
+    assert session is not leaked
+
+    # the expired session is closed when it comes back at last
+    machine = pooled_machine(pool, leaked)
+    machine.free_conn()
+    leaked.ssh.close.assert_called_once()
+    assert pool.idle == {}
+    assert pool.opened == {"192.168.0.1": 1}
+
+    machine = pooled_machine(pool, session)
+    machine.free_conn()
+    session.ssh.close.assert_not_called()
+    assert len(pool.idle[("root", "192.168.0.1", 22,
+                          pgsql_util.POSTGRESQL)]) == 1
+
+
+def test_machine_pool_closes_sessions_of_timed_out_conns(monkeypatch):
+    pool = pgsql_util.MachineConnectionPool()
+    monkeypatch.setattr(
+        pool, "_open", lambda *args: pgsql_util.MachineSession(
+            mock.Mock(), mock.Mock(), mock.Mock(), "password"))
+    session = pool.acquire("root", "password", "192.168.0.1", 22,
+                           pgsql_util.POSTGRESQL)
+    conn = pgsql_util.InstanceConnection(pooled_machine(pool, session), None)
+
+    results = pgsql_util.fan_out([conn],
+                                 lambda conn: time.sleep(1.5),
+                                 mock.Mock(),
+                                 fail_fast=False,
+                                 timeout=0.1)
+    assert isinstance(results[0].get_error(), pgsql_util.kopf.TemporaryError)
+
+    conn.free_conn()
+    session.ssh.close.assert_called_once()
+    assert pool.idle == {}
+    assert pool.opened == {}
+    assert pool.leased == {}
+
+
+def test_machine_pool_evicts_sessions_of_collected_holders(monkeypatch):
+    pool = pgsql_util.MachineConnectionPool()
+    monkeypatch.setattr(pool, "_start_evictor", lambda: None)
+    monkeypatch.setattr(
+        pool, "_open", lambda *args: pgsql_util.MachineSession(
+            mock.Mock(), mock.Mock(), mock.Mock(), "password"))
+    session = pool.acquire("root", "password", "192.168.0.1", 22,
+                           pgsql_util.POSTGRESQL)
+    machine = pooled_machine(pool, session)
+    pool.hold(session, machine)
+
+    pool.evict()
+    session.ssh.close.assert_not_called()
+
+    # the finalizer only logs, the session stays leased until evict
+    del machine
+    assert pool.idle == {}
+    assert pool.opened == {"192.168.0.1": 1}
+
+    pool.evict()
+    session.ssh.close.assert_called_once()
+    assert pool.opened == {}
+    assert pool.leased == {}
+    assert pool.holders == {}
+
+
+def test_instance_connections_are_freed_by_with():
+    conn = mock.Mock()
+    conns = pgsql_util.InstanceConnections()
+    conns.add(conn)
+
+    with pytest.raises(ValueError):
+        with conns:
+            raise ValueError()
+    conn.free_conn.assert_called_once()
+
+
+def test_rate_limiter_allows_burst_then_qps(monkeypatch):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(pgsql_util, "time",
+                        mock.Mock(monotonic=lambda: now[0], sleep=sleep))
+    limiter = pgsql_util.RateLimiter(qps=10, burst=3)
+
+    for _ in range(3):
+        limiter.acquire()
+    assert sleeps == []
+
+    limiter.acquire()
+    assert sleeps == [pytest.approx(0.1)]
+
+    now[0] += 10
+    for _ in range(3):
+        limiter.acquire()
+    assert len(sleeps) == 1